@@ -0,0 +1,25 @@
+from quart import Quart, redirect
+import os
+from dotenv import load_dotenv
+
+# Import async controllers
+from controllers.async_message_controller import message_bp, root_message_bp
+
+# Load environment variables
+load_dotenv()
+
+# Initialize Quart (asyncio-native version of the Flask app in app.py)
+app = Quart(__name__)
+
+# Register blueprints
+app.register_blueprint(message_bp)
+app.register_blueprint(root_message_bp)  # Register root level endpoints
+
+# Root endpoint redirects to API root
+@app.route('/')
+async def root():
+    return redirect('/api/')
+
+if __name__ == '__main__':
+    PORT = int(os.getenv('PORT', 5000))
+    app.run(host='0.0.0.0', port=PORT)
@@ -0,0 +1,180 @@
+"""
+Export benchmark: streams the full expense history of a user with a large number of
+expenses from /api/expenses/export and measures the time to first byte, the total time,
+the throughput and the peak memory (RSS) of the process serving it.
+
+The expenses are written to an embedded SQLite database file first, then each format is
+exported in a fresh Python process, so its peak RSS only comes from importing the app and
+streaming the export.
+
+Usage:
+    python -m benchmarks.export --rows 1000000 --output export.json
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from benchmarks.replay import git_revision
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+AUTH_KEY = "benchmark"
+TELEGRAM_ID = "1"
+
+# Runs in the child process, prints one JSON object with the measurements
+TRIAL = """
+import json, resource, sys, time
+from app import app
+
+def rss_bytes():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+client = app.test_client()
+baseline_rss = rss_bytes()
+start = time.perf_counter()
+response = client.get(
+    f"/api/expenses/export?telegram_id={sys.argv[1]}&format={sys.argv[2]}",
+    headers={"Authorization": sys.argv[3]}, buffered=False
+)
+first_byte = None
+size = 0
+lines = 0
+for chunk in response.response:
+    if first_byte is None and chunk:
+        first_byte = time.perf_counter() - start
+    size += len(chunk)
+    lines += chunk.count(b"\\n") if isinstance(chunk, bytes) else chunk.count("\\n")
+response.close()
+total = time.perf_counter() - start
+
+print(json.dumps({
+    "status": response.status_code,
+    "ttfb_ms": first_byte * 1000,
+    "total_ms": total * 1000,
+    "bytes": size,
+    "lines": lines,
+    "baseline_rss_bytes": baseline_rss,
+    # ru_maxrss is in KiB on Linux
+    "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+}))
+"""
+
+def seed_database(path, rows, seed=1):
+    """
+    Create a database with one user and `rows` expenses over the last year
+    """
+    from storage.sqlite_backend import SQLiteClient
+    from services.expense_parser import EXPENSE_CATEGORIES
+    SQLiteClient(path).table("users").insert({"telegram_id": TELEGRAM_ID}).execute()
+
+    rng = random.Random(seed)
+    start = datetime.now() - timedelta(days=365)
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("BEGIN")
+    batch = []
+    for index in range(rows):
+        added_at = start + timedelta(seconds=rng.uniform(0, 365 * 86400))
+        batch.append((
+            1, f"Expense {index}", round(rng.uniform(1, 500), 2), rng.choice(EXPENSE_CATEGORIES),
+            added_at.isoformat(timespec="microseconds")
+        ))
+        if len(batch) == 10000:
+            conn.executemany(
+                "INSERT INTO expenses (user_id, description, amount, category, added_at) VALUES (?, ?, ?, ?, ?)", batch
+            )
+            batch = []
+    if batch:
+        conn.executemany(
+            "INSERT INTO expenses (user_id, description, amount, category, added_at) VALUES (?, ?, ?, ?, ?)", batch
+        )
+    conn.execute("COMMIT")
+    conn.close()
+
+def child_environment(workdir, database_path, page_size):
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": ROOT,
+        "STORAGE_BACKEND": "sqlite",
+        "SQLITE_DATABASE_PATH": database_path,
+        "AUTH_KEY": AUTH_KEY,
+        "OPENAI_API_KEY": "benchmark",
+        "PARSE_CACHE_ENABLED": "False",
+        "METRICS_DIR": os.path.join(workdir, "metrics"),
+        "AGGREGATES_PATH": os.path.join(workdir, "spend_aggregates.sqlite3"),
+        "REPORT_CACHE_PATH": os.path.join(workdir, "report_cache.sqlite3"),
+        "RATE_LIMIT_PATH": os.path.join(workdir, "rate_limits.sqlite3"),
+        "IDEMPOTENCY_PATH": os.path.join(workdir, "idempotency.sqlite3"),
+        "CATEGORY_MODEL_PATH": os.path.join(workdir, "category_model.json"),
+        "LOG_LEVEL": "WARNING"
+    })
+    if page_size:
+        env["EXPORT_PAGE_SIZE"] = str(page_size)
+    return env
+
+def run_export(env, workdir, export_format):
+    output = subprocess.run(
+        [sys.executable, "-c", TRIAL, TELEGRAM_ID, export_format, AUTH_KEY],
+        env=env, cwd=workdir, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the streaming export of a large expense history")
+    parser.add_argument("--rows", type=int, default=1000000, help="Expenses of the exported user")
+    parser.add_argument("--formats", default="csv,ndjson", help="Comma separated formats to export")
+    parser.add_argument("--page-size", type=int, help="EXPORT_PAGE_SIZE of the app (default: its setting)")
+    parser.add_argument("--output", help="Save the results to this JSON file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bot-service-export-")
+    os.makedirs(os.path.join(workdir, "metrics"))
+    database_path = os.path.join(workdir, "bot_service.sqlite3")
+
+    start = time.perf_counter()
+    seed_database(database_path, args.rows)
+    print(f"Seeded {args.rows} expenses in {time.perf_counter() - start:.1f}s")
+
+    env = child_environment(workdir, database_path, args.page_size)
+    exports = {}
+    for export_format in args.formats.split(","):
+        result = run_export(env, workdir, export_format)
+        # The CSV export has a header line
+        result["rows"] = result.pop("lines") - (1 if export_format == "csv" else 0)
+        result["rows_per_second"] = result["rows"] / (result["total_ms"] / 1000)
+        exports[export_format] = result
+
+    results = {
+        "meta": {
+            "commit": git_revision(),
+            "timestamp": datetime.now().isoformat(),
+            "rows": args.rows,
+            "page_size": args.page_size,
+            "python": sys.version.split()[0]
+        },
+        "exports": exports
+    }
+
+    print(f"{'format':<8}{'ttfb ms':>10}{'total s':>10}{'rows/s':>12}{'MiB':>10}{'base RSS':>10}{'peak RSS':>10}")
+    for export_format, result in exports.items():
+        print(
+            f"{export_format:<8}{result['ttfb_ms']:>10.1f}{result['total_ms'] / 1000:>10.1f}"
+            f"{result['rows_per_second']:>12.0f}{result['bytes'] / 1024 / 1024:>10.1f}"
+            f"{result['baseline_rss_bytes'] / 1024 / 1024:>10.1f}{result['peak_rss_bytes'] / 1024 / 1024:>10.1f}"
+        )
+        if result["rows"] != args.rows or result["status"] != 200:
+            print(f"  {export_format}: status {result['status']}, exported {result['rows']} of {args.rows} rows")
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"\nResults saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
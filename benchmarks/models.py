@@ -0,0 +1,165 @@
+"""
+Model microbenchmark: builds expense models from synthetic database rows and measures the
+time and memory of Expense objects against an ExpenseBatch, and of per-object loops against
+the batch columns for totals, category breakdowns and time buckets.
+
+Usage:
+    python -m benchmarks.models --rows 100000 --output models.json
+"""
+import argparse
+import gc
+import json
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from benchmarks.replay import git_revision
+from models.expense import Expense, parse_amount_cents, parse_timestamp
+from models.expense_batch import ExpenseBatch
+from services.expense_parser import EXPENSE_CATEGORIES
+
+BUCKET_SECONDS = 3600
+
+class DictExpense:
+    """
+    Expense with a __dict__ and the amount kept as it came, as the model was before __slots__
+    """
+    def __init__(self, id, user_id, description, amount, category, added_at):
+        self.id = id
+        self.user_id = user_id
+        self.description = description
+        self.amount = amount
+        self.category = category
+        self.added_at = added_at
+
+def dict_expense(row):
+    return DictExpense(
+        row["id"], row["user_id"], row["description"], row["amount"], row["category"],
+        parse_timestamp(row["added_at"])
+    )
+
+def generate_rows(count, seed=1):
+    """
+    Rows as the database returns them: 30 days of expenses of one user, in time order
+    """
+    rng = random.Random(seed)
+    start = datetime.now() - timedelta(days=30)
+    rows = [
+        {
+            "id": index,
+            "user_id": 1,
+            "description": f"Expense {index}",
+            "amount": round(rng.uniform(1, 500), 2),
+            "category": rng.choice(EXPENSE_CATEGORIES),
+            "added_at": (start + timedelta(seconds=rng.uniform(0, 30 * 86400))).isoformat()
+        }
+        for index in range(count)
+    ]
+    rows.sort(key=lambda row: row["added_at"])
+    return rows
+
+def loop_summary(expenses):
+    """
+    Totals with a Python loop over the objects
+    """
+    total = 0
+    categories = {}
+    for expense in expenses:
+        total += expense.amount_cents
+        categories[expense.category] = categories.get(expense.category, 0) + expense.amount_cents
+    return total, categories
+
+def loop_buckets(expenses):
+    """
+    Time buckets with a Python loop over the objects
+    """
+    buckets = {}
+    for expense in expenses:
+        key = (int(expense.added_at.timestamp() // BUCKET_SECONDS), expense.category)
+        total, count = buckets.get(key, (0, 0))
+        buckets[key] = (total + expense.amount_cents, count + 1)
+    return buckets
+
+def measure_time(function, repeat):
+    """
+    Median wall time of function() in milliseconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(timings), 2)
+
+def measure_memory(function):
+    """
+    Memory retained by the result of function(), in bytes
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = function()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return retained
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the expense models and ExpenseBatch")
+    parser.add_argument("--rows", type=int, default=100000, help="Number of expense rows")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each measure (the median is reported)")
+    parser.add_argument("--output", help="Save the results to a JSON file")
+    args = parser.parse_args()
+
+    rows = generate_rows(args.rows)
+    expenses = [Expense.from_dict(row) for row in rows]
+    batch = ExpenseBatch.from_rows(rows)
+
+    # Both ways must agree before their speed means anything
+    total, categories = loop_summary(expenses)
+    summary = batch.summary()
+    assert total == batch.total_cents() == sum(parse_amount_cents(row["amount"]) for row in rows)
+    assert {category: cents / 100 for category, cents in categories.items()} == summary["categories"]
+    assert sum(count for _, count in loop_buckets(expenses).values()) == len(batch)
+    assert len(loop_buckets(expenses)) == len(batch.bucket_totals(BUCKET_SECONDS))
+
+    timings = {
+        "build_dict_objects_ms": measure_time(lambda: [dict_expense(row) for row in rows], args.repeat),
+        "build_objects_ms": measure_time(lambda: [Expense.from_dict(row) for row in rows], args.repeat),
+        "build_batch_ms": measure_time(lambda: ExpenseBatch.from_rows(rows), args.repeat),
+        "summary_loop_ms": measure_time(lambda: loop_summary(expenses), args.repeat),
+        "summary_batch_ms": measure_time(batch.summary, args.repeat),
+        "buckets_loop_ms": measure_time(lambda: loop_buckets(expenses), args.repeat),
+        "buckets_batch_ms": measure_time(lambda: batch.bucket_totals(BUCKET_SECONDS), args.repeat)
+    }
+    memory = {
+        "dict_objects_bytes": measure_memory(lambda: [dict_expense(row) for row in rows]),
+        "objects_bytes": measure_memory(lambda: [Expense.from_dict(row) for row in rows]),
+        "batch_bytes": measure_memory(lambda: ExpenseBatch.from_rows(rows))
+    }
+    results = {
+        "meta": {
+            "commit": git_revision(),
+            "timestamp": datetime.now().isoformat(),
+            "rows": args.rows,
+            "repeat": args.repeat,
+            "python": sys.version.split()[0]
+        },
+        "timings": timings,
+        "memory": memory
+    }
+
+    print(f"{args.rows} rows, median of {args.repeat} runs:")
+    for metric, value in timings.items():
+        print(f"  {metric:<24}{value:>12} ms")
+    for metric, value in memory.items():
+        print(f"  {metric:<24}{value / 1024 / 1024:>12.1f} MiB  ({value / args.rows:.0f} bytes/row)")
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"\nResults saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
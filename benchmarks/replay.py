@@ -0,0 +1,334 @@
+"""
+Replay benchmark: sends a JSONL corpus of messages through the Flask app and reports the
+latency percentiles, the throughput and the number of database and LLM calls per message
+for the help, register, report and expense paths.
+
+OpenAI is replaced by a stub chat model with a configurable latency and Supabase by the
+embedded SQLite backend with an in-memory database, so runs are repeatable and offline.
+Results are saved as JSON so two commits can be compared with --compare.
+
+Usage:
+    python -m benchmarks.replay --corpus benchmarks/corpus.jsonl --output results.json
+    python -m benchmarks.replay --mode http --concurrency 8 --compare results.json
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# Paths reported by the benchmark
+PATHS = ["help", "register", "report", "expense"]
+
+# Metrics shown by --compare, and whether a higher value is better
+COMPARED_METRICS = [
+    ("p50_ms", False), ("p95_ms", False), ("p99_ms", False), ("rps", True),
+    ("db_calls_per_message", False), ("llm_calls_per_message", False)
+]
+
+AUTH_KEY = "benchmark"
+
+def configure_environment(workdir):
+    """
+    Point the app at the in-memory database and throwaway local files.
+    Must run before the app is imported.
+    """
+    os.environ["STORAGE_BACKEND"] = "sqlite"
+    os.environ["SQLITE_DATABASE_PATH"] = ":memory:"
+    os.environ["PARSE_CACHE_ENABLED"] = "False"
+    os.environ["WRITE_BEHIND_ENABLED"] = "False"
+    os.environ["AGGREGATES_PATH"] = os.path.join(workdir, "spend_aggregates.sqlite3")
+    # The replay sends the same users' messages at full speed, the rate limits would reject them
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "False")
+    # The replay measures the pipeline with the optional LLM savings turned on
+    os.environ.setdefault("PREFILTER_MODE", "on")
+    os.environ.setdefault("LLM_FAST_MODEL", "gpt-4o-mini")
+    os.environ.setdefault("IDEMPOTENCY_ENABLED", "True")
+    os.environ["RATE_LIMIT_PATH"] = os.path.join(workdir, "rate_limits.sqlite3")
+    os.environ["IDEMPOTENCY_PATH"] = os.path.join(workdir, "idempotency.sqlite3")
+    os.environ["REPORT_CACHE_PATH"] = os.path.join(workdir, "report_cache.sqlite3")
+    # The category model trained from the replayed expenses is not saved for later runs
+    os.environ["CATEGORY_MODEL_PATH"] = os.path.join(workdir, "category_model.json")
+    os.environ["METRICS_DIR"] = os.path.join(workdir, "metrics")
+    os.environ["AUTH_KEY"] = AUTH_KEY
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+def load_app(llm_latency, db_counter, llm_counter):
+    """
+    Import the Flask app with the counting database client and the stub chat model
+    """
+    import database
+    from benchmarks.stubs import CountingClient, StubChatModel
+    database.set_client(CountingClient(database.get_client(), db_counter))
+
+    from app import app
+    from services.llm_parser import set_llm
+    set_llm(StubChatModel(latency=llm_latency, counter=llm_counter))
+    return app
+
+def load_corpus(path):
+    """
+    Read the corpus: one {"telegram_id", "message"} object per line, with an optional
+    "path" overriding the detected one
+    """
+    from services.message_responses import is_help_command, is_report_command, is_registration_request
+
+    corpus = []
+    with open(path) as corpus_file:
+        for line in corpus_file:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            message = item["message"]
+            if "path" not in item:
+                if is_help_command(message):
+                    item["path"] = "help"
+                elif is_report_command(message):
+                    item["path"] = "report"
+                elif is_registration_request(message):
+                    item["path"] = "register"
+                else:
+                    item["path"] = "expense"
+            corpus.append(item)
+    return corpus
+
+def repeat_telegram_id(telegram_id, repeat):
+    """
+    Give each repetition of the corpus its own users, so registrations happen again
+    """
+    if repeat == 0:
+        return telegram_id
+    if isinstance(telegram_id, int):
+        return telegram_id + repeat * 10 ** 9
+    return f"{telegram_id}-{repeat}"
+
+class TestClientSender:
+    """
+    Sends requests through the Flask test client (no network, one client per thread)
+    """
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def send(self, payload):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.post("/api/process-message", json=payload, headers={"Authorization": AUTH_KEY})
+        return response.status_code
+
+    def close(self):
+        pass
+
+class HTTPSender:
+    """
+    Sends requests over real HTTP to the app served by a threaded werkzeug server
+    """
+    def __init__(self, app):
+        import requests
+        from werkzeug.serving import make_server
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        self.server = make_server("127.0.0.1", 0, app, threaded=True)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/api/process-message"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self._requests = requests
+        self._local = threading.local()
+
+    def send(self, payload):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+        response = session.post(self.url, json=payload, headers={"Authorization": AUTH_KEY})
+        return response.status_code
+
+    def close(self):
+        self.server.shutdown()
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarize(samples, duration=None):
+    """
+    Summarize (latency, status, db_calls, llm_calls) samples. Call counts are None
+    when they couldn't be attributed to single messages.
+    """
+    latencies = sorted(sample[0] * 1000 for sample in samples)
+    summary = {
+        "requests": len(samples),
+        "errors": sum(1 for sample in samples if sample[1] >= 500),
+        "mean_ms": round(sum(latencies) / len(latencies), 3) if latencies else None,
+        "p50_ms": round(percentile(latencies, 0.50), 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95), 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99), 3) if latencies else None
+    }
+    if duration is not None:
+        summary["duration_s"] = round(duration, 3)
+        summary["rps"] = round(len(samples) / duration, 1) if duration else None
+    for index, name in ((2, "db_calls_per_message"), (3, "llm_calls_per_message")):
+        counts = [sample[index] for sample in samples]
+        summary[name] = round(sum(counts) / len(counts), 3) if counts and None not in counts else None
+    return summary
+
+def replay(sender, corpus, repeat, concurrency, db_counter, llm_counter):
+    """
+    Send the corpus `repeat` times and collect one sample per message.
+    Per-message call counts are only exact when messages are sent one at a time.
+    """
+    def send(item, repeat_index):
+        payload = {
+            "telegram_id": repeat_telegram_id(item["telegram_id"], repeat_index),
+            "message": item["message"]
+        }
+        db_before, llm_before = db_counter.count, llm_counter.count
+        start = time.perf_counter()
+        status = sender.send(payload)
+        latency = time.perf_counter() - start
+        if concurrency > 1:
+            return item["path"], (latency, status, None, None)
+        return item["path"], (latency, status, db_counter.count - db_before, llm_counter.count - llm_before)
+
+    jobs = [(item, repeat_index) for repeat_index in range(repeat) for item in corpus]
+    db_counter.reset()
+    llm_counter.reset()
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        # Each user's messages are sent in order by one worker, so registrations come first
+        conversations = {}
+        for item, repeat_index in jobs:
+            conversations.setdefault((str(item["telegram_id"]), repeat_index), []).append((item, repeat_index))
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            replayed = pool.map(lambda conversation: [send(*job) for job in conversation], conversations.values())
+            results = [result for conversation in replayed for result in conversation]
+    else:
+        results = [send(*job) for job in jobs]
+    duration = time.perf_counter() - start
+
+    overall = summarize([sample for _, sample in results], duration)
+    overall["db_calls_per_message"] = round(db_counter.count / len(jobs), 3) if jobs else None
+    overall["llm_calls_per_message"] = round(llm_counter.count / len(jobs), 3) if jobs else None
+
+    paths = {}
+    for path in PATHS + sorted({path for path, _ in results} - set(PATHS)):
+        samples = [sample for sample_path, sample in results if sample_path == path]
+        if samples:
+            paths[path] = summarize(samples)
+    return overall, paths
+
+def git_revision():
+    """
+    Get the commit being benchmarked ("-dirty" when there are local changes)
+    """
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except Exception:
+        return None
+
+def compare(previous, current):
+    """
+    Print the change of each metric between two result files
+    """
+    print(f"\nComparison with {previous['meta'].get('commit')} ({previous['meta'].get('timestamp')})")
+    for setting in ("corpus", "mode", "llm_latency", "concurrency"):
+        if previous["meta"].get(setting) != current["meta"][setting]:
+            print(f"  Warning: {setting} differs ({previous['meta'].get(setting)} vs {current['meta'][setting]})")
+    sections = [("overall", previous.get("overall", {}), current["overall"])]
+    sections += [(path, previous.get("paths", {}).get(path, {}), current["paths"][path]) for path in current["paths"]]
+    for name, before, after in sections:
+        print(f"  {name}")
+        for metric, higher_is_better in COMPARED_METRICS:
+            old, new = before.get(metric), after.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old * 100 if old else 0.0
+            worse = change < 0 if higher_is_better else change > 0
+            flag = " (regression)" if worse and abs(change) >= 10 else ""
+            print(f"    {metric:<24}{old:>12}{new:>12}{change:>+10.1f}%{flag}")
+
+def print_report(results):
+    meta = results["meta"]
+    print(f"\nReplayed {meta['messages']} messages x {meta['repeat']} ({meta['mode']} mode, "
+          f"concurrency {meta['concurrency']}, LLM latency {meta['llm_latency'] * 1000:.0f} ms)")
+    print(f"{'path':<10}{'requests':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rps':>10}{'db/msg':>8}{'llm/msg':>8}")
+    rows = [("overall", results["overall"])] + list(results["paths"].items())
+    for name, row in rows:
+        db_calls = "-" if row["db_calls_per_message"] is None else row["db_calls_per_message"]
+        llm_calls = "-" if row["llm_calls_per_message"] is None else row["llm_calls_per_message"]
+        print(f"{name:<10}{row['requests']:>10}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}"
+              f"{row.get('rps', '-'):>10}{db_calls:>8}{llm_calls:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a message corpus through the Flask app")
+    parser.add_argument("--corpus", default=os.path.join(os.path.dirname(__file__), "corpus.jsonl"),
+                        help="JSONL file of {telegram_id, message} objects")
+    parser.add_argument("--mode", choices=["client", "http"], default="client",
+                        help="Flask test client, or real HTTP against a local server")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds the stub LLM takes to answer")
+    parser.add_argument("--concurrency", type=int, default=1, help="Messages sent concurrently")
+    parser.add_argument("--repeat", type=int, default=3, help="Times the corpus is replayed")
+    parser.add_argument("--output", help="Save the results to this JSON file")
+    parser.add_argument("--compare", help="Results JSON of a previous run to compare against")
+    parser.add_argument("--verbose", action="store_true", help="Show the app's own output")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bot-service-bench-")
+    configure_environment(workdir)
+
+    app_output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    with app_output:
+        from benchmarks.stubs import CallCounter
+        db_counter, llm_counter = CallCounter(), CallCounter()
+        corpus = load_corpus(args.corpus)
+        app = load_app(args.llm_latency, db_counter, llm_counter)
+        sender = HTTPSender(app) if args.mode == "http" else TestClientSender(app)
+        try:
+            overall, paths = replay(sender, corpus, args.repeat, args.concurrency, db_counter, llm_counter)
+        finally:
+            sender.close()
+
+    results = {
+        "meta": {
+            "commit": git_revision(),
+            "timestamp": datetime.now().isoformat(),
+            "corpus": os.path.basename(args.corpus),
+            "messages": len(corpus),
+            "mode": args.mode,
+            "llm_latency": args.llm_latency,
+            "concurrency": args.concurrency,
+            "repeat": args.repeat,
+            "python": sys.version.split()[0]
+        },
+        "overall": overall,
+        "paths": paths
+    }
+
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"\nResults saved to {args.output}")
+    if args.compare:
+        with open(args.compare) as previous_file:
+            compare(json.load(previous_file), results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Startup benchmark: measures how long a fresh worker takes to import the app and answer its
+first requests, and which modules cost the most to import. Each trial runs in a new Python
+process so nothing is cached between trials.
+
+Usage:
+    python -m benchmarks.startup --output startup.json
+    python -m benchmarks.startup --compare startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from benchmarks.replay import git_revision
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child process, prints one JSON object with the timings in milliseconds
+TRIAL = """
+import json, sys, time
+timings = {}
+start = time.perf_counter()
+from app import app
+timings["import_app_ms"] = (time.perf_counter() - start) * 1000
+
+client = app.test_client()
+headers = {"Authorization": "benchmark"}
+
+start = time.perf_counter()
+client.get("/api/health", headers=headers)
+timings["first_health_ms"] = (time.perf_counter() - start) * 1000
+
+start = time.perf_counter()
+client.post("/api/process-message", json={"telegram_id": 1, "message": "/help"}, headers=headers)
+timings["first_help_ms"] = (time.perf_counter() - start) * 1000
+timings["langchain_loaded_after_help"] = "langchain_core" in sys.modules
+
+start = time.perf_counter()
+from services.llm_parser import import_langchain
+import_langchain()
+timings["load_langchain_ms"] = (time.perf_counter() - start) * 1000
+
+print(json.dumps(timings))
+"""
+
+TIMING_METRICS = ["import_app_ms", "first_health_ms", "first_help_ms", "load_langchain_ms"]
+
+def child_environment(workdir):
+    """
+    Environment of the measured process: no credentials are needed to start
+    """
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": ROOT,
+        "AUTH_KEY": "benchmark",
+        "METRICS_DIR": os.path.join(workdir, "metrics"),
+        "PARSE_CACHE_PATH": os.path.join(workdir, "parse_cache.sqlite3"),
+        "AGGREGATES_PATH": os.path.join(workdir, "spend_aggregates.sqlite3"),
+        "LOG_LEVEL": "WARNING"
+    })
+    return env
+
+def run_trial(env, workdir):
+    output = subprocess.run(
+        [sys.executable, "-c", TRIAL], env=env, cwd=workdir, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def import_costs(env, workdir, top):
+    """
+    Get the modules with the highest cumulative import time when importing the app
+    """
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"], env=env,
+        cwd=workdir, capture_output=True, text=True, check=True
+    ).stderr
+    costs = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line.split("|")
+        if cumulative.strip().isdigit():
+            costs.append((module.strip(), int(cumulative) / 1000))
+    # Top-level packages only, nested modules are included in their parent's time
+    packages = {}
+    for module, cost in costs:
+        package = module.split(".")[0]
+        packages[package] = max(packages.get(package, 0), cost)
+    return [
+        {"module": module, "cumulative_ms": round(cost, 1)}
+        for module, cost in sorted(packages.items(), key=lambda item: -item[1])[:top]
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure worker startup and import cost")
+    parser.add_argument("--trials", type=int, default=5, help="Fresh processes measured")
+    parser.add_argument("--top", type=int, default=15, help="Most expensive imports listed")
+    parser.add_argument("--output", help="Save the results to this JSON file")
+    parser.add_argument("--compare", help="Results JSON of a previous run to compare against")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bot-service-startup-")
+    os.makedirs(os.path.join(workdir, "metrics"))
+    env = child_environment(workdir)
+
+    trials = [run_trial(env, workdir) for _ in range(args.trials)]
+    timings = {
+        metric: round(statistics.median(trial[metric] for trial in trials), 1)
+        for metric in TIMING_METRICS
+    }
+    results = {
+        "meta": {
+            "commit": git_revision(),
+            "timestamp": datetime.now().isoformat(),
+            "trials": args.trials,
+            "python": sys.version.split()[0]
+        },
+        "timings": timings,
+        "langchain_loaded_after_help": any(trial["langchain_loaded_after_help"] for trial in trials),
+        "imports": import_costs(env, workdir, args.top)
+    }
+
+    print(f"Median of {args.trials} fresh processes:")
+    for metric, value in timings.items():
+        print(f"  {metric:<22}{value:>10} ms")
+    print(f"  Langchain loaded after /help: {results['langchain_loaded_after_help']}")
+    print("Most expensive imports of `import app`:")
+    for entry in results["imports"]:
+        print(f"  {entry['module']:<30}{entry['cumulative_ms']:>10} ms")
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"\nResults saved to {args.output}")
+    if args.compare:
+        with open(args.compare) as previous_file:
+            previous = json.load(previous_file)
+        print(f"\nComparison with {previous['meta'].get('commit')} ({previous['meta'].get('timestamp')})")
+        for metric, value in timings.items():
+            old = previous["timings"].get(metric)
+            if old:
+                print(f"  {metric:<22}{old:>10}{value:>10}{(value - old) / old * 100:>+10.1f}%")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Stand-ins for the external services used by the replay benchmark: a chat model with a
+configurable latency instead of OpenAI, and a call-counting wrapper around the database
+client (the embedded SQLite backend with an in-memory database instead of Supabase).
+"""
+import asyncio
+import json
+import re
+import threading
+import time
+from typing import Any
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from services.expense_parser import infer_category
+
+AMOUNT_PATTERN = re.compile(r"(\d+(?:[.,]\d+)?)")
+
+class CallCounter:
+    """
+    Thread-safe counter of calls to an external service
+    """
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def increment(self):
+        with self._lock:
+            self.count += 1
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+
+def stub_response(prompt):
+    """
+    Build the JSON answer of the stub model: the message is an expense if it contains a number
+    """
+    message = prompt.rsplit("Message:", 1)[-1].strip().strip('"')
+    match = AMOUNT_PATTERN.search(message)
+    if not match:
+        return json.dumps({"is_expense": False, "confidence": 0.9})
+    description = AMOUNT_PATTERN.sub("", message).strip(" $-:") or "Unknown expense"
+    return json.dumps({
+        "is_expense": True,
+        "description": description,
+        "amount": float(match.group(1).replace(",", ".")),
+        "category": infer_category(description) or "Other",
+        "confidence": 0.9
+    })
+
+class StubChatModel(BaseChatModel):
+    """
+    Chat model that answers after a fixed latency without calling any API.
+    Plugged into the expense chain with services.llm_parser.set_llm.
+    """
+    latency: float = 0.0
+    counter: Any = None
+
+    @property
+    def _llm_type(self):
+        return "stub"
+
+    def _result(self, messages):
+        if self.counter:
+            self.counter.increment()
+        content = stub_response(messages[-1].content)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        return self._result(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self._result(messages)
+
+class CountingClient:
+    """
+    Wrapper around a database client counting the queries it executes
+    """
+    def __init__(self, client, counter):
+        self.client = client
+        self.counter = counter
+
+    def table(self, table_name):
+        return CountingQuery(self.client.table(table_name), self.counter)
+
+    def rpc(self, function_name, params=None):
+        return CountingQuery(self.client.rpc(function_name, params), self.counter)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+class CountingQuery:
+    """
+    Wrapper around a query builder (or a database function call) counting its execute() calls
+    """
+    def __init__(self, query, counter):
+        self.query = query
+        self.counter = counter
+
+    def execute(self, *args, **kwargs):
+        self.counter.increment()
+        return self.query.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.query, name)
+        if not callable(attribute):
+            return attribute
+
+        def build(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            # Keep wrapping the builder returned by select/eq/order/...
+            return CountingQuery(result, self.counter) if hasattr(result, "execute") else result
+        return build
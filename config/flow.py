@@ -0,0 +1,138 @@
+"""
+Flows: the logic of an operation (what to read, what to store, what to answer) written once,
+for both the WSGI and the ASGI app.
+
+A flow is a generator that yields the I/O it needs, `result = yield io("query", build)`, and
+gets back its result, or its exception raised where it yielded. run() performs the I/O with
+blocking calls for the Flask app, and run_async() awaits it for the Quart app. Flows call
+other flows with `yield from`, so only the I/O operations registered here exist twice.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class IO:
+    """
+    An I/O operation requested by a flow: its name and arguments
+    """
+    __slots__ = ("name", "args", "kwargs")
+
+    def __init__(self, name, args, kwargs):
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+
+def io(name, *args, **kwargs):
+    """
+    Request an I/O operation from a flow
+    """
+    return IO(name, args, kwargs)
+
+# Blocking and async implementations of the I/O operations, by name
+_blocking = {}
+_awaitable = {}
+
+def register(name, blocking, awaitable):
+    """
+    Register an I/O operation: `blocking` is a function and `awaitable` a function that
+    returns an awaitable, both called with the arguments of the operation
+    """
+    _blocking[name] = blocking
+    _awaitable[name] = awaitable
+
+def run(flow):
+    """
+    Run a flow with blocking I/O, returns what the flow returns
+    """
+    result, error = None, None
+    while True:
+        try:
+            request = flow.throw(error) if error is not None else flow.send(result)
+        except StopIteration as stop:
+            return stop.value
+        result, error = None, None
+        try:
+            result = _blocking[request.name](*request.args, **request.kwargs)
+        except BaseException as e:
+            # The flow can handle it (and its finally blocks run) before it propagates
+            error = e
+
+async def run_async(flow):
+    """
+    Run a flow with async I/O, returns what the flow returns
+    """
+    result, error = None, None
+    while True:
+        try:
+            request = flow.throw(error) if error is not None else flow.send(result)
+        except StopIteration as stop:
+            return stop.value
+        result, error = None, None
+        try:
+            result = await _awaitable[request.name](*request.args, **request.kwargs)
+        except BaseException as e:
+            error = e
+
+def local(function, *args):
+    """
+    Call a function that uses local files (the SQLite stores): directly in the WSGI app,
+    from a worker thread in the ASGI app so it doesn't block the event loop
+    """
+    return io("local", function, *args)
+
+def sleep(seconds):
+    """
+    Wait without blocking the event loop of the ASGI app
+    """
+    return io("sleep", seconds)
+
+def gather(flows, limit):
+    """
+    Run flows concurrently, at most `limit` at a time: on a thread pool in the WSGI app,
+    as tasks in the ASGI app. Returns their results in order.
+    """
+    return io("gather", list(flows), limit)
+
+def pages(next_page):
+    """
+    Iterate over the pages of a cursor pagination with blocking I/O. next_page(cursor) is a
+    flow that returns (items, next_cursor), next_cursor being None on the last page.
+    """
+    cursor = None
+    while True:
+        items, cursor = run(next_page(cursor))
+        if items:
+            yield items
+        if cursor is None:
+            return
+
+async def pages_async(next_page):
+    """
+    Async version of pages
+    """
+    cursor = None
+    while True:
+        items, cursor = await run_async(next_page(cursor))
+        if items:
+            yield items
+        if cursor is None:
+            return
+
+def _gather(flows, limit):
+    if not flows:
+        return []
+    with ThreadPoolExecutor(max_workers=min(limit, len(flows))) as pool:
+        return list(pool.map(run, flows))
+
+async def _gather_async(flows, limit):
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run_limited(flow):
+        async with semaphore:
+            return await run_async(flow)
+
+    return await asyncio.gather(*(run_limited(flow) for flow in flows))
+
+register("local", lambda function, *args: function(*args), asyncio.to_thread)
+register("sleep", time.sleep, asyncio.sleep)
+register("gather", _gather, _gather_async)
@@ -0,0 +1,41 @@
+import os
+import threading
+
+class LazySingleton:
+    """
+    Value created by `factory` on first use, once per process.
+
+    Creation is thread-safe, and a process forked after the value was created (a gunicorn
+    worker with preload_app) creates its own instead of sharing the parent's connections.
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self._value = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Get the value, creating it if needed
+        """
+        if self._pid == os.getpid():
+            return self._value
+        with self._lock:
+            if self._pid != os.getpid():
+                self._value = self.factory()
+                self._pid = os.getpid()
+        return self._value
+
+    def set(self, value):
+        """
+        Replace the value for this process (e.g. with a stub in benchmarks)
+        """
+        with self._lock:
+            self._value = value
+            self._pid = os.getpid()
+
+    def is_created(self):
+        """
+        Check if the value was created in this process
+        """
+        return self._pid == os.getpid()
@@ -0,0 +1,167 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from config.settings import LOG_LEVEL, LOG_QUEUE_SIZE, LOG_DEBUG_SAMPLE_RATE
+
+# Parent of all the loggers of the service
+ROOT_LOGGER = "bot"
+
+# Context of the request being processed (request id, stage timings and fields)
+_request_context = contextvars.ContextVar("request_context", default=None)
+
+_setup_lock = threading.Lock()
+_configured = False
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON line, with its structured fields
+    """
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            entry["request_id"] = request_id
+        for name, value in (getattr(record, "fields", None) or {}).items():
+            entry.setdefault(name, value)
+        return json.dumps(entry, default=str)
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """
+    Handler that puts records on a bounded queue written to stdout by a background thread,
+    so logging never blocks a request on I/O. Records are dropped when the queue is full.
+
+    The writer thread is started lazily in each process, so it also runs in forked gunicorn workers.
+    """
+    def __init__(self, queue_size, stream=None):
+        super().__init__(queue.Queue(queue_size))
+        self.queue_size = queue_size
+        self.stream_handler = logging.StreamHandler(stream or sys.stdout)
+        self.stream_handler.setFormatter(JSONFormatter())
+        self.dropped = 0
+        self._listener = None
+        self._listener_pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._listener_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._listener_pid == os.getpid():
+                return
+            if self._listener_pid is not None:
+                # Forked: records queued by the parent belong to the parent
+                self.queue = queue.Queue(self.queue_size)
+            self._listener = logging.handlers.QueueListener(self.queue, self.stream_handler)
+            self._listener.start()
+            self._listener_pid = os.getpid()
+            atexit.register(self._listener.stop)
+
+    def prepare(self, record):
+        # Attach the request id here, the writer thread doesn't see the request context
+        context = _request_context.get()
+        if context:
+            record.request_id = context["request_id"]
+        return super().prepare(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def emit(self, record):
+        self._ensure_listener()
+        super().emit(record)
+
+def setup_logging():
+    """
+    Configure the service loggers once
+    """
+    global _configured
+    if _configured:
+        return
+    with _setup_lock:
+        if _configured:
+            return
+        logger = logging.getLogger(ROOT_LOGGER)
+        logger.setLevel(LOG_LEVEL)
+        logger.addHandler(BackgroundQueueHandler(LOG_QUEUE_SIZE))
+        logger.propagate = False
+        _configured = True
+
+def get_logger(name):
+    """
+    Get the logger of a module, e.g. get_logger(__name__)
+    """
+    setup_logging()
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+def log_fields(**fields):
+    """
+    Structured fields of a log record: logger.info("...", extra=log_fields(user=...))
+    """
+    return {"fields": fields}
+
+def debug_sample(logger, log_message, **fields):
+    """
+    Log a verbose debug dump (full message texts, raw LLM responses) for a sample of
+    the calls only, LOG_DEBUG_SAMPLE_RATE of them
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    if LOG_DEBUG_SAMPLE_RATE < 1 and random.random() >= LOG_DEBUG_SAMPLE_RATE:
+        return
+    logger.debug(log_message, extra=log_fields(**fields))
+
+def record_stage(stage, seconds):
+    """
+    Add the duration of a stage to the log line of the current request
+    """
+    context = _request_context.get()
+    if context is None:
+        return
+    stages = context["stages"]
+    stages[stage] = round(stages.get(stage, 0) + seconds * 1000, 3)
+
+def count_request_path(path, count=1):
+    """
+    Count messages of a path (help, report, expense...) in the log line of the current request
+    """
+    context = _request_context.get()
+    if context is None:
+        return
+    paths = context.setdefault("paths", {})
+    paths[path] = paths.get(path, 0) + count
+
+@contextmanager
+def request_log(route, request_id=None):
+    """
+    Collect the stage timings and fields of a request and log them as one JSON line
+    when it ends. Yields a dictionary where the route can add fields (status, path...).
+    """
+    context = {"request_id": request_id or uuid.uuid4().hex[:16], "route": route, "stages": {}}
+    token = _request_context.set(context)
+    start = time.perf_counter()
+    try:
+        yield context
+    finally:
+        context["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        fields = {name: value for name, value in context.items() if name != "request_id"}
+        get_logger("request").info("request", extra=log_fields(**fields))
+        _request_context.reset(token)
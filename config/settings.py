@@ -15,4 +15,138 @@ SUPABASE_KEY = os.getenv('SUPABASE_KEY')
 
 # OpenAI settings
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4') 
\ No newline at end of file
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4')
+# Model cascade: messages are parsed by the fast model first and escalated to OPENAI_MODEL
+# when its answer is invalid, has an unknown category or a low confidence. Off (empty) by default,
+# set it (e.g. gpt-4o-mini) to turn the cascade on.
+LLM_FAST_MODEL = os.getenv('LLM_FAST_MODEL', '')
+LLM_CONFIDENCE_THRESHOLD = float(os.getenv('LLM_CONFIDENCE_THRESHOLD', 0.7))
+# Most expenses saved from one message ("coffee 5, taxi 20, lunch 12"), the rest are left out.
+# It bounds the answer the LLM writes for a message, and so its latency.
+EXPENSE_MAX_ITEMS = int(os.getenv('EXPENSE_MAX_ITEMS', 10))
+
+# HTTP connection pool settings, each external dependency (Supabase, OpenAI) has its own pool per worker
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 20))
+HTTP_KEEPALIVE_CONNECTIONS = int(os.getenv('HTTP_KEEPALIVE_CONNECTIONS', 10))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', 30))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 3))
+# Timeouts of the requests to each dependency, in seconds
+DATABASE_TIMEOUT = float(os.getenv('DATABASE_TIMEOUT', 10))
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', 20))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 1))
+
+# Circuit breaker settings: after CIRCUIT_BREAKER_FAILURE_THRESHOLD consecutive failures of a dependency,
+# its calls fail fast for CIRCUIT_BREAKER_RESET_TIMEOUT seconds (messages are parsed locally meanwhile)
+CIRCUIT_BREAKER_ENABLED = os.getenv('CIRCUIT_BREAKER_ENABLED', 'True').lower() == 'true'
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_BREAKER_FAILURE_THRESHOLD', 5))
+CIRCUIT_BREAKER_RESET_TIMEOUT = float(os.getenv('CIRCUIT_BREAKER_RESET_TIMEOUT', 30))
+
+# User cache settings
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 300))
+# Lookups of unregistered users are cached for a shorter time, so a registration
+# handled by another worker is picked up quickly
+USER_CACHE_NEGATIVE_TTL = int(os.getenv('USER_CACHE_NEGATIVE_TTL', 30))
+
+# LLM parse result cache settings
+PARSE_CACHE_ENABLED = os.getenv('PARSE_CACHE_ENABLED', 'True').lower() == 'true'
+PARSE_CACHE_PATH = os.getenv('PARSE_CACHE_PATH', 'parse_cache.sqlite3')
+PARSE_CACHE_MAX_ENTRIES = int(os.getenv('PARSE_CACHE_MAX_ENTRIES', 50000))
+
+# Pre-filter of obvious non-expenses ("thanks!", stickers...) before the LLM: "on", "off", or
+# "shadow" (the LLM is still called, only the pre-filter's false negatives are measured). Shadow by
+# default, so no message is skipped until the measured false negatives allow "on".
+PREFILTER_MODE = os.getenv('PREFILTER_MODE', 'shadow').lower()
+# Share of the filtered messages still sent to the LLM in "on" mode, to keep measuring false negatives
+PREFILTER_SHADOW_SAMPLE_RATE = float(os.getenv('PREFILTER_SHADOW_SAMPLE_RATE', 0.01))
+
+# Single-flight settings: identical messages parsed at the same time share one LLM call
+SINGLE_FLIGHT_ENABLED = os.getenv('SINGLE_FLIGHT_ENABLED', 'True').lower() == 'true'
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv('SINGLE_FLIGHT_TIMEOUT', 30))
+SINGLE_FLIGHT_STATS_KEYS = int(os.getenv('SINGLE_FLIGHT_STATS_KEYS', 1000))
+
+# Local category classifier trained from the stored expenses (naive Bayes over description words)
+CATEGORY_MODEL_ENABLED = os.getenv('CATEGORY_MODEL_ENABLED', 'True').lower() == 'true'
+CATEGORY_MODEL_PATH = os.getenv('CATEGORY_MODEL_PATH', 'category_model.json')
+# Minimum probability of the predicted category, below it the message goes to the LLM
+CATEGORY_MODEL_MIN_CONFIDENCE = float(os.getenv('CATEGORY_MODEL_MIN_CONFIDENCE', 0.9))
+CATEGORY_MODEL_MIN_EXAMPLES = int(os.getenv('CATEGORY_MODEL_MIN_EXAMPLES', 50))
+CATEGORY_MODEL_REFRESH_INTERVAL = int(os.getenv('CATEGORY_MODEL_REFRESH_INTERVAL', 300))
+CATEGORY_MODEL_MAX_OVERRIDES = int(os.getenv('CATEGORY_MODEL_MAX_OVERRIDES', 100000))
+
+# Admission control of the messages sent to the LLM, shared by the workers on the host through
+# a SQLite file: token buckets per user and for the whole service (0 disables a bucket), and a
+# limit on the LLM calls in flight (0 disables it). Rejected messages get a 429 response. Off by default.
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'False').lower() == 'true'
+RATE_LIMIT_PATH = os.getenv('RATE_LIMIT_PATH', 'rate_limits.sqlite3')
+RATE_LIMIT_USER_PER_MINUTE = float(os.getenv('RATE_LIMIT_USER_PER_MINUTE', 10))
+RATE_LIMIT_USER_BURST = int(os.getenv('RATE_LIMIT_USER_BURST', 20))
+RATE_LIMIT_GLOBAL_PER_MINUTE = float(os.getenv('RATE_LIMIT_GLOBAL_PER_MINUTE', 600))
+RATE_LIMIT_GLOBAL_BURST = int(os.getenv('RATE_LIMIT_GLOBAL_BURST', 100))
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 32))
+# Seconds after which the slot of an LLM call that never ended (killed worker) is freed
+LLM_SLOT_TIMEOUT = float(os.getenv('LLM_SLOT_TIMEOUT', 120))
+
+# Idempotent /process-message: the responses of requests with an idempotency key (Idempotency-Key
+# header, Telegram message_id, or sender, text and date) are kept for IDEMPOTENCY_TTL seconds and
+# replayed to retries, in a SQLite file shared by the workers on the host. Off by default.
+IDEMPOTENCY_ENABLED = os.getenv('IDEMPOTENCY_ENABLED', 'False').lower() == 'true'
+IDEMPOTENCY_PATH = os.getenv('IDEMPOTENCY_PATH', 'idempotency.sqlite3')
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 600))
+# Seconds a retry waits for the first request still running before getting a 409
+IDEMPOTENCY_WAIT_TIMEOUT = float(os.getenv('IDEMPOTENCY_WAIT_TIMEOUT', 60))
+# Same for the WSGI app, kept short: a waiting retry holds a sync worker that could serve other requests
+IDEMPOTENCY_SYNC_WAIT_TIMEOUT = float(os.getenv('IDEMPOTENCY_SYNC_WAIT_TIMEOUT', 1))
+# Seconds after which the claim of a request that never finished (killed worker) can be taken over
+IDEMPOTENCY_PENDING_TIMEOUT = float(os.getenv('IDEMPOTENCY_PENDING_TIMEOUT', 120))
+
+# Batch processing settings
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 500))
+BATCH_PARSE_WORKERS = int(os.getenv('BATCH_PARSE_WORKERS', 8))
+
+# Write-behind settings: expenses are queued locally and written in the background
+WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', 'False').lower() == 'true'
+WRITE_BEHIND_QUEUE_PATH = os.getenv('WRITE_BEHIND_QUEUE_PATH', 'expense_queue.sqlite3')
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', 100))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', 1.0))
+WRITE_BEHIND_MAX_BACKOFF = int(os.getenv('WRITE_BEHIND_MAX_BACKOFF', 60))
+
+# Expense history and report settings
+HISTORY_DEFAULT_LIMIT = int(os.getenv('HISTORY_DEFAULT_LIMIT', 50))
+HISTORY_MAX_LIMIT = int(os.getenv('HISTORY_MAX_LIMIT', 200))
+# Expenses read per query by /api/expenses/export. Keep it below the max rows of the
+# Supabase API (1000 by default), which would cut the pages short and end the export early
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', 500))
+# Expenses listed in the daily report, the rest only count in its summary
+REPORT_MAX_ROWS = int(os.getenv('REPORT_MAX_ROWS', 10))
+# Fetch the daily report with the get_expense_report database function (storage/supabase_functions.sql):
+# the user and their expenses in one round trip. Falls back to separate queries if the function is missing.
+REPORT_RPC_ENABLED = os.getenv('REPORT_RPC_ENABLED', 'True').lower() == 'true'
+# After this many consecutive errors of the function that are not outages (it doesn't match the
+# schema), reports use the separate queries for REPORT_RPC_BACKOFF seconds before trying it again
+REPORT_RPC_MAX_ERRORS = int(os.getenv('REPORT_RPC_MAX_ERRORS', 3))
+REPORT_RPC_BACKOFF = int(os.getenv('REPORT_RPC_BACKOFF', 600))
+# Cache of the rendered daily reports, shared by the workers on the host: dropped when the user
+# adds an expense and when an expense leaves the 24 hour window, kept REPORT_CACHE_TTL seconds at most
+REPORT_CACHE_ENABLED = os.getenv('REPORT_CACHE_ENABLED', 'True').lower() == 'true'
+REPORT_CACHE_PATH = os.getenv('REPORT_CACHE_PATH', 'report_cache.sqlite3')
+REPORT_CACHE_TTL = int(os.getenv('REPORT_CACHE_TTL', 300))
+
+# Rolling spend aggregates used by /report week and /report month
+AGGREGATES_ENABLED = os.getenv('AGGREGATES_ENABLED', 'True').lower() == 'true'
+AGGREGATES_PATH = os.getenv('AGGREGATES_PATH', 'spend_aggregates.sqlite3')
+AGGREGATES_BUCKET_SECONDS = int(os.getenv('AGGREGATES_BUCKET_SECONDS', 3600))
+AGGREGATES_RETENTION_DAYS = int(os.getenv('AGGREGATES_RETENTION_DAYS', 31))
+AGGREGATES_RESEED_INTERVAL = int(os.getenv('AGGREGATES_RESEED_INTERVAL', 86400))
+
+# Metrics settings: each worker writes a snapshot of its metrics to METRICS_DIR,
+# and /api/metrics merges the snapshots of all the workers
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True').lower() == 'true'
+METRICS_DIR = os.getenv('METRICS_DIR', 'metrics')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+
+# Logging settings: one JSON line per log record, written to stdout by a background thread
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# Share of the verbose debug dumps (message texts, raw LLM responses) that are logged
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', 0.1))
@@ -0,0 +1,121 @@
+import asyncio
+from datetime import datetime
+from quart import Blueprint, request, jsonify, Response
+from services.llm_parser import get_single_flight_stats, get_rate_limit_stats
+from services.message_handler import handle_history, prepare_export, handle_process_message, handle_process_messages
+from middleware.auth_middleware import async_auth_middleware
+from services.metrics import metrics
+from services.expense_export import EXPORT_FORMATS, export_stream_async
+from services.circuit_breaker import get_circuit_breaker_states
+from config.flow import run_async, pages_async
+
+# Async versions of the message routes, served by asgi.py with the same URLs and responses
+message_bp = Blueprint('message', __name__, url_prefix='/api')
+root_message_bp = Blueprint('root_message', __name__)
+
+@message_bp.route('/', methods=['GET'])
+@async_auth_middleware
+async def api_home():
+    """
+    Home endpoint
+    """
+    return jsonify({"status": "ok", "message": "Bot Service running correctly"})
+
+@message_bp.route('/health', methods=['GET'])
+@async_auth_middleware
+async def api_health():
+    """
+    Health check endpoint
+    """
+    return jsonify({"status": "ok", "timestamp": datetime.now().isoformat()})
+
+@message_bp.route('/metrics', methods=['GET'])
+@async_auth_middleware
+async def api_metrics():
+    """
+    Metrics of all the workers in the Prometheus text format
+    """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@message_bp.route('/single-flight', methods=['GET'])
+@async_auth_middleware
+async def api_single_flight():
+    """
+    Wait statistics of the identical LLM parses coalesced by this worker
+    """
+    limit = request.args.get("limit", 20, type=int)
+    return jsonify(get_single_flight_stats(limit))
+
+@message_bp.route('/circuit-breakers', methods=['GET'])
+@async_auth_middleware
+async def api_circuit_breakers():
+    """
+    State of the circuit breakers of this worker (closed, open or half_open)
+    """
+    return jsonify(get_circuit_breaker_states())
+
+@message_bp.route('/rate-limits', methods=['GET'])
+@async_auth_middleware
+async def api_rate_limits():
+    """
+    Settings and shared state of the rate limits and of the LLM concurrency limit
+    """
+    return jsonify(await asyncio.to_thread(get_rate_limit_stats))
+
+@message_bp.route('/expenses', methods=['GET'])
+@async_auth_middleware
+async def api_expenses():
+    """
+    Expense history of a user, newest first, one page at a time
+    """
+    response, status = await run_async(handle_history(request.args))
+    return jsonify(response), status
+
+@message_bp.route('/expenses/export', methods=['GET'])
+@async_auth_middleware
+async def api_export_expenses():
+    """
+    Full expense history of a user, newest first, streamed as CSV or NDJSON
+    """
+    response, status, export = await run_async(prepare_export(request.args))
+    if export is None:
+        return jsonify(response), status
+
+    next_page, columns, export_format = export
+    response = Response(
+        export_stream_async(pages_async(next_page), columns, export_format),
+        content_type=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="expenses.{export_format}"'}
+    )
+    # Large exports take longer than the response timeout of the app
+    response.timeout = None
+    return response
+
+@message_bp.route('/process-message', methods=['POST'])
+@async_auth_middleware
+async def api_process_message():
+    """
+    Receives messages from the Connector Service, verifies if the user is in the whitelist,
+    processes the message using Langchain, and returns a response
+    """
+    response, status, headers = await run_async(handle_process_message(
+        request.headers, await request.get_json(silent=True)
+    ))
+    return jsonify(response), status, headers
+
+@message_bp.route('/process-messages', methods=['POST'])
+@async_auth_middleware
+async def api_process_messages():
+    """
+    Receives a batch of messages from the Connector Service and processes them together
+    """
+    response, status = await run_async(handle_process_messages(request.headers, await request.get_json(silent=True)))
+    return jsonify(response), status
+
+@root_message_bp.route('/process-message', methods=['POST'])
+@async_auth_middleware
+async def root_process_message():
+    """
+    Root level endpoint for process-message (for compatibility with existing clients)
+    """
+    return await api_process_message()
@@ -1,6 +1,10 @@
 import os
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from config.logging_config import get_logger
+from config.lazy import LazySingleton
+from config.flow import io, register
+
+logger = get_logger(__name__)
 
 # Load environment variables
 load_dotenv()
@@ -9,26 +13,114 @@ load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
-# Initialize Supabase client
-supabase = None
-if SUPABASE_URL and SUPABASE_KEY:
+# Storage backend: "supabase" (default) or "sqlite" (embedded database, no network)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase").lower()
+SQLITE_DATABASE_PATH = os.getenv("SQLITE_DATABASE_PATH", "bot_service.sqlite3")
+
+def create_client_options():
+    """
+    Create the Supabase client options: the shared database connection pool and its timeouts
+    """
     try:
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-        print("Connected to Supabase successfully")
+        from supabase import ClientOptions
+    except ImportError:
+        from supabase.lib.client_options import ClientOptions
+    from services.http_pool import DATABASE, create_timeout, get_http_client
+    try:
+        return ClientOptions(postgrest_client_timeout=create_timeout(DATABASE), httpx_client=get_http_client(DATABASE))
+    except TypeError:
+        # Older supabase versions create their own HTTP client, only its timeout can be set
+        return ClientOptions(postgrest_client_timeout=create_timeout(DATABASE))
+
+def create_client():
+    """
+    Create the database client of the configured storage backend
+    """
+    if STORAGE_BACKEND == "sqlite":
+        from storage.sqlite_backend import SQLiteClient
+        client = SQLiteClient(SQLITE_DATABASE_PATH)
+        logger.info("Using SQLite database at %s", SQLITE_DATABASE_PATH)
+        return client
+    if STORAGE_BACKEND != "supabase":
+        raise ValueError(f"Unknown storage backend: {STORAGE_BACKEND}. Use 'supabase' or 'sqlite'.")
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        raise ValueError("Supabase URL or key not provided. Please check your .env file.")
+    try:
+        from supabase import create_client as create_supabase_client
+        from services.circuit_breaker import CircuitBreakerClient, get_circuit_breaker
+        from services.http_pool import DATABASE
+        client = create_supabase_client(SUPABASE_URL, SUPABASE_KEY, options=create_client_options())
+        logger.info("Connected to Supabase successfully")
+        return CircuitBreakerClient(client, get_circuit_breaker(DATABASE))
     except Exception as e:
-        print(f"Error connecting to Supabase: {e}")
+        logger.error("Error connecting to Supabase: %s", e)
         raise e
-else:
-    raise ValueError("Supabase URL or key not provided. Please check your .env file.")
+
+def create_async_client():
+    """
+    Create the async database client of the configured storage backend
+    """
+    if STORAGE_BACKEND == "sqlite":
+        from storage.sqlite_backend import AsyncSQLiteClient
+        return AsyncSQLiteClient(get_client())
+    from postgrest import AsyncPostgrestClient
+    from services.circuit_breaker import AsyncCircuitBreakerClient, get_circuit_breaker
+    from services.http_pool import DATABASE, create_timeout, get_async_http_client
+    headers = {
+        "apikey": SUPABASE_KEY,
+        "Authorization": f"Bearer {SUPABASE_KEY}",
+        "Accept": "application/json",
+        "Content-Type": "application/json"
+    }
+    try:
+        client = AsyncPostgrestClient(
+            f"{SUPABASE_URL}/rest/v1", headers=headers, http_client=get_async_http_client(DATABASE)
+        )
+    except TypeError:
+        # Older postgrest versions create their own HTTP client, only its timeout can be set
+        client = AsyncPostgrestClient(f"{SUPABASE_URL}/rest/v1", headers=headers, timeout=create_timeout(DATABASE))
+    return AsyncCircuitBreakerClient(client, get_circuit_breaker(DATABASE))
+
+# The clients are created on first use (once per worker process), so importing this
+# module doesn't connect and a missing setting only fails the requests that need the database
+_client = LazySingleton(create_client)
+_async_client = LazySingleton(create_async_client)
 
 def is_connected():
     """
-    Check if Supabase connection is established
+    Check if the database client was created in this process
     """
-    return supabase is not None
+    return _client.is_created()
 
 def get_client():
     """
-    Get the Supabase client
+    Get the database client (Supabase or the embedded SQLite backend)
+    """
+    return _client.get()
+
+def set_client(client):
+    """
+    Replace the database client of this process (the benchmarks wrap it to count queries)
+    """
+    _client.set(client)
+
+def get_async_client():
+    """
+    Get the async database client (the queries of the flows run by the ASGI app)
     """
-    return supabase 
\ No newline at end of file
+    return _async_client.get()
+
+def query(build):
+    """
+    Request the execution of a query from a flow (see config.flow): build(client) builds
+    it with the sync or the async client, and the flow gets the response
+    """
+    return io("query", build)
+
+def _execute(build):
+    return build(get_client()).execute()
+
+async def _execute_async(build):
+    return await build(get_async_client()).execute()
+
+register("query", _execute, _execute_async)
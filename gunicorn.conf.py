@@ -0,0 +1,37 @@
+"""
+Gunicorn configuration, used with: gunicorn -c gunicorn.conf.py app:app
+
+The app is preloaded in the master and the workers are forked from it. This is safe because
+the database and LLM clients, SQLite connections and background threads are all created on
+first use in each process, never inherited from the master.
+"""
+import os
+import shutil
+from config.settings import PORT, METRICS_DIR
+
+bind = f"0.0.0.0:{PORT}"
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 60))
+preload_app = os.getenv("GUNICORN_PRELOAD", "True").lower() == "true"
+
+# Import Langchain in the master too, so a new worker doesn't spend seconds loading it on its first LLM call
+preload_langchain = os.getenv("GUNICORN_PRELOAD_LANGCHAIN", "True").lower() == "true"
+
+def on_starting(server):
+    # Metrics snapshots of workers from a previous run
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+
+def when_ready(server):
+    if preload_app and preload_langchain:
+        from services.llm_parser import import_langchain
+        import_langchain()
+        server.log.info("Langchain loaded in the master")
+
+def post_fork(server, worker):
+    # Threads don't survive a fork: start the write-behind flusher of this worker,
+    # which also flushes expenses left in the queue by a previous run
+    from services.message_handler import get_expense_service
+    write_queue = get_expense_service().write_queue
+    if write_queue:
+        write_queue.start()
@@ -1,6 +1,24 @@
 from flask import request, jsonify
 import os
 from functools import wraps
+from services.metrics import metrics
+
+def check_auth_header(auth_header):
+    """
+    Check an Authorization header against the AUTH_KEY.
+    Returns None if it's valid, or a tuple (error_body, status_code) otherwise.
+    """
+    if not auth_header:
+        return {"error": "Missing Authorization header"}, 401
+    
+    expected_key = os.getenv("AUTH_KEY")
+    
+    # Check if the auth header matches the expected key directly
+    # or with a Bearer prefix
+    if auth_header != expected_key and auth_header != f"Bearer {expected_key}":
+        return {"error": "Invalid Auth key"}, 403
+    
+    return None
 
 def auth_middleware(f):
     """
@@ -8,18 +26,30 @@ def auth_middleware(f):
     """
     @wraps(f)  # Preserva el nombre y los metadatos de la función original
     def decorated_function(*args, **kwargs):
-        auth_header = request.headers.get("Authorization")
-
-        if not auth_header:
-            return jsonify({"error": "Missing Authorization header"}), 401
-        
-        expected_key = os.getenv("AUTH_KEY")
-        
-        # Check if the auth header matches the expected key directly
-        # or with a Bearer prefix
-        if auth_header != expected_key and auth_header != f"Bearer {expected_key}":
-            return jsonify({"error": "Invalid Auth key"}), 403
+        with metrics.span("auth"):
+            error = check_auth_header(request.headers.get("Authorization"))
+        if error:
+            body, status = error
+            return jsonify(body), status
 
         return f(*args, **kwargs)
 
     return decorated_function
+
+def async_auth_middleware(f):
+    """
+    Middleware to authenticate requests of the async (Quart) app using a static API key.
+    """
+    from quart import request as async_request, jsonify as async_jsonify
+
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        with metrics.span("auth"):
+            error = check_auth_header(async_request.headers.get("Authorization"))
+        if error:
+            body, status = error
+            return async_jsonify(body), status
+
+        return await f(*args, **kwargs)
+
+    return decorated_function
@@ -1,2 +1,3 @@
 from models.user import User
 from models.expense import Expense
+from models.expense_batch import ExpenseBatch
@@ -1,20 +1,71 @@
 from datetime import datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from config.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+def parse_amount_cents(amount):
+    """
+    Parse an amount (a number, or a string like "$1,234.50") into integer cents.
+    Invalid amounts are logged and count as 0.
+    """
+    if isinstance(amount, bool) or amount is None:
+        return 0
+    if isinstance(amount, int):
+        return amount * 100
+    try:
+        if isinstance(amount, float):
+            # Numeric columns come back as floats with at most two decimals (29.99 * 100 is 2998.9999...)
+            return round(amount * 100)
+        if not isinstance(amount, Decimal):
+            amount = Decimal(str(amount).replace("$", "").replace(",", "").strip())
+        return int((amount * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except (InvalidOperation, ValueError, OverflowError) as e:
+        logger.warning("Error parsing amount '%s': %s", amount, e)
+        return 0
+
+def parse_timestamp(value):
+    """
+    Parse a timestamp column (an ISO string or a datetime), None if it's missing or invalid
+    """
+    if isinstance(value, datetime) or value is None:
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
 
 class Expense:
     """
-    Expense model representing a user's expense
+    Expense model representing a user's expense.
+    The amount is parsed once and kept as integer cents.
     """
-    def __init__(self, user_id, description, amount, category, added_at=None, id=None):
+    __slots__ = ("id", "user_id", "description", "amount_cents", "category", "added_at", "parsed_by")
+
+    def __init__(self, user_id, description, amount, category, added_at=None, id=None, parsed_by=None):
         self.id = id
         self.user_id = user_id
         self.description = description
-        self.amount = amount
+        self.amount_cents = parse_amount_cents(amount)
         self.category = category
         self.added_at = added_at or datetime.now()
-        
+        # Parse path that extracted the expense ("rules", "classifier", "llm"...), None if unknown
+        self.parsed_by = parsed_by
+
+    @property
+    def amount(self):
+        """
+        Exact amount, as a Decimal with two decimal places
+        """
+        return Decimal(self.amount_cents).scaleb(-2)
+
+    @amount.setter
+    def amount(self, amount):
+        self.amount_cents = parse_amount_cents(amount)
+
     def __str__(self):
         return f"Expense(ID: {self.id}, User ID: {self.user_id}, Amount: {self.amount}, Category: {self.category})"
-        
+
     def to_dict(self):
         """
         Convert expense to dictionary for database storage
@@ -22,32 +73,28 @@ class Expense:
         return {
             "user_id": self.user_id,
             "description": self.description,
-            "amount": self.amount,
+            "amount": self.amount_cents / 100,
             "category": self.category,
-            "added_at": self.added_at.isoformat() if isinstance(self.added_at, datetime) else self.added_at
+            "added_at": self.added_at.isoformat() if isinstance(self.added_at, datetime) else self.added_at,
+            "parsed_by": self.parsed_by
         }
-        
+
     @classmethod
     def from_dict(cls, data):
         """
-        Create an Expense instance from dictionary data
+        Create an Expense instance from dictionary data (a database row, possibly with only
+        some of the columns)
         """
         if not data:
             return None
-            
-        # Convert added_at from string to datetime if it exists
-        added_at = data.get("added_at")
-        if added_at and isinstance(added_at, str):
-            try:
-                added_at = datetime.fromisoformat(added_at)
-            except ValueError:
-                added_at = datetime.now()
-            
-        return cls(
-            id=data.get("id"),
-            user_id=data.get("user_id"),
-            description=data.get("description"),
-            amount=data.get("amount"),
-            category=data.get("category"),
-            added_at=added_at
-        ) 
\ No newline at end of file
+
+        # Skip __init__: the row already has its id and timestamp
+        expense = cls.__new__(cls)
+        expense.id = data.get("id")
+        expense.user_id = data.get("user_id")
+        expense.description = data.get("description")
+        expense.amount_cents = parse_amount_cents(data.get("amount"))
+        expense.category = data.get("category")
+        expense.added_at = parse_timestamp(data.get("added_at")) or datetime.now()
+        expense.parsed_by = data.get("parsed_by")
+        return expense
@@ -1,6 +1,7 @@
-from langchain.prompts import ChatPromptTemplate
+from config.settings import EXPENSE_MAX_ITEMS
 
-EXPENSE_PROMPT = ChatPromptTemplate.from_template("""
+# Raw template text, also used to fingerprint cached parse results
+EXPENSE_PROMPT_TEMPLATE = """
 You are an expense analyzer. Your task is to analyze a message and determine if it contains information about an expense.
 
 IMPORTANT: The following examples should ALL be considered expenses:
@@ -11,12 +12,15 @@ IMPORTANT: The following examples should ALL be considered expenses:
 - "Taxi 20"
 - "Coffee 5 dollars"
 
-If the message contains an expense, extract the following information:
+A message can list several expenses, for example "coffee 5, taxi 20, lunch 12". Extract each one of them,
+up to {max_items} expenses. If the message lists more, only extract the first {max_items}.
+
+For each expense, extract the following information:
 - Description: What was purchased or what the expense is for
 - Amount: The monetary value of the expense (convert to numeric value only)
 - Category: The category of the expense (Housing, Transportation, Food, Utilities, Insurance, Medical, Healthcare, Savings, Debt, Education, Entertainment, Other)
 
-If the message does not contain an expense, return null.
+If the message does not contain any expense, return null.
 
 The message might be in any format and any language. Try to extract the information as best as you can.
 Recognize various currency formats including:
@@ -29,18 +33,34 @@ For any currency, extract only the numeric value for the amount field.
 
 IMPORTANT: Any message that mentions a product or service with a numeric value should be considered an expense, even if it doesn't explicitly use words like "bought", "paid", or "spent".
 
-Return your analysis as a JSON object with the following structure:
+Include a confidence between 0 and 1: how sure you are of your analysis. Use a low confidence when the message is ambiguous or the category is a guess.
+
+Return your analysis as a JSON object with the following structure, with one item per expense in the order of the message:
 {{
   "is_expense": true,
-  "description": "description of the expense",
-  "amount": numeric_value,
-  "category": "category of the expense"
+  "expenses": [
+    {{
+      "description": "description of the expense",
+      "amount": numeric_value,
+      "category": "category of the expense"
+    }}
+  ],
+  "confidence": numeric_value
 }}
 
 If it's not an expense, return:
 {{
-  "is_expense": false
+  "is_expense": false,
+  "confidence": numeric_value
 }}
 
 Message: {message}
-""") 
\ No newline at end of file
+""".replace("{max_items}", str(EXPENSE_MAX_ITEMS))
+
+def get_expense_prompt():
+    """
+    Build the Langchain prompt. Langchain is imported here, so it's only loaded when
+    the language model is first used.
+    """
+    from langchain.prompts import ChatPromptTemplate
+    return ChatPromptTemplate.from_template(EXPENSE_PROMPT_TEMPLATE)
\ No newline at end of file
@@ -1,26 +1,175 @@
-from database import get_client
-from models.expense import Expense
-from datetime import datetime, timedelta
+import base64
+import json
+from database import query
+from models.expense import Expense, parse_amount_cents
+from models.expense_batch import ExpenseBatch
+from datetime import datetime
+from config.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Columns that can be requested from the history API
+HISTORY_COLUMNS = ["id", "description", "amount", "category", "added_at"]
+
+def encode_cursor(expense):
+    """
+    Opaque cursor pointing after an expense, in (added_at, id) order
+    """
+    added_at = expense.added_at.isoformat() if isinstance(expense.added_at, datetime) else expense.added_at
+    return base64.urlsafe_b64encode(json.dumps([added_at, expense.id]).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    """
+    Get the (added_at, id) of a cursor, raises ValueError if it's not valid.
+    The id is kept as the database returned it, it isn't necessarily an integer.
+    """
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if not isinstance(decoded, list) or len(decoded) != 2:
+            raise ValueError("A cursor has two elements")
+        added_at, expense_id = decoded
+        return datetime.fromisoformat(added_at).isoformat(), expense_id
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+def history_query(query, user_id, since=None, until=None, categories=None, columns=None, limit=50, cursor=None):
+    """
+    Build the query of a page of a user's expenses, newest first, with keyset pagination
+    on (added_at, id): each page starts after the last row of the previous one, so pages
+    cost the same however deep they are.
+    """
+    # The cursor of the next page needs added_at and id
+    selected = list(dict.fromkeys((columns or HISTORY_COLUMNS) + ["id", "added_at"]))
+    query = query.select(",".join(selected)).eq("user_id", user_id)
+    if since:
+        query = query.gte("added_at", since.isoformat())
+    if until:
+        query = query.lt("added_at", until.isoformat())
+    if categories:
+        query = query.in_("category", categories)
+    if cursor:
+        added_at, expense_id = decode_cursor(cursor)
+        # The redundant bound lets the (user_id, added_at) index seek to the page instead of
+        # scanning every newer row to evaluate the OR
+        query = query.lte("added_at", added_at).or_(f'added_at.lt."{added_at}",and(added_at.eq."{added_at}",id.lt."{expense_id}")')
+    return query.order("added_at", desc=True).order("id", desc=True).limit(limit + 1)
+
+# Rows per request of the reads that page through many rows, PostgREST returns at most
+# 1000 rows per request (its max-rows setting)
+BATCH_PAGE_SIZE = 1000
+
+def expense_batch_query(query, user_id, since_iso, offset):
+    """
+    Build the query of a page of a user's expense amounts, categories and times since a
+    datetime, oldest first. The id breaks ties, so pages don't overlap or skip rows.
+    """
+    return query.select(ExpenseBatch.COLUMNS)\
+        .eq("user_id", user_id)\
+        .gte("added_at", since_iso)\
+        .order("added_at")\
+        .order("id")\
+        .range(offset, offset + BATCH_PAGE_SIZE - 1)
+
+def history_page(rows, limit):
+    """
+    Turn the rows of a history query into (expenses, next_cursor)
+    """
+    expenses = [Expense.from_dict(expense_data) for expense_data in rows or []]
+    if len(expenses) <= limit:
+        return expenses, None
+    expenses = expenses[:limit]
+    return expenses, encode_cursor(expenses[-1])
+
+# Database function of the single round trip daily report (storage/supabase_functions.sql)
+REPORT_FUNCTION = "get_expense_report"
+
+def report_from_data(data):
+    """
+    Get the (user_id, expenses, totals) of a get_expense_report result.
+    user_id is None for unregistered users.
+    """
+    user_id = data.get("user_id") if data else None
+    if user_id is None:
+        return None, [], {"total": 0.0, "count": 0, "categories": {}}
+    expenses = [Expense.from_dict(row) for row in data["expenses"]]
+    for expense in expenses:
+        expense.user_id = user_id
+    totals = {
+        "total": parse_amount_cents(data["total"]) / 100,
+        "count": int(data["count"]),
+        "categories": {category: parse_amount_cents(total) / 100 for category, total in (data["categories"] or {}).items()}
+    }
+    return user_id, expenses, totals
+
+# Column added after the first release (storage/supabase_functions.sql). Whether the table
+# has it is checked once per process, before the first insert or read that needs it.
+PARSED_BY_COLUMN = "parsed_by"
+_parsed_by_stored = {}
+
+def is_missing_column(error, column):
+    """
+    Check if a database error says that a column doesn't exist
+    """
+    message = str(error)
+    return column in message and (
+        "42703" in message or "PGRST204" in message or "does not exist" in message or "Could not find" in message
+    )
 
 class ExpenseRepository:
     """
-    Repository for expense operations
+    Repository for expense operations. Its methods are flows (see config.flow), run with
+    the blocking client by the Flask app and with the async client by the Quart app.
     """
     def __init__(self):
-        self.supabase = get_client()
         self.table_name = "expenses"
-        
+
+    def stores_parsed_by(self):
+        """
+        Check once per process if the expenses table has the parsed_by column. Without it
+        every insert that sends it fails, so expenses are then stored without it, and a
+        loud warning asks for the migration.
+        """
+        stored = _parsed_by_stored.get(self.table_name)
+        if stored is not None:
+            return stored
+        try:
+            yield query(lambda client: client.table(self.table_name).select(PARSED_BY_COLUMN).limit(1))
+            stored = True
+        except Exception as e:
+            if not is_missing_column(e, PARSED_BY_COLUMN):
+                # Checked again next time, the insert itself reports the error
+                logger.error("Error checking the %s column of %s: %s", PARSED_BY_COLUMN, self.table_name, e)
+                return True
+            logger.error(
+                "THE %s TABLE HAS NO %s COLUMN: expenses are saved without their parse path and the "
+                "category classifier learns from its own guesses. Run storage/supabase_functions.sql "
+                "on the database and restart the service.", self.table_name.upper(), PARSED_BY_COLUMN.upper()
+            )
+            stored = False
+        _parsed_by_stored[self.table_name] = stored
+        return stored
+
+    def _rows(self, expenses):
+        """
+        Get the rows to insert for expenses, without parsed_by when the table doesn't have it
+        """
+        rows = [expense.to_dict() for expense in expenses]
+        if not (yield from self.stores_parsed_by()):
+            for row in rows:
+                row.pop(PARSED_BY_COLUMN, None)
+        return rows
+
     def get_by_id(self, expense_id):
         """
         Get an expense by ID
         """
         try:
-            response = self.supabase.table(self.table_name).select("*").eq("id", expense_id).execute()
+            response = yield query(lambda client: client.table(self.table_name).select("*").eq("id", expense_id))
             if response.data and len(response.data) > 0:
                 return Expense.from_dict(response.data[0])
             return None
         except Exception as e:
-            print(f"Error getting expense by ID: {e}")
+            logger.error("Error getting expense by ID: %s", e)
             return None
             
     def create(self, expense):
@@ -28,31 +177,44 @@ class ExpenseRepository:
         Create a new expense
         """
         try:
-            expense_data = expense.to_dict()
-            response = self.supabase.table(self.table_name).insert(expense_data).execute()
+            expense_data = (yield from self._rows([expense]))[0]
+            response = yield query(lambda client: client.table(self.table_name).insert(expense_data))
             if response.data and len(response.data) > 0:
                 return Expense.from_dict(response.data[0])
             return None
         except Exception as e:
-            print(f"Error creating expense: {e}")
+            logger.error("Error creating expense: %s", e)
             return None
 
-    def get_daily_expenses(self, user_id):
+    def create_many(self, expenses):
         """
-        Get all expenses for a user from the last 24 hours
+        Create several expenses with a single bulk insert
         """
         try:
-            # Calculate the timestamp for 24 hours ago
-            yesterday = datetime.now() - timedelta(days=1)
-            yesterday_iso = yesterday.strftime("%Y-%m-%dT%H:%M:%S.%f%z")
-            
-            # Query expenses for the user in the last 24 hours
-            response = self.supabase.table(self.table_name)\
-                .select("*")\
-                .eq("user_id", user_id)\
-                .gte("added_at", yesterday_iso)\
-                .order("added_at", desc=True)\
-                .execute()
+            if not expenses:
+                return []
+            expenses_data = yield from self._rows(expenses)
+            response = yield query(lambda client: client.table(self.table_name).insert(expenses_data))
+            if response.data:
+                return [Expense.from_dict(expense_data) for expense_data in response.data]
+            return []
+        except Exception as e:
+            logger.error("Error creating expenses: %s", e)
+            return []
+
+    def get_expenses_since(self, user_id, since, columns="*", raise_errors=False):
+        """
+        Get all expenses for a user added since the given datetime, newest first.
+        Errors are logged and return an empty list unless raise_errors is set.
+        """
+        since_iso = since.strftime("%Y-%m-%dT%H:%M:%S.%f%z")
+        try:
+            # Query expenses for the user since the given time
+            response = yield query(lambda client: client.table(self.table_name)
+                .select(columns)
+                .eq("user_id", user_id)
+                .gte("added_at", since_iso)
+                .order("added_at", desc=True))
             
             # Convert the response data to Expense objects
             if response.data:
@@ -60,6 +222,76 @@ class ExpenseRepository:
             return []
             
         except Exception as e:
-            print(f"Error getting daily expenses: {e}")
-            print(f"Query parameters: user_id={user_id}, yesterday={yesterday_iso}")
+            logger.error("Error getting expenses: %s (user_id=%s, since=%s)", e, user_id, since_iso)
+            if raise_errors:
+                raise
             return []
+
+    def get_expense_batch_since(self, user_id, since, raise_errors=False):
+        """
+        Get the amounts, categories and times of a user's expenses since the given datetime,
+        column-wise in an ExpenseBatch. They are read BATCH_PAGE_SIZE rows at a time, so
+        heavy users aren't cut at the row limit of a response. Errors are logged and return
+        an empty batch unless raise_errors is set.
+        """
+        since_iso = since.strftime("%Y-%m-%dT%H:%M:%S.%f%z")
+        try:
+            batch = ExpenseBatch()
+            while True:
+                offset = len(batch)
+                response = yield query(lambda client: expense_batch_query(client.table(self.table_name), user_id, since_iso, offset))
+                rows = response.data or []
+                batch.extend_rows(rows)
+                if len(rows) < BATCH_PAGE_SIZE:
+                    return batch
+
+        except Exception as e:
+            logger.error("Error getting expenses: %s (user_id=%s, since=%s)", e, user_id, since_iso)
+            if raise_errors:
+                raise
+            return ExpenseBatch()
+
+    def get_report_by_telegram_id(self, telegram_id, since, max_rows):
+        """
+        Get a user's ID, their `max_rows` most recent expenses since the given datetime and
+        the totals of all of them, by Telegram ID with a single database call.
+        Returns a tuple (user_id, expenses, totals), errors are raised.
+        """
+        params = {
+            "p_telegram_id": str(telegram_id),
+            "p_since": since.isoformat(),
+            "p_max_rows": max_rows
+        }
+        response = yield query(lambda client: client.rpc(REPORT_FUNCTION, params))
+        return report_from_data(response.data)
+
+    def get_history(self, user_id, since=None, until=None, categories=None, columns=None, limit=50, cursor=None):
+        """
+        Get a page of a user's expenses, newest first, optionally in a date range
+        [since, until) and in some categories, with only the given columns.
+
+        Returns a tuple (expenses, next_cursor), next_cursor is None on the last page.
+        Raises ValueError if the cursor is not valid.
+        """
+        response = yield query(lambda client: history_query(
+            client.table(self.table_name), user_id, since, until, categories, columns, limit, cursor
+        ))
+        return history_page(response.data, limit)
+
+    def get_expenses_after(self, after_id, limit=1000, columns="id,user_id,description,category,parsed_by"):
+        """
+        Get up to `limit` expenses with an ID greater than after_id (from the first one
+        if it's None), in ID order.
+        Used to load all the expenses page by page, and then only the new ones.
+        """
+        if PARSED_BY_COLUMN in columns.split(",") and not (yield from self.stores_parsed_by()):
+            columns = ",".join(column for column in columns.split(",") if column != PARSED_BY_COLUMN)
+
+        def build(client):
+            selected = client.table(self.table_name).select(columns)
+            if after_id is not None:
+                selected = selected.gt("id", after_id)
+            return selected.order("id").limit(limit)
+
+        response = yield query(build)
+        return [Expense.from_dict(expense_data) for expense_data in response.data or []]
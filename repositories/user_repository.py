@@ -1,40 +1,64 @@
-from database import get_client
+from database import query
 from models.user import User
 from datetime import datetime
+from config.logging_config import get_logger
+
+logger = get_logger(__name__)
 
 class UserRepository:
     """
-    Repository for user operations
+    Repository for user operations. Its methods are flows (see config.flow), run with
+    the blocking client by the Flask app and with the async client by the Quart app.
     """
     def __init__(self):
-        self.supabase = get_client()
         self.table_name = "users"
-        
-    def get_by_telegram_id(self, telegram_id):
+
+    def get_by_telegram_id(self, telegram_id, raise_errors=False):
         """
-        Get a user by Telegram ID
+        Get a user by Telegram ID, None if not registered.
+        Errors are logged and return None unless raise_errors is set.
         """
         try:
-            response = self.supabase.table(self.table_name).select("*").eq("telegram_id", telegram_id).execute()
+            response = yield query(lambda client: client.table(self.table_name).select("*").eq("telegram_id", telegram_id))
             if response.data and len(response.data) > 0:
                 return User.from_dict(response.data[0])
             return None
         except Exception as e:
-            print(f"Error getting user by Telegram ID: {e}")
+            logger.error("Error getting user by Telegram ID: %s", e)
+            if raise_errors:
+                raise
             return None
             
+    def get_by_telegram_ids(self, telegram_ids, raise_errors=False):
+        """
+        Get the users with any of the given Telegram IDs with a single query.
+        Errors are logged and return an empty list unless raise_errors is set.
+        """
+        try:
+            if not telegram_ids:
+                return []
+            response = yield query(lambda client: client.table(self.table_name).select("*").in_("telegram_id", list(telegram_ids)))
+            if response.data:
+                return [User.from_dict(user_data) for user_data in response.data]
+            return []
+        except Exception as e:
+            logger.error("Error getting users by Telegram IDs: %s", e)
+            if raise_errors:
+                raise
+            return []
+            
     def create(self, user):
         """
         Create a new user
         """
         try:
             user_data = user.to_dict()
-            response = self.supabase.table(self.table_name).insert(user_data).execute()
+            response = yield query(lambda client: client.table(self.table_name).insert(user_data))
             if response.data and len(response.data) > 0:
                 return User.from_dict(response.data[0])
             return None
         except Exception as e:
-            print(f"Error creating user: {e}")
+            logger.error("Error creating user: %s", e)
             return None
             
     def user_exists(self, telegram_id):
@@ -42,8 +66,8 @@ class UserRepository:
         Check if a user exists by Telegram ID
         """
         try:
-            user = self.get_by_telegram_id(telegram_id)
+            user = yield from self.get_by_telegram_id(telegram_id)
             return user is not None
         except Exception as e:
-            print(f"Error checking if user exists: {e}")
-            return False 
\ No newline at end of file
+            logger.error("Error checking if user exists: %s", e)
+            return False 
@@ -1 +1,2 @@
 from services.user_service import UserService
+from services.expense_service import ExpenseService
@@ -0,0 +1,353 @@
+"""
+Local expense category classifier, trained from the stored expenses.
+
+Train it offline from the database with:
+    python -m services.category_classifier --output category_model.json
+"""
+import argparse
+import fcntl
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from services.expense_parser import EXPENSE_CATEGORIES, canonical_category, PARSE_PATH_CLASSIFIER, PARSE_PATH_DEGRADED
+from config.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+MODEL_VERSION = 1
+
+# Words of a description, numbers and single letters are ignored
+_TOKEN_RE = re.compile(r"[^\W\d_]{2,}")
+
+# Sources of a predicted category
+SOURCE_USER = "user"
+SOURCE_MODEL = "model"
+
+# Expenses whose category the classifier (or the degraded parse) chose are not learned,
+# or each mistake would make the model more sure of itself
+UNTRUSTED_PARSE_PATHS = {PARSE_PATH_CLASSIFIER, PARSE_PATH_DEGRADED}
+
+def tokenize(description):
+    """
+    Split a description into lowercase words
+    """
+    return _TOKEN_RE.findall((description or "").lower())
+
+def is_trusted(expense):
+    """
+    Check if the category of a stored expense can be learned
+    """
+    return getattr(expense, "parsed_by", None) not in UNTRUSTED_PARSE_PATHS
+
+class CategoryClassifier:
+    """
+    Multinomial naive Bayes over the words of expense descriptions, plus per-user overrides:
+    the category a user last stored for the same description wins over the model.
+
+    The model is loaded from a file trained offline, then kept up to date by loading the
+    expenses stored since (by ID) every refresh_interval seconds in a background thread,
+    so classifying never waits on the database. Without a model file, the first worker of
+    the host trains it from all the expenses and saves it to model_path, and the other
+    workers load it.
+    """
+    def __init__(self, load_expenses=None, min_confidence=0.9, min_examples=50,
+                 refresh_interval=300, max_overrides=100000, alpha=0.1, model_path=None):
+        # load_expenses(after_id, limit) returns the expenses with an ID greater than after_id,
+        # from the first one when after_id is None
+        self.load_expenses = load_expenses
+        self.model_path = model_path
+        self.loaded = False
+        self.min_confidence = min_confidence
+        self.min_examples = min_examples
+        self.refresh_interval = refresh_interval
+        self.max_overrides = max_overrides
+        self.alpha = alpha
+        # ID of the last expense loaded, compared only by the database
+        self.last_id = None
+        self.examples = 0
+        # category -> number of expenses, category -> {word: count}, category -> number of words
+        self.category_examples = {}
+        self.word_counts = {}
+        self.category_words = {}
+        self.vocabulary = set()
+        # (user_id, normalized description) -> category
+        self.overrides = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_refresh = 0
+        self._refresh_pid = None
+
+    def learn(self, description, category, user_id=None):
+        """
+        Add a labelled expense to the model
+        """
+        category = canonical_category(category or "")
+        words = tokenize(description)
+        if not category or not words:
+            return
+        with self._lock:
+            self.examples += 1
+            self.category_examples[category] = self.category_examples.get(category, 0) + 1
+            counts = self.word_counts.setdefault(category, {})
+            for word in words:
+                counts[word] = counts.get(word, 0) + 1
+            self.category_words[category] = self.category_words.get(category, 0) + len(words)
+            self.vocabulary.update(words)
+            if user_id is not None:
+                key = (str(user_id), " ".join(words))
+                self.overrides[key] = category
+                self.overrides.move_to_end(key)
+                while len(self.overrides) > self.max_overrides:
+                    self.overrides.popitem(last=False)
+
+    def learn_expenses(self, expenses):
+        """
+        Add stored expenses (in ID order) to the model, remembering the last ID seen
+        """
+        for expense in expenses:
+            if is_trusted(expense):
+                self.learn(expense.description, expense.category, expense.user_id)
+            if expense.id is not None:
+                self.last_id = expense.id
+
+    def user_category(self, description, user_id):
+        """
+        Get the category the user last stored for this description, or None
+        """
+        if user_id is None:
+            return None
+        self.refresh_if_stale()
+        with self._lock:
+            return self.overrides.get((str(user_id), " ".join(tokenize(description))))
+
+    def predict(self, description):
+        """
+        Get the probability of each category for a description, or an empty dictionary
+        when less than half of its words are known (a sentence the model has never seen)
+        """
+        words = tokenize(description)
+        with self._lock:
+            known = [word for word in words if word in self.vocabulary]
+            if not known or len(known) * 2 < len(words):
+                return {}
+            vocabulary_size = len(self.vocabulary)
+            scores = {}
+            for category, examples in self.category_examples.items():
+                counts = self.word_counts[category]
+                denominator = self.category_words[category] + self.alpha * vocabulary_size
+                score = math.log(examples / self.examples)
+                for word in known:
+                    score += math.log((counts.get(word, 0) + self.alpha) / denominator)
+                scores[category] = score
+        best = max(scores.values())
+        weights = {category: math.exp(score - best) for category, score in scores.items()}
+        total = sum(weights.values())
+        return {category: weight / total for category, weight in weights.items()}
+
+    def classify(self, description, user_id=None):
+        """
+        Get the category of a description and where it comes from (SOURCE_USER or SOURCE_MODEL),
+        or (None, None) when the model is not confident enough
+        """
+        self.refresh_if_stale()
+        category = self.user_category(description, user_id)
+        if category:
+            return category, SOURCE_USER
+        if self.examples < self.min_examples:
+            return None, None
+        probabilities = self.predict(description)
+        if not probabilities:
+            return None, None
+        category, probability = max(probabilities.items(), key=lambda item: item[1])
+        if probability < self.min_confidence:
+            return None, None
+        return category, SOURCE_MODEL
+
+    def refresh(self, page_size=1000):
+        """
+        Load the expenses stored since the last refresh
+        """
+        loaded = 0
+        while True:
+            expenses = self.load_expenses(self.last_id, page_size)
+            self.learn_expenses(expenses)
+            loaded += len(expenses)
+            if len(expenses) < page_size:
+                break
+        if loaded:
+            logger.info("Category model loaded %d new expenses (%d in total)", loaded, self.examples)
+        return loaded
+
+    def load_or_train(self):
+        """
+        Load the model file, or else train the model from all the stored expenses and save
+        it. The file is locked meanwhile, so one worker of the host trains it and the others
+        wait and load it instead of paging the whole table too.
+        """
+        try:
+            lock_file = open(f"{self.model_path}.lock", "a")
+        except OSError as e:
+            logger.warning("Error locking the category model %s, training it in this worker: %s", self.model_path, e)
+            self.refresh()
+            return
+        with lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if self.load(self.model_path):
+                return
+            self.refresh()
+            try:
+                self.save(self.model_path)
+            except OSError as e:
+                logger.warning("Error saving the category model to %s: %s", self.model_path, e)
+            else:
+                logger.info("Category model trained on %d expenses and saved to %s", self.examples, self.model_path)
+
+    def _run_refresh(self):
+        try:
+            if self.model_path and not self.loaded:
+                self.load_or_train()
+                self.loaded = True
+            self.refresh()
+        except Exception as e:
+            logger.warning("Error refreshing the category model: %s", e)
+        finally:
+            self._last_refresh = time.monotonic()
+            self._refresh_pid = None
+
+    def refresh_if_stale(self):
+        """
+        Start a background refresh if the last one is older than refresh_interval
+        """
+        if not self.load_expenses or self._refresh_pid == os.getpid():
+            return
+        if self._last_refresh and time.monotonic() - self._last_refresh < self.refresh_interval:
+            return
+        with self._lock:
+            if self._refresh_pid == os.getpid():
+                return
+            self._refresh_pid = os.getpid()
+        threading.Thread(target=self._run_refresh, name="category-model-refresh", daemon=True).start()
+
+    def to_dict(self):
+        """
+        Get the model as a JSON-serializable dictionary
+        """
+        with self._lock:
+            return {
+                "version": MODEL_VERSION,
+                "last_id": self.last_id,
+                "categories": {
+                    category: {
+                        "examples": examples,
+                        "words": self.category_words[category],
+                        "counts": self.word_counts[category]
+                    }
+                    for category, examples in self.category_examples.items()
+                },
+                "overrides": [[user_id, description, category] for (user_id, description), category in self.overrides.items()]
+            }
+
+    def load_dict(self, data):
+        """
+        Replace the model with one saved by to_dict
+        """
+        if data.get("version") != MODEL_VERSION:
+            raise ValueError(f"Unsupported category model version: {data.get('version')}")
+        with self._lock:
+            self.last_id = data["last_id"]
+            self.category_examples = {category: entry["examples"] for category, entry in data["categories"].items()}
+            self.category_words = {category: entry["words"] for category, entry in data["categories"].items()}
+            self.word_counts = {category: entry["counts"] for category, entry in data["categories"].items()}
+            self.examples = sum(self.category_examples.values())
+            self.vocabulary = {word for counts in self.word_counts.values() for word in counts}
+            self.overrides = OrderedDict(
+                ((user_id, description), category) for user_id, description, category in data["overrides"]
+            )
+            self.loaded = True
+
+    def save(self, path):
+        """
+        Save the model to a JSON file (atomically, workers never load a partial file)
+        """
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as model_file:
+            json.dump(self.to_dict(), model_file)
+        os.replace(temp_path, path)
+
+    def load(self, path):
+        """
+        Load the model saved in a file, returns False if there is no valid file
+        """
+        try:
+            with open(path) as model_file:
+                self.load_dict(json.load(model_file))
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Error loading the category model from %s: %s", path, e)
+            return False
+        logger.info("Category model loaded from %s (%d expenses)", path, self.examples)
+        return True
+
+def evaluate(expenses, min_confidence, holdout_every=10):
+    """
+    Train on all the expenses but every holdout_every-th one, and classify those.
+    Returns the share of held out expenses classified (coverage) and the share of those
+    classified correctly (accuracy).
+    """
+    classifier = CategoryClassifier(min_confidence=min_confidence, min_examples=0)
+    held_out = []
+    for index, expense in enumerate(filter(is_trusted, expenses)):
+        if index % holdout_every == 0:
+            held_out.append(expense)
+        else:
+            classifier.learn(expense.description, expense.category)
+    classified = correct = 0
+    for expense in held_out:
+        category, _ = classifier.classify(expense.description)
+        if category:
+            classified += 1
+            correct += category == canonical_category(expense.category or "")
+    return {
+        "held_out": len(held_out),
+        "coverage": classified / len(held_out) if held_out else 0.0,
+        "accuracy": correct / classified if classified else 0.0
+    }
+
+def main():
+    from repositories.expense_repository import ExpenseRepository
+    from config.flow import run
+    from config.settings import CATEGORY_MODEL_PATH, CATEGORY_MODEL_MIN_CONFIDENCE
+
+    parser = argparse.ArgumentParser(description="Train the category classifier from the stored expenses")
+    parser.add_argument("--output", default=CATEGORY_MODEL_PATH, help="Model file to write")
+    parser.add_argument("--min-confidence", type=float, default=CATEGORY_MODEL_MIN_CONFIDENCE,
+                        help="Minimum probability used for the evaluation")
+    args = parser.parse_args()
+
+    repository = ExpenseRepository()
+    expenses = []
+    while True:
+        page = run(repository.get_expenses_after(expenses[-1].id if expenses else None, 1000))
+        expenses.extend(page)
+        if len(page) < 1000:
+            break
+
+    classifier = CategoryClassifier()
+    classifier.learn_expenses(expenses)
+    classifier.save(args.output)
+
+    print(f"Trained on {classifier.examples} of {len(expenses)} expenses, saved to {args.output}")
+    for category in EXPENSE_CATEGORIES:
+        print(f"  {category:<22}{classifier.category_examples.get(category, 0):>8}")
+    result = evaluate(expenses, args.min_confidence)
+    print(
+        f"Held out {result['held_out']} expenses: {result['coverage']:.1%} classified "
+        f"with {result['accuracy']:.1%} accuracy at confidence {args.min_confidence}"
+    )
+
+if __name__ == "__main__":
+    main()
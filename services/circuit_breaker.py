@@ -0,0 +1,255 @@
+import threading
+import time
+from services.metrics import metrics
+from config.logging_config import get_logger
+from config.settings import CIRCUIT_BREAKER_ENABLED, CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_RESET_TIMEOUT
+
+logger = get_logger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Exceptions of the HTTP clients (httpx, openai) raised when a dependency can't be reached
+# or doesn't answer in time, matched by name so the clients aren't imported here
+_OUTAGE_ERRORS = {"TransportError", "TimeoutException", "APIConnectionError", "APITimeoutError"}
+
+class CircuitOpenError(RuntimeError):
+    """
+    Raised instead of calling a dependency whose circuit breaker is open
+    """
+
+def is_outage(error):
+    """
+    Check if an exception means the dependency is failing (unreachable, timing out,
+    overloaded or erroring), rather than the request being wrong
+    """
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    if any(cls.__name__ in _OUTAGE_ERRORS for cls in type(error).__mro__):
+        return True
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status is None:
+        # PostgREST errors carry the HTTP status as their code when the server failed
+        code = str(getattr(error, "code", "") or "")
+        status = int(code) if code.isdigit() else None
+    return status is not None and (status >= 500 or status == 429)
+
+class CircuitBreaker:
+    """
+    Stops calling a dependency that keeps failing, so requests fail fast instead of each
+    one waiting for a timeout.
+
+    After failure_threshold consecutive outage errors (see is_outage) the breaker opens and
+    calls raise CircuitOpenError. After reset_timeout seconds it lets half_open_max_calls
+    trial calls through: it closes if one succeeds, and opens again if one fails.
+    Each worker process has its own breakers.
+    """
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, half_open_max_calls=1, enabled=True):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.enabled = enabled
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_calls = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        """
+        Change the state, must be called with the lock held
+        """
+        if state == self.state:
+            return
+        self.state = state
+        metrics.increment("bot_circuit_breaker_transitions_total", breaker=self.name, state=state)
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+            logger.warning(
+                "Circuit breaker %s opened after %d failures, retrying in %ss: %s",
+                self.name, self.failures, self.reset_timeout, self.last_error
+            )
+        elif state == CLOSED:
+            logger.info("Circuit breaker %s closed", self.name)
+
+    def is_open(self):
+        """
+        Check if calls are rejected right now, without using a trial call
+        """
+        with self._lock:
+            if self.state == OPEN:
+                return time.monotonic() - self.opened_at < self.reset_timeout
+            return self.state == HALF_OPEN and self.trial_calls >= self.half_open_max_calls
+
+    def before_call(self):
+        """
+        Check that a call may go through, raises CircuitOpenError otherwise
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.trial_calls = 0
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN and self.trial_calls < self.half_open_max_calls:
+                self.trial_calls += 1
+                return
+            if self.state == CLOSED:
+                return
+        metrics.increment("bot_circuit_breaker_calls_total", breaker=self.name, result="rejected")
+        raise CircuitOpenError(f"The {self.name} circuit breaker is open")
+
+    def record_success(self):
+        if not self.enabled:
+            return
+        metrics.increment("bot_circuit_breaker_calls_total", breaker=self.name, result="success")
+        with self._lock:
+            self.failures = 0
+            self._set_state(CLOSED)
+
+    def record_failure(self, error):
+        """
+        Record a failed call. Errors that are not outages count as successes: the
+        dependency answered.
+        """
+        if not self.enabled:
+            return
+        if not is_outage(error):
+            self.record_success()
+            return
+        metrics.increment("bot_circuit_breaker_calls_total", breaker=self.name, result="failure")
+        with self._lock:
+            self.failures += 1
+            self.last_error = f"{type(error).__name__}: {error}"
+            # A failed trial call opens the breaker again, restarting the wait
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self._set_state(OPEN)
+
+    def call(self, function, *args, **kwargs):
+        """
+        Call function(*args, **kwargs) through the breaker
+        """
+        self.before_call()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            self.record_failure(e)
+            raise
+        self.record_success()
+        return result
+
+    async def call_async(self, function, *args, **kwargs):
+        """
+        Async version of call, function is a coroutine function
+        """
+        self.before_call()
+        try:
+            result = await function(*args, **kwargs)
+        except Exception as e:
+            self.record_failure(e)
+            raise
+        self.record_success()
+        return result
+
+    def get_state(self):
+        """
+        Get the state of the breaker as a JSON-serializable dictionary
+        """
+        with self._lock:
+            retry_in = None
+            if self.state == OPEN:
+                retry_in = round(max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at)), 3)
+            return {
+                "name": self.name,
+                "enabled": self.enabled,
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "failure_threshold": self.failure_threshold,
+                "reset_timeout": self.reset_timeout,
+                "retry_in_seconds": retry_in,
+                "last_error": self.last_error
+            }
+
+class CircuitBreakerQuery:
+    """
+    Query builder whose execute() goes through a circuit breaker, the other methods
+    are those of the wrapped builder
+    """
+    def __init__(self, query, breaker):
+        self._query = query
+        self._breaker = breaker
+
+    def __getattr__(self, attribute):
+        value = getattr(self._query, attribute)
+        if not callable(value):
+            return value
+
+        def method(*args, **kwargs):
+            result = value(*args, **kwargs)
+            # Filters and modifiers return the next builder of the chain
+            return type(self)(result, self._breaker) if hasattr(result, "execute") else result
+        return method
+
+    def execute(self):
+        return self._breaker.call(self._query.execute)
+
+class AsyncCircuitBreakerQuery(CircuitBreakerQuery):
+    """
+    Query builder whose awaitable execute() goes through a circuit breaker
+    """
+    async def execute(self):
+        return await self._breaker.call_async(self._query.execute)
+
+class CircuitBreakerClient:
+    """
+    Database client whose queries (table() and rpc()) go through a circuit breaker
+    """
+    query_class = CircuitBreakerQuery
+
+    def __init__(self, client, breaker):
+        self.client = client
+        self.breaker = breaker
+
+    def table(self, table_name):
+        return self.query_class(self.client.table(table_name), self.breaker)
+
+    def rpc(self, function_name, params=None):
+        return self.query_class(self.client.rpc(function_name, params or {}), self.breaker)
+
+    def __getattr__(self, attribute):
+        return getattr(self.client, attribute)
+
+class AsyncCircuitBreakerClient(CircuitBreakerClient):
+    """
+    Async database client whose queries go through a circuit breaker
+    """
+    query_class = AsyncCircuitBreakerQuery
+
+# Breakers of this worker process, by dependency
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(name):
+    """
+    Get the circuit breaker of a dependency ("database" or "openai"), the sync and
+    async clients of a dependency share it
+    """
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(name, CircuitBreaker(
+                name,
+                failure_threshold=CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+                reset_timeout=CIRCUIT_BREAKER_RESET_TIMEOUT,
+                enabled=CIRCUIT_BREAKER_ENABLED
+            ))
+    return breaker
+
+def get_circuit_breaker_states():
+    """
+    Get the state of the circuit breakers of this worker process
+    """
+    return {name: breaker.get_state() for name, breaker in sorted(_breakers.items())}
@@ -0,0 +1,75 @@
+import csv
+import io
+import json
+from services.message_responses import expense_row
+from services.metrics import metrics
+from config.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Content type of each export format
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson"
+}
+
+def export_header(columns, export_format):
+    """
+    Text sent before the first expense: the header row of a CSV export
+    """
+    if export_format != "csv":
+        return ""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(columns)
+    return buffer.getvalue()
+
+def render_page(expenses, columns, export_format):
+    """
+    Render a page of expenses as CSV rows or JSON lines, one chunk of the export
+    """
+    if export_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for expense in expenses:
+            row = expense_row(expense, columns)
+            writer.writerow([row[column] for column in columns])
+        return buffer.getvalue()
+    return "".join(json.dumps(expense_row(expense, columns), ensure_ascii=False) + "\n" for expense in expenses)
+
+def export_stream(pages, columns, export_format):
+    """
+    Stream an export chunk by chunk from an iterator of pages of expenses, so only one page
+    is in memory. The response has started when a page fails: the error is logged and the
+    export ends early.
+    """
+    rows = 0
+    try:
+        yield export_header(columns, export_format)
+        for expenses in pages:
+            rows += len(expenses)
+            yield render_page(expenses, columns, export_format)
+    except Exception:
+        logger.exception("Error exporting expenses after %d rows", rows)
+        metrics.increment("bot_exports_total", format=export_format, result="error")
+        return
+    finally:
+        metrics.increment("bot_export_rows_total", value=rows, format=export_format)
+    metrics.increment("bot_exports_total", format=export_format, result="completed")
+
+async def export_stream_async(pages, columns, export_format):
+    """
+    Async version of export_stream, pages is an async iterator
+    """
+    rows = 0
+    try:
+        yield export_header(columns, export_format)
+        async for expenses in pages:
+            rows += len(expenses)
+            yield render_page(expenses, columns, export_format)
+    except Exception:
+        logger.exception("Error exporting expenses after %d rows", rows)
+        metrics.increment("bot_exports_total", format=export_format, result="error")
+        return
+    finally:
+        metrics.increment("bot_export_rows_total", value=rows, format=export_format)
+    metrics.increment("bot_exports_total", format=export_format, result="completed")
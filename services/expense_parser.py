@@ -0,0 +1,221 @@
+import re
+import threading
+
+# Categories accepted by the bot (see README "Expense Categories")
+EXPENSE_CATEGORIES = [
+    "Housing",
+    "Transportation",
+    "Food",
+    "Utilities",
+    "Insurance",
+    "Medical/Healthcare",
+    "Savings",
+    "Debt",
+    "Education",
+    "Entertainment",
+    "Other",
+]
+
+# Names the prompt and users use for a category, mapped to the canonical name
+CATEGORY_ALIASES = {
+    "medical": "Medical/Healthcare",
+    "healthcare": "Medical/Healthcare",
+    "health": "Medical/Healthcare",
+    "transport": "Transportation",
+}
+
+# Keywords used to infer a category when the message doesn't specify one
+CATEGORY_KEYWORDS = {
+    "Housing": ["rent", "mortgage", "alquiler", "expensas", "furniture", "heladera", "fridge", "repair"],
+    "Transportation": ["taxi", "uber", "cabify", "bus", "train", "subway", "subte", "gas", "fuel",
+                       "nafta", "parking", "toll", "flight", "metro"],
+    "Food": ["food", "groceries", "grocery", "supermarket", "pizza", "coffee", "cafe", "lunch",
+             "dinner", "breakfast", "restaurant", "bread", "burger", "snack", "snacks", "meal",
+             "sushi", "beer", "empanadas", "pan", "comida", "almuerzo", "cena"],
+    "Utilities": ["electricity", "water", "internet", "phone bill", "wifi", "power bill", "luz", "gas bill"],
+    "Insurance": ["insurance", "seguro"],
+    "Medical/Healthcare": ["doctor", "pharmacy", "medicine", "medicines", "dentist", "hospital",
+                           "farmacia", "pills", "therapy"],
+    "Savings": ["savings", "ahorro"],
+    "Debt": ["loan", "debt", "credit card", "installment", "cuota"],
+    "Education": ["books", "book", "course", "tuition", "school", "university", "class", "classes"],
+    "Entertainment": ["movie", "movies", "cinema", "concert", "netflix", "spotify", "tickets",
+                      "game", "games", "theater", "bar"],
+}
+
+# Currency markers the parser understands, written before or after the number
+_CURRENCY_PREFIX = r"(?:US\$|AR\$|ARS\$|\$|€|USD|ARS|EUR)"
+_CURRENCY_SUFFIX = r"(?:dollars?|bucks|pesos?|euros?|usd|ars|eur|€|\$)"
+_NUMBER = r"\d{1,3}(?:,\d{3})+(?:\.\d{1,2})?|\d+(?:[.,]\d{1,2})?"
+
+# An amount with an explicit currency marker ("$15.99", "EUR 50", "300 pesos")
+_AMOUNT = (
+    rf"(?:{_CURRENCY_PREFIX}\s?(?P<prefixed>{_NUMBER})"
+    rf"|(?P<suffixed>{_NUMBER})\s?{_CURRENCY_SUFFIX})"
+)
+
+# An amount with or without currency marker ("Taxi 20")
+_AMOUNT_OR_NUMBER = rf"(?:{_AMOUNT}|(?P<bare>{_NUMBER}))"
+
+_PATTERNS = [
+    # Food: Pizza $15.99
+    ("category", re.compile(rf"^(?P<category>[A-Za-z/ ]+):\s*(?P<description>.+?)\s+{_AMOUNT_OR_NUMBER}$", re.I)),
+    # Spent $30 on gas / Paid $30 for gas
+    ("spent", re.compile(rf"^(?:spent|paid)\s+{_AMOUNT}\s+(?:on|for)\s+(?P<description>.+)$", re.I)),
+    # $20 for movie tickets
+    ("amount_for", re.compile(rf"^{_AMOUNT}\s+(?:for|on)\s+(?P<description>.+)$", re.I)),
+    # Bought bread for $100
+    ("bought", re.compile(rf"^(?:bought|paid for)\s+(?P<description>.+?)\s+for\s+{_AMOUNT}$", re.I)),
+    # Groceries $45.50 / Taxi 20 / Heladera 300 pesos
+    ("description_amount", re.compile(rf"^(?P<description>.+?)\s+{_AMOUNT_OR_NUMBER}$", re.I)),
+]
+
+_NUMBER_RE = re.compile(r"\d")
+
+# Separators of the expenses of a message that lists several ("coffee 5, taxi 20; lunch 12").
+# A comma only separates when a space follows, so "1,500" and "15,99" stay amounts.
+_ITEM_SEPARATOR = re.compile(r",\s+|;|\n")
+
+# Heuristic extraction of messages that don't follow the formats above
+_AMOUNT_RE = re.compile(_AMOUNT, re.I)
+_LEADING_VERB = re.compile(r"^(?:i\s+)?(?:spent|paid(?:\s+for)?|bought)\s+", re.I)
+_CONNECTOR = re.compile(r"^(?:on|for|at)\s+|\s+(?:on|for|at)$", re.I)
+
+PARSE_PATH_RULES = "rules"
+PARSE_PATH_CLASSIFIER = "classifier"
+PARSE_PATH_PREFILTER = "prefilter"
+PARSE_PATH_LLM = "llm"
+# Parsed with extract_expense_heuristically while the LLM is unavailable
+PARSE_PATH_DEGRADED = "degraded"
+
+_stats_lock = threading.Lock()
+_stats = {PARSE_PATH_RULES: 0, PARSE_PATH_CLASSIFIER: 0, PARSE_PATH_PREFILTER: 0, PARSE_PATH_LLM: 0, PARSE_PATH_DEGRADED: 0}
+
+def _to_number(amount_str):
+    """
+    Convert an amount string like "1,234.50" or "15,99" to a float
+    """
+    if re.fullmatch(r"\d+,\d{1,2}", amount_str):
+        # Decimal comma ("15,99")
+        return float(amount_str.replace(",", "."))
+    return float(amount_str.replace(",", ""))
+
+def canonical_category(name):
+    """
+    Map a user supplied category name to one of EXPENSE_CATEGORIES, or None if unknown
+    """
+    key = name.strip().lower()
+    for category in EXPENSE_CATEGORIES:
+        if category.lower() == key:
+            return category
+    return CATEGORY_ALIASES.get(key)
+
+def infer_category(description):
+    """
+    Infer the category of an expense from keywords in its description.
+    Returns None when no keyword matches or several categories do.
+    """
+    text = f" {re.sub(r'[^a-z0-9 ]', ' ', description.lower())} "
+    matches = {
+        category
+        for category, keywords in CATEGORY_KEYWORDS.items()
+        if any(f" {keyword} " in text for keyword in keywords)
+    }
+    if len(matches) == 1:
+        return matches.pop()
+    return None
+
+def extract_expense_with_rules(message):
+    """
+    Extract the description and amount of an expense using the documented message formats,
+    even when its category can't be inferred from keywords.
+
+    Returns a dictionary with the description, amount, category (None if unknown),
+    category_given (the category was written in the message) and currency_given (the amount
+    was written with a currency), or None if no format matches.
+    """
+    text = " ".join(message.split())
+    if not text or not _NUMBER_RE.search(text):
+        return None
+
+    for name, pattern in _PATTERNS:
+        match = pattern.match(text)
+        if not match:
+            continue
+
+        groups = match.groupdict()
+        amount_str = groups.get("prefixed") or groups.get("suffixed") or groups.get("bare")
+        description = groups["description"].strip(" .,:-")
+
+        # More than one number left in the description is ambiguous ("2 coffees 10")
+        if not description or _NUMBER_RE.search(description):
+            return None
+
+        amount = _to_number(amount_str)
+        if amount <= 0:
+            return None
+
+        if name == "category":
+            category = canonical_category(groups["category"])
+        else:
+            category = infer_category(description)
+
+        return {
+            "description": description,
+            "amount": amount,
+            "category": category,
+            "category_given": name == "category" and category is not None,
+            "currency_given": not groups.get("bare")
+        }
+
+    return None
+
+def split_expense_items(message):
+    """
+    Split a message that may list several expenses into the text of each one
+    """
+    return [item.strip() for item in _ITEM_SEPARATOR.split(message) if item.strip()]
+
+def extract_expense_heuristically(message):
+    """
+    Extract an expense from a message that doesn't follow the documented formats
+    ("I spent $12 on lunch with Ana"): the first amount written with a currency, and the
+    rest of the message as description. Bare numbers are not trusted.
+
+    Returns a dictionary like extract_expense_with_rules, or None if there is no such amount
+    """
+    text = " ".join(message.split())
+    match = _AMOUNT_RE.search(text)
+    if not match:
+        return None
+    amount = _to_number(match.group("prefixed") or match.group("suffixed"))
+    if amount <= 0:
+        return None
+
+    description = " ".join(f"{text[:match.start()]} {text[match.end():]}".split()).strip(" .,:-")
+    description = _CONNECTOR.sub("", _LEADING_VERB.sub("", description)).strip(" .,:-")
+    return {
+        "description": description or "Expense",
+        "amount": amount,
+        "category": infer_category(description),
+        "category_given": False,
+        "currency_given": True
+    }
+
+def record_parse_path(path):
+    """
+    Record which path (rules, classifier, prefilter, llm or degraded) handled a message
+    """
+    with _stats_lock:
+        _stats[path] = _stats.get(path, 0) + 1
+
+def get_parse_stats():
+    """
+    Get the number of messages handled by each parse path and the rules hit rate
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    total = sum(stats.values())
+    stats["total"] = total
+    stats["rules_hit_rate"] = stats[PARSE_PATH_RULES] / total if total else 0.0
+    return stats
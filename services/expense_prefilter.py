@@ -0,0 +1,91 @@
+import random
+import re
+from services.metrics import metrics
+from config.logging_config import get_logger, debug_sample
+from config.settings import PREFILTER_MODE, PREFILTER_SHADOW_SAMPLE_RATE
+
+logger = get_logger(__name__)
+
+PREFILTER_OFF = "off"
+PREFILTER_SHADOW = "shadow"
+PREFILTER_ON = "on"
+
+# Reasons a message is obviously not an expense
+REASON_NO_TEXT = "no_text"
+REASON_NO_NUMBER = "no_number"
+REASON_CHAT = "chat"
+
+# Numbers written as words, in English and Spanish ("Coffee five dollars", "Taxi veinte")
+NUMBER_WORDS = {
+    "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten",
+    "eleven", "twelve", "thirteen", "fourteen", "fifteen", "sixteen", "seventeen", "eighteen",
+    "nineteen", "twenty", "thirty", "forty", "fifty", "sixty", "seventy", "eighty", "ninety",
+    "hundred", "thousand", "million", "dozen", "half",
+    "uno", "una", "dos", "tres", "cuatro", "cinco", "seis", "siete", "ocho", "nueve", "diez",
+    "once", "doce", "trece", "catorce", "quince", "dieciseis", "dieciséis", "veinte", "treinta",
+    "cuarenta", "cincuenta", "sesenta", "setenta", "ochenta", "noventa", "cien", "ciento",
+    "doscientos", "trescientos", "quinientos", "mil", "millon", "millón", "medio", "media",
+}
+
+# Words of chat messages that never describe an expense ("thanks!", "ok 👍", "hola")
+CHAT_WORDS = {
+    "hi", "hello", "hey", "hola", "buenas", "buenos", "buen", "dia", "día", "dias", "días",
+    "tardes", "noches", "good", "morning", "afternoon", "evening", "night",
+    "thanks", "thank", "thx", "ty", "you", "gracias", "muchas", "much", "so", "very",
+    "ok", "okay", "oki", "okey", "k", "yes", "yeah", "yep", "no", "nope", "si", "sí",
+    "bye", "chau", "adios", "adiós", "see", "later", "lol", "haha", "jaja", "jajaja", "jeje",
+    "great", "nice", "cool", "perfect", "perfecto", "genial", "dale", "bien", "bueno", "listo",
+    "please", "por", "favor", "de", "nada", "welcome", "the", "a", "and", "y",
+}
+
+# Currency markers: a message with one may be an expense whatever its words
+_CURRENCY_RE = re.compile(r"[$€£¥]|\b(?:usd|ars|eur|pesos?|dollars?|euros?|bucks)\b", re.I)
+_WORD_RE = re.compile(r"[^\W_]+")
+_DIGIT_RE = re.compile(r"\d")
+
+def prefilter_reason(message):
+    """
+    Check if a message is obviously not an expense, without calling the LLM.
+    Returns the reason (REASON_*), or None if the message may be an expense.
+    """
+    words = _WORD_RE.findall(message.lower())
+    # Stickers, emojis and punctuation only
+    if not words:
+        return REASON_NO_TEXT
+    has_currency = bool(_CURRENCY_RE.search(message))
+    has_number = bool(_DIGIT_RE.search(message)) or any(word in NUMBER_WORDS for word in words)
+    if not has_number and not has_currency:
+        return REASON_NO_NUMBER
+    # A number with only chat words around it ("ok 2", "thanks x100") describes nothing
+    if not has_currency:
+        text_words = [word for word in words if not _DIGIT_RE.search(word) and word not in NUMBER_WORDS]
+        if text_words and all(word in CHAT_WORDS for word in text_words):
+            return REASON_CHAT
+    return None
+
+def check_message(message):
+    """
+    Run the pre-filter on a message the local parsers couldn't parse.
+
+    Returns a tuple (reason, skip_llm): reason is why the message is obviously not an expense
+    (None if it may be one), and skip_llm is False in shadow mode and for the sample of
+    filtered messages still sent to the LLM to measure the false negatives of the pre-filter.
+    """
+    if PREFILTER_MODE == PREFILTER_OFF:
+        return None, False
+    reason = prefilter_reason(message)
+    if not reason:
+        return None, False
+    shadow = PREFILTER_MODE == PREFILTER_SHADOW or random.random() < PREFILTER_SHADOW_SAMPLE_RATE
+    metrics.increment("bot_prefilter_total", reason=reason, mode=PREFILTER_SHADOW if shadow else PREFILTER_ON)
+    return reason, not shadow
+
+def record_shadow_result(reason, message, expense_data):
+    """
+    Compare the pre-filter decision with the LLM result of a filtered message
+    """
+    result = "false_negative" if expense_data else "agreed"
+    metrics.increment("bot_prefilter_shadow_checks_total", reason=reason, result=result)
+    if expense_data:
+        logger.info("Pre-filter false negative (%s)", reason)
+        debug_sample(logger, "Pre-filter false negative", reason=reason, text=message)
@@ -0,0 +1,195 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from models.expense import Expense
+from config.logging_config import get_logger
+from storage.sqlite_store import SQLiteStore
+
+logger = get_logger(__name__)
+
+# Tables of the write-behind queue file
+SCHEMA = [
+    """
+        CREATE TABLE IF NOT EXISTS pending_expenses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            claimed_by TEXT,
+            claimed_at REAL
+        )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_pending_expenses_user ON pending_expenses (user_id)"
+]
+
+class ExpenseWriteQueue:
+    """
+    Durable local queue of expenses waiting to be written to the database.
+
+    Expenses are stored in a SQLite file shared by all the workers on the host, and a
+    background thread in each worker flushes them in batches with retry and backoff.
+    Rows are claimed before being flushed, so two workers never send the same batch.
+    Delivery is at-least-once: a worker that dies after the insert but before deleting
+    its batch leaves it to be retried once its claim expires.
+    """
+    def __init__(self, path, flush_batch, batch_size=100, flush_interval=1.0,
+                 max_backoff=60, claim_timeout=120):
+        self.path = path
+        # Function that saves a list of Expense objects and returns the created ones
+        self.flush_batch = flush_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.claim_timeout = claim_timeout
+        self.flushed = 0
+        self.failures = 0
+        self._store = SQLiteStore(path, SCHEMA, timeout=5)
+        self._wakeup = threading.Event()
+        self._flusher = None
+        self._flusher_pid = None
+        self._start_lock = threading.Lock()
+
+    def enqueue(self, expenses):
+        """
+        Add expenses to the queue. They are durable once this returns.
+        """
+        conn = self._store.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO pending_expenses (user_id, payload) VALUES (?, ?)",
+                [(str(expense.user_id), json.dumps(expense.to_dict())) for expense in expenses]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        self._ensure_flusher()
+        if self.pending_count() >= self.batch_size:
+            self._wakeup.set()
+
+    def get_pending(self, user_id, since=None):
+        """
+        Get the expenses of a user that are still waiting to be written
+        """
+        self._ensure_flusher()
+        rows = self._store.connect().execute(
+            "SELECT payload FROM pending_expenses WHERE user_id = ?", (str(user_id),)
+        ).fetchall()
+        expenses = [Expense.from_dict(json.loads(payload)) for (payload,) in rows]
+        if since is not None:
+            expenses = [expense for expense in expenses if expense.added_at and expense.added_at >= since]
+        return expenses
+
+    def pending_count(self):
+        """
+        Get the number of expenses waiting to be written
+        """
+        return self._store.connect().execute("SELECT COUNT(*) FROM pending_expenses").fetchone()[0]
+
+    def _claim(self):
+        """
+        Claim the next batch of expenses that are due for a write attempt
+        """
+        now = time.time()
+        claimer = f"{os.getpid()}:{threading.get_ident()}"
+        conn = self._store.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "UPDATE pending_expenses SET claimed_by = ?, claimed_at = ? WHERE id IN ("
+                "  SELECT id FROM pending_expenses"
+                "  WHERE next_attempt_at <= ? AND (claimed_by IS NULL OR claimed_at < ?)"
+                "  ORDER BY id LIMIT ?"
+                ")",
+                (claimer, now, now, now - self.claim_timeout, self.batch_size)
+            )
+            rows = conn.execute(
+                "SELECT id, payload, attempts FROM pending_expenses WHERE claimed_by = ? AND claimed_at = ?",
+                (claimer, now)
+            ).fetchall()
+            conn.execute("COMMIT")
+            return rows
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def flush(self):
+        """
+        Write one batch of due expenses to the database.
+        Returns the number of expenses written.
+        """
+        rows = self._claim()
+        if not rows:
+            return 0
+
+        ids = [row[0] for row in rows]
+        placeholders = ",".join("?" * len(ids))
+        expenses = [Expense.from_dict(json.loads(row[1])) for row in rows]
+
+        try:
+            created = self.flush_batch(expenses)
+            if len(created) != len(expenses):
+                raise Exception(f"only {len(created)} of {len(expenses)} expenses were created")
+        except Exception as e:
+            # Release the claim and retry later with exponential backoff
+            self.failures += 1
+            attempts = max(row[2] for row in rows) + 1
+            backoff = min(self.max_backoff, 2 ** attempts)
+            logger.error(
+                "Error flushing %d queued expenses (attempt %d, retry in %ss): %s",
+                len(expenses), attempts, backoff, e
+            )
+            self._store.connect().execute(
+                f"UPDATE pending_expenses SET attempts = ?, next_attempt_at = ?, claimed_by = NULL "
+                f"WHERE id IN ({placeholders})",
+                [attempts, time.time() + backoff] + ids
+            )
+            return 0
+
+        self._store.connect().execute(f"DELETE FROM pending_expenses WHERE id IN ({placeholders})", ids)
+        self.flushed += len(expenses)
+        logger.debug("Flushed %d queued expenses", len(expenses))
+        return len(expenses)
+
+    def _run_flusher(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                # Keep flushing while there are full batches
+                while self.flush() == self.batch_size:
+                    pass
+            except Exception as e:
+                logger.error("Error in expense queue flusher: %s", e)
+
+    def _ensure_flusher(self):
+        """
+        Start the background flusher of this process if it's not running.
+        Started lazily so it runs in each forked worker, not in the gunicorn master.
+        """
+        if self._flusher is not None and self._flusher_pid == os.getpid() and self._flusher.is_alive():
+            return
+        with self._start_lock:
+            if self._flusher is not None and self._flusher_pid == os.getpid() and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._run_flusher, name="expense-queue-flusher", daemon=True)
+            self._flusher_pid = os.getpid()
+            self._flusher.start()
+
+    def start(self):
+        """
+        Start flushing expenses left in the queue by a previous run
+        """
+        self._ensure_flusher()
+
+    def stats(self):
+        """
+        Get the queue length and flush counters of this process
+        """
+        return {"pending": self.pending_count(), "flushed": self.flushed, "failures": self.failures}
@@ -0,0 +1,349 @@
+import time
+from datetime import datetime, timedelta
+from repositories.expense_repository import ExpenseRepository, REPORT_FUNCTION
+from services.expense_queue import ExpenseWriteQueue
+from services.spend_aggregates import SpendAggregates, summarize_expenses
+from services.report_cache import ReportCache
+from services.circuit_breaker import is_outage
+from config.flow import run, local
+from services.metrics import metrics
+from config.settings import (
+    WRITE_BEHIND_ENABLED, WRITE_BEHIND_QUEUE_PATH, WRITE_BEHIND_BATCH_SIZE,
+    WRITE_BEHIND_FLUSH_INTERVAL, WRITE_BEHIND_MAX_BACKOFF,
+    AGGREGATES_ENABLED, AGGREGATES_PATH, AGGREGATES_BUCKET_SECONDS,
+    AGGREGATES_RETENTION_DAYS, AGGREGATES_RESEED_INTERVAL, REPORT_RPC_ENABLED,
+    REPORT_RPC_MAX_ERRORS, REPORT_RPC_BACKOFF,
+    REPORT_CACHE_ENABLED, REPORT_CACHE_PATH, REPORT_CACHE_TTL
+)
+from config.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Columns listed in the daily report
+REPORT_COLUMNS = ["description", "amount", "category", "added_at"]
+
+def create_write_queue(expense_repository):
+    """
+    Create the write-behind queue if it's enabled, flushing through the given repository.
+    The flusher is a thread, so it writes with the blocking client.
+    """
+    if not WRITE_BEHIND_ENABLED:
+        return None
+    write_queue = ExpenseWriteQueue(
+        WRITE_BEHIND_QUEUE_PATH,
+        flush_batch=lambda expenses: run(expense_repository.create_many(expenses)),
+        batch_size=WRITE_BEHIND_BATCH_SIZE,
+        flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+        max_backoff=WRITE_BEHIND_MAX_BACKOFF
+    )
+    # The flusher thread starts on first use, or from the gunicorn post_fork hook, so it
+    # never runs in the gunicorn master when the app is preloaded
+    return write_queue
+
+def create_aggregates():
+    """
+    Create the rolling spend aggregates if they're enabled
+    """
+    if not AGGREGATES_ENABLED:
+        return None
+    return SpendAggregates(
+        AGGREGATES_PATH,
+        bucket_seconds=AGGREGATES_BUCKET_SECONDS,
+        retention_days=AGGREGATES_RETENTION_DAYS,
+        reseed_interval=AGGREGATES_RESEED_INTERVAL
+    )
+
+def create_report_cache():
+    """
+    Create the cache of rendered daily reports if it's enabled
+    """
+    if not REPORT_CACHE_ENABLED:
+        return None
+    return ReportCache(REPORT_CACHE_PATH, ttl=REPORT_CACHE_TTL)
+
+def _identity(expense):
+    added_at = expense.added_at.replace(tzinfo=None) if isinstance(expense.added_at, datetime) else expense.added_at
+    return (expense.description, expense.amount_cents, expense.category, added_at)
+
+def unstored_pending(expenses, pending):
+    """
+    Get the pending (not yet written) expenses of a user that are not among their expenses
+    read from the database. An expense flushed between both reads shows up in both.
+    """
+    stored = {_identity(expense) for expense in expenses}
+    return [expense for expense in pending if _identity(expense) not in stored]
+
+def merge_pending(expenses, pending):
+    """
+    Add pending (not yet written) expenses to the expenses read from the database
+    """
+    if not pending:
+        return expenses
+
+    merged = expenses + unstored_pending(expenses, pending)
+    merged.sort(key=lambda expense: expense.added_at.replace(tzinfo=None), reverse=True)
+    return merged
+
+def merge_pending_report(expenses, totals, pending, max_rows):
+    """
+    Add pending expenses to a daily report read from the database, to its most recent
+    expenses and to its totals. Pending expenses flushed since they were read are among
+    the most recent stored expenses, so they are found there and skipped.
+    """
+    unstored = unstored_pending(expenses, pending)
+    if not unstored:
+        return expenses, totals
+
+    added = summarize_expenses(unstored)
+    categories = dict(totals["categories"])
+    for category, amount in added["categories"].items():
+        categories[category] = round(categories.get(category, 0.0) + amount, 2)
+    totals = {
+        "total": round(totals["total"] + added["total"], 2),
+        "count": totals["count"] + added["count"],
+        "categories": categories
+    }
+    return merge_pending(expenses, unstored)[:max_rows], totals
+
+class ReportRPCSwitch:
+    """
+    Decides if daily reports use the report database function. It's turned off for good
+    when the function is missing, and for `backoff` seconds after `max_errors` consecutive
+    errors that are not outages: a function that doesn't match the schema fails every call,
+    and each report would pay for it on top of the separate queries.
+    """
+    def __init__(self, enabled, max_errors=3, backoff=600):
+        self.enabled = enabled
+        self.max_errors = max_errors
+        self.backoff = backoff
+        self.errors = 0
+        self.disabled_until = 0
+
+    def available(self):
+        """
+        Check if the next report should call the function
+        """
+        return self.enabled and time.monotonic() >= self.disabled_until
+
+    def succeeded(self):
+        self.errors = 0
+
+    def failed(self, error):
+        """
+        Log a failed call of the report database function
+        """
+        metrics.increment("bot_report_queries_total", result="error")
+        message = str(error)
+        if "PGRST202" in message or "Could not find the function" in message:
+            logger.warning(
+                "The %s database function is missing (see storage/supabase_functions.sql), "
+                "daily reports use separate queries", REPORT_FUNCTION
+            )
+            self.enabled = False
+            return
+        logger.error("Error getting the daily report with %s: %s", REPORT_FUNCTION, error)
+        # Outages fail the separate queries too, the circuit breaker handles them
+        if is_outage(error):
+            return
+        self.errors += 1
+        if self.errors >= self.max_errors:
+            logger.warning(
+                "The %s database function failed %d times in a row, daily reports use separate "
+                "queries for %d seconds", REPORT_FUNCTION, self.errors, self.backoff
+            )
+            self.errors = 0
+            self.disabled_until = time.monotonic() + self.backoff
+
+class ExpenseService:
+    """
+    Service for expense operations. When WRITE_BEHIND_ENABLED is set, new expenses
+    are queued locally and written to the database in the background.
+
+    The methods that read or write are flows (see config.flow): the write-behind queue,
+    the aggregates and the report cache are local SQLite files, called through local().
+    """
+    def __init__(self):
+        self.expense_repository = ExpenseRepository()
+        self.write_queue = create_write_queue(self.expense_repository)
+        self.aggregates = create_aggregates()
+        self.report_cache = create_report_cache()
+        self.report_rpc = ReportRPCSwitch(REPORT_RPC_ENABLED, REPORT_RPC_MAX_ERRORS, REPORT_RPC_BACKOFF)
+
+    def create(self, expense):
+        """
+        Create a new expense
+        """
+        if self.write_queue:
+            yield local(self.write_queue.enqueue, [expense])
+            created = expense
+        else:
+            created = yield from self.expense_repository.create(expense)
+
+        if created:
+            yield from self._add_to_aggregates([expense])
+            yield from self._invalidate_reports([expense])
+        return created
+
+    def create_many(self, expenses):
+        """
+        Create several expenses with a single bulk insert
+        """
+        if self.write_queue:
+            yield local(self.write_queue.enqueue, expenses)
+            created = expenses
+        else:
+            created = yield from self.expense_repository.create_many(expenses)
+
+        if created:
+            yield from self._add_to_aggregates(created)
+            yield from self._invalidate_reports(created)
+        return created
+
+    def _get_pending(self, user_id, since):
+        if not self.write_queue:
+            return []
+        return (yield local(self.write_queue.get_pending, user_id, since))
+
+    def get_expenses_since(self, user_id, since, columns="*", raise_errors=False):
+        """
+        Get all expenses for a user added since the given datetime, including pending writes
+        """
+        # Read the queue first: an expense flushed in between is then seen twice, not missed
+        pending = yield from self._get_pending(user_id, since)
+        expenses = yield from self.expense_repository.get_expenses_since(user_id, since, columns, raise_errors)
+        return merge_pending(expenses, pending)
+
+    def get_expense_batch_since(self, user_id, since, raise_errors=False):
+        """
+        Get the amounts, categories and times of a user's expenses since the given datetime,
+        column-wise, including pending writes
+        """
+        pending = yield from self._get_pending(user_id, since)
+        batch = yield from self.expense_repository.get_expense_batch_since(user_id, since, raise_errors)
+        if pending:
+            batch.merge(pending)
+        return batch
+
+    def get_history(self, user_id, since=None, until=None, categories=None, columns=None, limit=50, cursor=None):
+        """
+        Get a page of a user's stored expenses, newest first.
+        Expenses waiting in the write-behind queue show up once they're written.
+
+        Returns a tuple (expenses, next_cursor)
+        """
+        return (yield from self.expense_repository.get_history(user_id, since, until, categories, columns, limit, cursor))
+
+    def history_pages(self, user_id, since=None, until=None, categories=None, columns=None, page_size=500):
+        """
+        Get the next_page(cursor) flow of config.flow.pages/pages_async, to iterate over a
+        user's stored expenses page by page, newest first, with keyset pagination: each page
+        is read when the previous one has been used
+        """
+        def next_page(cursor):
+            return self.expense_repository.get_history(user_id, since, until, categories, columns, page_size, cursor)
+        return next_page
+
+    def get_recent_expenses(self, user_id, since, limit):
+        """
+        Get the `limit` most recent expenses of a user since a datetime, including pending writes
+        """
+        pending = yield from self._get_pending(user_id, since)
+        expenses, _ = yield from self.expense_repository.get_history(user_id, since=since, columns=REPORT_COLUMNS, limit=limit)
+        return merge_pending(expenses, pending)[:limit]
+
+    def get_daily_report(self, user_id, max_rows):
+        """
+        Get the `max_rows` most recent expenses of a user from the last 24 hours and the
+        totals of all of them. The totals only need another source when some expenses are
+        left out: the rolling aggregates when they're enabled, else a read of the day's rows.
+        """
+        since = datetime.now() - timedelta(days=1)
+        expenses = yield from self.get_recent_expenses(user_id, since, max_rows)
+        if len(expenses) < max_rows:
+            return expenses, summarize_expenses(expenses)
+        if self.aggregates:
+            return expenses, (yield from self._get_aggregate_totals(user_id, since))
+        batch = yield from self.get_expense_batch_since(user_id, since, raise_errors=True)
+        return expenses, batch.summary()
+
+    def get_daily_report_by_telegram_id(self, telegram_id, max_rows, user_id=None):
+        """
+        Get the daily report of a user by Telegram ID with a single database round trip.
+
+        Returns a tuple (user_id, expenses, totals), user_id being None for unregistered users,
+        or None when the report needs separate queries: the report function is disabled or
+        failed, or there are pending writes to merge and the user's ID isn't known (they are
+        read by user ID, before the database)
+        """
+        if not self.report_rpc.available():
+            metrics.increment("bot_report_queries_total", result="disabled")
+            return None
+        if self.write_queue and user_id is None:
+            metrics.increment("bot_report_queries_total", result="unknown_user")
+            return None
+
+        since = datetime.now() - timedelta(days=1)
+        pending = yield from self._get_pending(user_id, since)
+        try:
+            user_id, expenses, totals = yield from self.expense_repository.get_report_by_telegram_id(telegram_id, since, max_rows)
+        except Exception as e:
+            self.report_rpc.failed(e)
+            return None
+        self.report_rpc.succeeded()
+        metrics.increment("bot_report_queries_total", result="rpc")
+
+        if pending and user_id is not None:
+            expenses, totals = merge_pending_report(expenses, totals, pending, max_rows)
+        return user_id, expenses, totals
+
+    def get_cached_report(self, telegram_id):
+        """
+        Get the cached daily report of a user by Telegram ID as a tuple
+        (user_id, report, totals), or None
+        """
+        if not self.report_cache:
+            return None
+        return (yield local(self.report_cache.get, telegram_id))
+
+    def cache_report(self, telegram_id, user_id, report, expenses, totals, read_at):
+        """
+        Cache the rendered daily report of a user, read from the database at read_at
+        """
+        if self.report_cache:
+            yield local(self.report_cache.set, telegram_id, user_id, report, expenses, totals, read_at)
+
+    def get_window_totals(self, user_id, days):
+        """
+        Get a user's total and per-category spend over the last `days` days.
+        Served from the rolling aggregates when they're enabled.
+        """
+        since = datetime.now() - timedelta(days=days)
+        if not self.aggregates:
+            batch = yield from self.get_expense_batch_since(user_id, since)
+            return batch.summary()
+        return (yield from self._get_aggregate_totals(user_id, since))
+
+    def _get_aggregate_totals(self, user_id, since):
+        """
+        Get a user's totals since a datetime from the aggregates, seeding them first if needed
+        """
+        if (yield local(self.aggregates.needs_seed, user_id)):
+            loaded_at = time.time()
+            retention_start = datetime.now() - timedelta(days=AGGREGATES_RETENTION_DAYS)
+            expenses = yield from self.get_expense_batch_since(user_id, retention_start, raise_errors=True)
+            yield local(self.aggregates.seed, user_id, expenses, loaded_at)
+            logger.debug("Seeded spend aggregates of user %s from %d expenses", user_id, len(expenses))
+
+        return (yield local(self.aggregates.totals, user_id, since))
+
+    def _add_to_aggregates(self, expenses):
+        if not self.aggregates:
+            return
+        try:
+            yield local(self.aggregates.add, expenses)
+        except Exception as e:
+            logger.error("Error updating spend aggregates: %s", e)
+
+    def _invalidate_reports(self, expenses):
+        if self.report_cache:
+            yield local(self.report_cache.invalidate, [expense.user_id for expense in expenses])
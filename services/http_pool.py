@@ -0,0 +1,71 @@
+"""
+Shared HTTP connection pools of the external dependencies (Supabase and OpenAI).
+
+Each dependency has its own pool, so a slow one can't take the connections of the other,
+with a bounded size, keep-alive connections reused across requests and explicit timeouts.
+The pools are created on first use, once per worker process.
+"""
+from config.lazy import LazySingleton
+from config.settings import (
+    HTTP_POOL_SIZE, HTTP_KEEPALIVE_CONNECTIONS, HTTP_KEEPALIVE_EXPIRY, HTTP_CONNECT_TIMEOUT,
+    DATABASE_TIMEOUT, OPENAI_TIMEOUT
+)
+
+DATABASE = "database"
+OPENAI = "openai"
+
+# Read/write/pool timeout of the requests to each dependency, in seconds
+TIMEOUTS = {
+    DATABASE: DATABASE_TIMEOUT,
+    OPENAI: OPENAI_TIMEOUT
+}
+
+def create_timeout(dependency):
+    """
+    Create the httpx timeout of a dependency
+    """
+    import httpx
+    return httpx.Timeout(TIMEOUTS[dependency], connect=HTTP_CONNECT_TIMEOUT)
+
+def _limits():
+    import httpx
+    return httpx.Limits(
+        max_connections=HTTP_POOL_SIZE,
+        max_keepalive_connections=HTTP_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    )
+
+def create_http_client(dependency):
+    """
+    Create the pooled HTTP client of a dependency
+    """
+    import httpx
+    return httpx.Client(timeout=create_timeout(dependency), limits=_limits())
+
+def create_async_http_client(dependency):
+    """
+    Create the pooled async HTTP client of a dependency (used by the ASGI app)
+    """
+    import httpx
+    return httpx.AsyncClient(timeout=create_timeout(dependency), limits=_limits())
+
+_clients = {
+    dependency: LazySingleton(lambda dependency=dependency: create_http_client(dependency))
+    for dependency in TIMEOUTS
+}
+_async_clients = {
+    dependency: LazySingleton(lambda dependency=dependency: create_async_http_client(dependency))
+    for dependency in TIMEOUTS
+}
+
+def get_http_client(dependency):
+    """
+    Get the shared HTTP client of a dependency ("database" or "openai")
+    """
+    return _clients[dependency].get()
+
+def get_async_http_client(dependency):
+    """
+    Get the shared async HTTP client of a dependency ("database" or "openai")
+    """
+    return _async_clients[dependency].get()
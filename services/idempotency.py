@@ -0,0 +1,174 @@
+import json
+import sqlite3
+import threading
+import time
+from config.flow import local, sleep
+from services.metrics import metrics
+from config.logging_config import get_logger
+from storage.sqlite_store import SQLiteStore
+
+logger = get_logger(__name__)
+
+# Outcomes of IdempotencyStore.claim
+CLAIMED = "claimed"
+DONE = "done"
+PENDING = "pending"
+
+class IdempotencyTimeout(Exception):
+    """
+    Raised when a request waited too long for the request with the same key to finish
+    """
+
+def is_storable(status):
+    """
+    Check if a response can be replayed: errors of the service and rate limit rejections
+    are not stored, so a retry processes the message again
+    """
+    return status < 500 and status != 429
+
+# Tables of the idempotency store file
+SCHEMA = [
+    """
+        CREATE TABLE IF NOT EXISTS idempotent_requests (
+            key TEXT PRIMARY KEY,
+            response TEXT,
+            status INTEGER,
+            claimed_at REAL NOT NULL,
+            expires_at REAL
+        )
+    """
+]
+
+class IdempotencyStore:
+    """
+    Short-lived store of the responses of processed requests, by idempotency key, shared
+    by all the workers on the host through a local SQLite database.
+
+    The first request with a key claims it and stores its response when it's done; a request
+    with the same key gets the stored response, or waits for it while the first one runs.
+    A claim older than pending_timeout (its worker died) can be taken over.
+    """
+    # Remove the expired responses every N claims
+    PURGE_INTERVAL = 1000
+
+    def __init__(self, path, ttl=600, wait_timeout=60, pending_timeout=120, poll_interval=0.05):
+        self.path = path
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.pending_timeout = pending_timeout
+        self.poll_interval = poll_interval
+        self._claims = 0
+        self._store = SQLiteStore(path, SCHEMA, timeout=5, synchronous="NORMAL")
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        """
+        Claim a key. Returns (CLAIMED, None) if the caller must process the request,
+        (DONE, (response, status)) if it was processed, or (PENDING, None) if it's running.
+        """
+        conn = self._store.connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT response, status, claimed_at, expires_at FROM idempotent_requests WHERE key = ?", (key,)
+            ).fetchone()
+            outcome = None
+            if row is not None:
+                response, status, claimed_at, expires_at = row
+                if status is not None and expires_at > now:
+                    outcome = DONE, (json.loads(response), status)
+                elif status is None and now - claimed_at < self.pending_timeout:
+                    outcome = PENDING, None
+            if outcome is None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO idempotent_requests (key, response, status, claimed_at, expires_at) "
+                    "VALUES (?, NULL, NULL, ?, NULL)",
+                    (key, now)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if outcome is not None:
+            return outcome
+
+        with self._lock:
+            self._claims += 1
+            purge = self._claims % self.PURGE_INTERVAL == 0
+        if purge:
+            self.purge()
+        return CLAIMED, None
+
+    def complete(self, key, response, status):
+        """
+        Store the response of a claimed key, or release the key if the response can't be replayed
+        """
+        if not is_storable(status):
+            self.release(key)
+            return
+        now = time.time()
+        self._store.connect().execute(
+            "UPDATE idempotent_requests SET response = ?, status = ?, expires_at = ? WHERE key = ?",
+            (json.dumps(response), status, now + self.ttl, key)
+        )
+
+    def release(self, key):
+        """
+        Drop the claim of a key whose request failed, so a retry processes it again
+        """
+        self._store.connect().execute("DELETE FROM idempotent_requests WHERE key = ? AND status IS NULL", (key,))
+
+    def purge(self):
+        """
+        Remove the expired responses and the abandoned claims
+        """
+        now = time.time()
+        self._store.connect().execute(
+            "DELETE FROM idempotent_requests WHERE expires_at < ? OR (status IS NULL AND claimed_at < ?)",
+            (now, now - self.pending_timeout)
+        )
+
+    def run(self, key, flow, wait_timeout=None):
+        """
+        Process a request once per key, a flow (see config.flow) that returns
+        (response, status, replayed) and runs `flow` -> (response, status) only if no request
+        with the same key was processed. wait_timeout replaces the store's for this request.
+        Raises IdempotencyTimeout if the request with the same key doesn't finish in time.
+        """
+        deadline = time.monotonic() + (self.wait_timeout if wait_timeout is None else wait_timeout)
+        waited = False
+        while True:
+            try:
+                state, stored = yield local(self.claim, key)
+            except sqlite3.Error as e:
+                logger.error("Error reading the idempotency store, processing the request: %s", e)
+                metrics.increment("bot_idempotency_requests_total", result="error")
+                return (yield from flow) + (False,)
+
+            if state == CLAIMED:
+                metrics.increment("bot_idempotency_requests_total", result="new")
+                try:
+                    response, status = yield from flow
+                except Exception:
+                    yield local(self._write, self.release, key)
+                    raise
+                yield local(self._write, self.complete, key, response, status)
+                return response, status, False
+            if state == DONE:
+                metrics.increment("bot_idempotency_requests_total", result="waited" if waited else "replayed")
+                return stored + (True,)
+            if time.monotonic() >= deadline:
+                metrics.increment("bot_idempotency_requests_total", result="timeout")
+                raise IdempotencyTimeout(f"The request with idempotency key {key} is still being processed")
+            waited = True
+            yield sleep(self.poll_interval)
+
+    def _write(self, method, *args):
+        """
+        Store or release a claim, a database error only loses the stored response
+        """
+        try:
+            method(*args)
+        except sqlite3.Error as e:
+            logger.error("Error writing the idempotency store: %s", e)
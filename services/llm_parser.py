@@ -0,0 +1,552 @@
+import json
+import time
+from prompts.expense_prompt import get_expense_prompt, EXPENSE_PROMPT_TEMPLATE
+from models.expense import parse_amount_cents
+from services.expense_parser import (
+    extract_expense_with_rules, extract_expense_heuristically, split_expense_items, record_parse_path, get_parse_stats,
+    canonical_category, PARSE_PATH_RULES, PARSE_PATH_CLASSIFIER, PARSE_PATH_PREFILTER, PARSE_PATH_LLM,
+    PARSE_PATH_DEGRADED
+)
+from services.expense_prefilter import check_message, record_shadow_result
+from services.category_classifier import CategoryClassifier
+from services.parse_cache import ParseCache, prompt_fingerprint, normalize_message
+from services.single_flight import SingleFlight
+from config.flow import io, register, run, local
+from services.circuit_breaker import CircuitOpenError, get_circuit_breaker, is_outage
+from services.http_pool import OPENAI, create_timeout, get_http_client, get_async_http_client
+from services.rate_limiter import RateLimiter, RateLimitExceeded
+from services.ttl_cache import MISSING
+from services.metrics import metrics
+from config.logging_config import get_logger, debug_sample
+from config.lazy import LazySingleton
+from config.settings import (
+    OPENAI_API_KEY, OPENAI_MODEL, OPENAI_MAX_RETRIES, LLM_FAST_MODEL, LLM_CONFIDENCE_THRESHOLD, EXPENSE_MAX_ITEMS,
+    PARSE_CACHE_ENABLED, PARSE_CACHE_PATH, PARSE_CACHE_MAX_ENTRIES,
+    SINGLE_FLIGHT_ENABLED, SINGLE_FLIGHT_TIMEOUT, SINGLE_FLIGHT_STATS_KEYS,
+    CATEGORY_MODEL_ENABLED, CATEGORY_MODEL_PATH, CATEGORY_MODEL_MIN_CONFIDENCE,
+    CATEGORY_MODEL_MIN_EXAMPLES, CATEGORY_MODEL_REFRESH_INTERVAL, CATEGORY_MODEL_MAX_OVERRIDES,
+    RATE_LIMIT_ENABLED, RATE_LIMIT_PATH, RATE_LIMIT_USER_PER_MINUTE, RATE_LIMIT_USER_BURST,
+    RATE_LIMIT_GLOBAL_PER_MINUTE, RATE_LIMIT_GLOBAL_BURST, LLM_MAX_CONCURRENCY, LLM_SLOT_TIMEOUT
+)
+
+logger = get_logger(__name__)
+
+FAST_TIER = "fast"
+STRONG_TIER = "strong"
+
+# Models of the cascade, in the order they are tried
+LLM_TIERS = [(FAST_TIER, LLM_FAST_MODEL)] if LLM_FAST_MODEL and LLM_FAST_MODEL != OPENAI_MODEL else []
+LLM_TIERS.append((STRONG_TIER, OPENAI_MODEL))
+LLM_TIER_NAMES = [tier for tier, _ in LLM_TIERS]
+
+# Reasons to escalate a message to the next model of the cascade
+ESCALATE_ERROR = "error"
+ESCALATE_INVALID_JSON = "invalid_json"
+ESCALATE_INVALID_AMOUNT = "invalid_amount"
+ESCALATE_INVALID_CATEGORY = "invalid_category"
+ESCALATE_LOW_CONFIDENCE = "low_confidence"
+
+# Returned by _review_tier_response when the next model must parse the message
+_ESCALATE = object()
+
+def create_llm(model):
+    """
+    Create an OpenAI chat model (importing Langchain and the OpenAI client). The models
+    of all the tiers share the OpenAI connection pool of the worker.
+    """
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(
+        model=model,
+        temperature=0,
+        api_key=OPENAI_API_KEY,
+        timeout=create_timeout(OPENAI),
+        max_retries=OPENAI_MAX_RETRIES,
+        http_client=get_http_client(OPENAI),
+        http_async_client=get_async_http_client(OPENAI)
+    )
+
+# Langchain components are created on first use, so workers start (and serve /help,
+# reports and rule-parsed expenses) without loading Langchain
+_llms = {tier: LazySingleton(lambda model=model: create_llm(model)) for tier, model in LLM_TIERS}
+_chains = {tier: LazySingleton(lambda tier=tier: get_expense_prompt() | get_llm(tier)) for tier in LLM_TIER_NAMES}
+
+def get_llm(tier=STRONG_TIER):
+    """
+    Get the chat model of a tier of the cascade
+    """
+    return _llms[tier].get()
+
+def get_chain(tier=STRONG_TIER):
+    """
+    Get the Langchain expense chain (prompt | model) of a tier of the cascade
+    """
+    return _chains[tier].get()
+
+def import_langchain():
+    """
+    Import Langchain and the OpenAI client without creating any client or connection.
+    The gunicorn master calls this so forked workers start with the modules loaded.
+    """
+    import langchain_openai
+    get_expense_prompt()
+
+def set_llm(model, tier=None):
+    """
+    Replace the chat model of a tier, or of all the tiers (the benchmarks plug in a stub model)
+    """
+    for name in ([tier] if tier else LLM_TIER_NAMES):
+        _llms[name].set(model)
+        _chains[name].set(get_expense_prompt() | model)
+
+# Cache of parse results, invalidated automatically when the prompt or model changes
+parse_cache = None
+if PARSE_CACHE_ENABLED:
+    parse_cache = ParseCache(
+        PARSE_CACHE_PATH,
+        prompt_fingerprint(EXPENSE_PROMPT_TEMPLATE, ",".join(model for _, model in LLM_TIERS)),
+        max_entries=PARSE_CACHE_MAX_ENTRIES
+    )
+
+# Identical messages parsed at the same time in this worker wait for one LLM call
+parse_flight = None
+if SINGLE_FLIGHT_ENABLED:
+    parse_flight = SingleFlight("llm_parse", timeout=SINGLE_FLIGHT_TIMEOUT, max_stats_keys=SINGLE_FLIGHT_STATS_KEYS)
+
+def get_single_flight_stats(limit=20):
+    """
+    Get the wait statistics of the coalesced LLM parses of this worker,
+    for the `limit` messages with the most waiting requests
+    """
+    if not parse_flight:
+        return {"enabled": False}
+    return {"enabled": True, **parse_flight.get_stats(limit)}
+
+# Admission control of the messages sent to the LLM, shared by the workers on the host
+rate_limiter = None
+if RATE_LIMIT_ENABLED:
+    rate_limiter = RateLimiter(
+        RATE_LIMIT_PATH,
+        user_rate=RATE_LIMIT_USER_PER_MINUTE / 60,
+        user_burst=RATE_LIMIT_USER_BURST,
+        global_rate=RATE_LIMIT_GLOBAL_PER_MINUTE / 60,
+        global_burst=RATE_LIMIT_GLOBAL_BURST,
+        max_concurrency=LLM_MAX_CONCURRENCY,
+        slot_timeout=LLM_SLOT_TIMEOUT
+    )
+
+def get_rate_limit_stats():
+    """
+    Get the state of the rate limits and of the LLM concurrency limit of the host
+    """
+    if not rate_limiter:
+        return {"enabled": False}
+    return rate_limiter.get_stats()
+
+# Calls to OpenAI fail fast while it's failing, and messages are parsed locally meanwhile
+llm_breaker = get_circuit_breaker(OPENAI)
+
+def _invoke_chain(tier, message):
+    return llm_breaker.call(get_chain(tier).invoke, {"message": message})
+
+def _ainvoke_chain(tier, message):
+    return llm_breaker.call_async(get_chain(tier).ainvoke, {"message": message})
+
+# The LLM call of a flow: Langchain's invoke in the WSGI app, its ainvoke in the ASGI app
+register("llm", _invoke_chain, _ainvoke_chain)
+
+class LLMUnavailableError(RuntimeError):
+    """
+    Raised when OpenAI can't parse a message because it's failing or its circuit breaker is open
+    """
+
+def create_category_classifier():
+    """
+    Create the local category classifier from the model file trained offline (or by the
+    first worker of the host), kept up to date with the expenses stored since
+    """
+    from repositories.expense_repository import ExpenseRepository
+    repository = ExpenseRepository()
+    classifier = CategoryClassifier(
+        load_expenses=lambda after_id, limit: run(repository.get_expenses_after(after_id, limit)),
+        min_confidence=CATEGORY_MODEL_MIN_CONFIDENCE,
+        min_examples=CATEGORY_MODEL_MIN_EXAMPLES,
+        refresh_interval=CATEGORY_MODEL_REFRESH_INTERVAL,
+        max_overrides=CATEGORY_MODEL_MAX_OVERRIDES,
+        model_path=CATEGORY_MODEL_PATH
+    )
+    classifier.load(CATEGORY_MODEL_PATH)
+    return classifier
+
+# Loaded on first use in each worker
+_category_classifier = LazySingleton(create_category_classifier)
+
+def get_category_classifier():
+    """
+    Get the local category classifier, or None if it's disabled
+    """
+    if not CATEGORY_MODEL_ENABLED:
+        return None
+    return _category_classifier.get()
+
+def _record_parse(parsed_by, expenses):
+    record_parse_path(parsed_by)
+    metrics.increment(
+        "bot_parsed_messages_total", parsed_by=parsed_by,
+        result="expense" if expenses else "not_expense"
+    )
+    if expenses:
+        metrics.increment("bot_parsed_expenses_total", len(expenses), parsed_by=parsed_by)
+    stats = get_parse_stats()
+    logger.debug("Message parsed by %s (rules hit rate: %.1f%% of %d)", parsed_by, stats['rules_hit_rate'] * 100, stats['total'])
+
+def parse_expenses(message, user_id=None):
+    """
+    Parse the expenses of a message: most messages have one, and a message that lists
+    several ("coffee 5, taxi 20, lunch 12") is parsed with a single LLM call. The rule-based
+    parser and the local category classifier handle most messages, the pre-filter drops
+    obvious non-expenses, and Langchain is only called for the rest.
+
+    A flow (see config.flow), returns a tuple (expenses, parsed_by): expenses is the list
+    of expense data, at most EXPENSE_MAX_ITEMS and empty if the message is not an expense,
+    and parsed_by is "rules", "classifier", "prefilter", "llm" or "degraded" (OpenAI is
+    unavailable, see parse_expense_degraded).
+    Raises RateLimitExceeded if the message needs the LLM and the user or the service is
+    over its rate limit.
+    """
+    expenses, parsed_by = parse_expenses_locally(message, user_id)
+    if not expenses:
+        prefilter_reason, skip_llm = check_message(message)
+        if skip_llm:
+            _record_parse(PARSE_PATH_PREFILTER, None)
+            return [], PARSE_PATH_PREFILTER
+        try:
+            expenses = apply_user_categories((yield from parse_expenses_with_langchain(message, user_id)), user_id)
+        except LLMUnavailableError as e:
+            logger.warning("Parsing the message without the LLM: %s", e)
+            expenses = parse_expenses_degraded(message, user_id)
+            parsed_by = PARSE_PATH_DEGRADED
+        else:
+            parsed_by = PARSE_PATH_LLM
+            if prefilter_reason:
+                record_shadow_result(prefilter_reason, message, expenses)
+
+    _record_parse(parsed_by, expenses)
+    return expenses, parsed_by
+
+def parse_expenses_locally(message, user_id=None):
+    """
+    Parse the expenses of a message without the LLM: the whole message as one expense,
+    or else each item of a message that lists several, when all of them can be parsed.
+
+    Returns a tuple (expenses, parsed_by), or ([], None) when the LLM must parse the message
+    """
+    expense_data, parsed_by = parse_expense_locally(message, user_id)
+    if expense_data:
+        return [expense_data], parsed_by
+
+    items = split_expense_items(message)
+    if len(items) < 2:
+        return [], None
+    parsed = [parse_expense_locally(item, user_id) for item in items[:EXPENSE_MAX_ITEMS]]
+    if not all(expense_data for expense_data, _ in parsed):
+        return [], None
+    paths = {parsed_by for _, parsed_by in parsed}
+    parsed_by = PARSE_PATH_CLASSIFIER if PARSE_PATH_CLASSIFIER in paths else PARSE_PATH_RULES
+    return [expense_data for expense_data, _ in parsed], parsed_by
+
+def parse_expense_locally(message, user_id=None):
+    """
+    Parse an expense without the LLM. The rules extract the description and amount, and
+    the category is, in order: the one written in the message, the one the user stored
+    last for the same description, the one of the keywords, or the local classifier's.
+    Bare numbers without a currency are only trusted for the first three ("Meeting at 5"
+    goes to the LLM).
+
+    Returns a tuple (expense_data, parsed_by), or (None, None) when the LLM must parse the message
+    """
+    with metrics.span("rules_parse"):
+        candidate = extract_expense_with_rules(message)
+    if not candidate:
+        return None, None
+    if candidate["category_given"]:
+        return _local_expense(candidate, candidate["category"]), PARSE_PATH_RULES
+
+    classifier = get_category_classifier()
+    if classifier:
+        with metrics.span("classify"):
+            category = classifier.user_category(candidate["description"], user_id)
+        if category:
+            metrics.increment("bot_category_classifier_requests_total", result="user")
+            return _local_expense(candidate, category), PARSE_PATH_CLASSIFIER
+
+    if candidate["category"]:
+        return _local_expense(candidate, candidate["category"]), PARSE_PATH_RULES
+
+    if classifier and candidate["currency_given"]:
+        with metrics.span("classify"):
+            category, _ = classifier.classify(candidate["description"])
+        metrics.increment("bot_category_classifier_requests_total", result="model" if category else "unsure")
+        if category:
+            return _local_expense(candidate, category), PARSE_PATH_CLASSIFIER
+    return None, None
+
+def parse_expense_degraded(message, user_id=None):
+    """
+    Parse an expense without the LLM while OpenAI is unavailable, instead of failing the
+    message: the amount and description of the rules, or else the first amount written with
+    a currency, and the category of the local parse or "Other".
+
+    Returns the expense data, or None if the message has no amount that can be trusted
+    """
+    candidate = _trusted_rules_candidate(message) or extract_expense_heuristically(message)
+    if not candidate:
+        return None
+    category = candidate["category"]
+    classifier = get_category_classifier()
+    if not category and classifier:
+        category = classifier.user_category(candidate["description"], user_id) or classifier.classify(candidate["description"])[0]
+    return _local_expense(candidate, category or "Other")
+
+def parse_expenses_degraded(message, user_id=None):
+    """
+    Parse the expenses of a message without the LLM while OpenAI is unavailable (see
+    parse_expense_degraded): each item of a message that lists several, keeping those
+    that have an amount that can be trusted
+    """
+    items = split_expense_items(message)
+    if len(items) < 2 or _trusted_rules_candidate(message):
+        items = [message]
+    expenses = [parse_expense_degraded(item, user_id) for item in items[:EXPENSE_MAX_ITEMS]]
+    return [expense_data for expense_data in expenses if expense_data]
+
+def _trusted_rules_candidate(message):
+    """
+    Extract an expense with the rules, unless its amount is a bare number and its category
+    isn't known: "see you in 10" or "Room 101" must not be saved while the LLM can't check them
+    """
+    candidate = extract_expense_with_rules(message)
+    if candidate and (candidate["currency_given"] or candidate["category"]):
+        return candidate
+    return None
+
+def _local_expense(candidate, category):
+    return {
+        "description": candidate["description"],
+        "amount": candidate["amount"],
+        "category": category
+    }
+
+def apply_user_category(expense_data, user_id):
+    """
+    Use the category the user stored last for the same description, if any
+    """
+    classifier = get_category_classifier()
+    if not expense_data or not classifier:
+        return expense_data
+    category = classifier.user_category(expense_data["description"], user_id)
+    if not category or category == expense_data["category"]:
+        return expense_data
+    metrics.increment("bot_category_classifier_requests_total", result="user")
+    return {**expense_data, "category": category}
+
+def apply_user_categories(expenses, user_id):
+    """
+    Apply apply_user_category to each expense of a message
+    """
+    return [apply_user_category(expense_data, user_id) for expense_data in expenses]
+
+def parse_expenses_with_langchain(message, user_id=None):
+    """
+    Parse the expenses of a message using Langchain, with a single call however many it lists
+
+    A flow, returns a list of dictionaries with the expense information, empty if the message
+    is not an expense.
+    Raises LLMUnavailableError if OpenAI is failing or its circuit breaker is open, and
+    RateLimitExceeded if the message isn't admitted (cached results are always returned).
+    """
+    # Check the parse cache first
+    if parse_cache:
+        with metrics.span("cache_lookup"):
+            cached = yield local(parse_cache.get, message)
+        metrics.increment("bot_parse_cache_requests_total", result="miss" if cached is MISSING else "hit")
+        if cached is not MISSING:
+            debug_sample(logger, "Parse cache hit", result=cached)
+            return cached
+
+    if rate_limiter:
+        yield local(rate_limiter.admit, user_id)
+    try:
+        if parse_flight:
+            return (yield parse_flight.do_flow(normalize_message(message), _run_and_cache(message)))
+        return (yield from _run_and_cache(message))
+    except RateLimitExceeded:
+        raise
+    except Exception as e:
+        if isinstance(e, CircuitOpenError) or is_outage(e):
+            raise LLMUnavailableError(str(e)) from e
+        logger.warning("Error parsing expense with Langchain: %s", e)
+        # For debugging purposes, log the full message
+        debug_sample(logger, "Original message", text=message)
+        # In case of error, return no expenses
+        return []
+
+def _run_and_cache(message):
+    # Hold one of the LLM call slots of the host during the call
+    slot_id = (yield local(rate_limiter.acquire_slot)) if rate_limiter and rate_limiter.max_concurrency > 0 else None
+    try:
+        expenses = yield from run_expense_chain(message)
+    finally:
+        if slot_id is not None:
+            yield local(rate_limiter.release_slot, slot_id)
+    # Only successful analyses are cached, errors are retried next time
+    if parse_cache:
+        yield local(parse_cache.set, message, expenses)
+    return expenses
+
+def run_expense_chain(message):
+    """
+    Run the model cascade on a message: each tier parses it in turn until one gives an
+    answer that can be trusted, the last tier's answer is always used.
+
+    A flow, returns the list of expenses of the message, empty if the message is not an expense.
+    Raises an exception if the last LLM call fails or its response can't be parsed.
+    """
+    for tier in LLM_TIER_NAMES:
+        start = time.perf_counter()
+        try:
+            with metrics.span("llm_call"):
+                result = yield io("llm", tier, message)
+        except Exception as e:
+            if _escalate_on_error(tier, e, start):
+                continue
+            raise
+        expenses = _review_tier_response(tier, result, start)
+        if expenses is not _ESCALATE:
+            return expenses
+
+def _record_tier(tier, outcome, start, reason=None):
+    metrics.observe("bot_llm_tier_duration_seconds", time.perf_counter() - start, tier=tier)
+    metrics.increment("bot_llm_tier_requests_total", tier=tier, outcome=outcome)
+    if reason:
+        metrics.increment("bot_llm_escalations_total", tier=tier, reason=reason)
+
+def _escalate_on_error(tier, error, start):
+    """
+    Record a failed LLM call, returns True if the next tier should parse the message
+    """
+    # The tiers share the OpenAI breaker, the next one would be rejected too
+    if tier == LLM_TIER_NAMES[-1] or isinstance(error, CircuitOpenError):
+        _record_tier(tier, "error", start)
+        return False
+    logger.warning("Error parsing expense with the %s model, escalating: %s", tier, error)
+    _record_tier(tier, "escalated", start, ESCALATE_ERROR)
+    return True
+
+def _review_tier_response(tier, result, start):
+    """
+    Check the response of a tier. Returns the expenses, or _ESCALATE if the next
+    tier should parse the message.
+    """
+    record_token_usage(result, tier)
+    with metrics.span("json_extract"):
+        expenses, reason = review_expense_response(result.content)
+    if reason is None:
+        _record_tier(tier, "accepted", start)
+        return expenses
+    if tier != LLM_TIER_NAMES[-1]:
+        debug_sample(logger, "Escalating LLM response", tier=tier, reason=reason, content=result.content)
+        _record_tier(tier, "escalated", start, reason)
+        return _ESCALATE
+    # Nothing left to escalate to
+    if reason == ESCALATE_INVALID_JSON:
+        _record_tier(tier, "error", start)
+        raise ValueError(f"The {tier} model response is not valid JSON")
+    _record_tier(tier, "accepted", start)
+    return expenses
+
+def record_token_usage(result, tier=STRONG_TIER):
+    """
+    Count the tokens of an LLM response (when the model reports them)
+    """
+    usage = getattr(result, "usage_metadata", None)
+    if not usage:
+        return
+    metrics.increment("bot_llm_tokens_total", usage.get("input_tokens", 0), type="prompt", tier=tier)
+    metrics.increment("bot_llm_tokens_total", usage.get("output_tokens", 0), type="completion", tier=tier)
+
+def extract_json(content):
+    """
+    Extract the JSON object of the raw LLM response.
+    Raises an exception if the response doesn't contain valid JSON.
+    """
+    debug_sample(logger, "Raw Langchain response", content=content)
+
+    # Extract the JSON part
+    if "```json" in content:
+        json_str = content.split("```json")[1].split("```")[0].strip()
+    elif "```" in content:
+        json_str = content.split("```")[1].strip()
+    else:
+        json_str = content.strip()
+
+    debug_sample(logger, "Extracted JSON string", json=json_str)
+
+    # Parse the JSON
+    expense_data = json.loads(json_str)
+
+    debug_sample(logger, "Langchain analysis result", result=expense_data)
+    return expense_data
+
+def review_expense_response(content):
+    """
+    Extract the expenses from the raw LLM response and check them
+
+    Returns a tuple (expenses, reason): expenses is the list of valid expenses, empty if the
+    message is not an expense, and reason is why the response can't be trusted (ESCALATE_*),
+    or None
+    """
+    try:
+        analysis = extract_json(content)
+    except ValueError:
+        return [], ESCALATE_INVALID_JSON
+    if analysis is not None and not isinstance(analysis, dict):
+        return [], ESCALATE_INVALID_JSON
+
+    # A missing confidence is not considered low
+    confidence = (analysis or {}).get("confidence")
+    low_confidence = (
+        isinstance(confidence, (int, float)) and not isinstance(confidence, bool)
+        and confidence < LLM_CONFIDENCE_THRESHOLD
+    )
+
+    # If it's not an expense, return no expenses
+    if not analysis or not analysis.get('is_expense', False):
+        return [], ESCALATE_LOW_CONFIDENCE if low_confidence else None
+
+    # A single expense can also be written at the top level
+    items = analysis.get('expenses', [analysis])
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return [], ESCALATE_INVALID_JSON
+    if len(items) > EXPENSE_MAX_ITEMS:
+        metrics.increment("bot_expense_items_dropped_total", len(items) - EXPENSE_MAX_ITEMS)
+        items = items[:EXPENSE_MAX_ITEMS]
+
+    expenses = []
+    reason = None if items else ESCALATE_INVALID_AMOUNT
+    for item in items:
+        # "$1,234.50" is parsed like the stored amounts, and invalid or non-finite amounts
+        # ("inf", "NaN") are 0
+        amount = parse_amount_cents(item.get('amount')) / 100
+        if not amount > 0:
+            reason = ESCALATE_INVALID_AMOUNT
+            continue
+
+        category = canonical_category(str(item.get('category') or ''))
+        expenses.append({
+            "description": item.get('description') or 'Unknown expense',
+            "amount": amount,
+            "category": category or 'Other'
+        })
+        if category is None and reason is None:
+            reason = ESCALATE_INVALID_CATEGORY
+    return expenses, reason or (ESCALATE_LOW_CONFIDENCE if low_confidence else None)
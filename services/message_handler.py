@@ -0,0 +1,504 @@
+"""
+Message processing shared by the Flask app (controllers/message_controller.py) and the Quart
+app (controllers/async_message_controller.py). The handlers are flows (see config.flow):
+the controllers only read the request, run the handler with blocking or async I/O and send
+its response.
+"""
+import time
+from models.expense import Expense
+from models.user import User
+from services.user_service import UserService
+from services.expense_service import ExpenseService
+from services.llm_parser import parse_expenses
+from services.message_responses import (
+    is_command, is_help_command, is_report_command, is_registration_request,
+    help_response, report_not_registered_response, render_report, rendered_report_response, report_error_response,
+    window_report_response, get_report_window, REPORT_WINDOWS,
+    registered_response, welcome_response, user_not_found_response,
+    not_expense_response, expense_added_response, expense_not_saved_response, rate_limited_response,
+    get_batch_items, batch_error_response, get_item_fields,
+    get_history_filters, history_response, get_export_filters, get_idempotency_key, duplicate_in_progress_response
+)
+from config.settings import (
+    BATCH_MAX_ITEMS, BATCH_PARSE_WORKERS, REPORT_MAX_ROWS, HISTORY_DEFAULT_LIMIT, HISTORY_MAX_LIMIT, EXPORT_PAGE_SIZE,
+    IDEMPOTENCY_ENABLED, IDEMPOTENCY_PATH, IDEMPOTENCY_TTL, IDEMPOTENCY_WAIT_TIMEOUT, IDEMPOTENCY_PENDING_TIMEOUT
+)
+from repositories.expense_repository import HISTORY_COLUMNS
+from services.expense_parser import EXPENSE_CATEGORIES
+from services.expense_export import EXPORT_FORMATS
+from services.metrics import metrics, count_message
+from services.rate_limiter import RateLimitExceeded
+from services.idempotency import IdempotencyStore, IdempotencyTimeout
+from services.ttl_cache import MISSING
+from config.flow import gather
+from config.lazy import LazySingleton
+from config.logging_config import get_logger, debug_sample, request_log
+
+logger = get_logger(__name__)
+
+def create_idempotency_store():
+    """
+    Create the store of the responses of the requests with an idempotency key, shared by
+    the workers on the host
+    """
+    return IdempotencyStore(
+        IDEMPOTENCY_PATH,
+        ttl=IDEMPOTENCY_TTL,
+        wait_timeout=IDEMPOTENCY_WAIT_TIMEOUT,
+        pending_timeout=IDEMPOTENCY_PENDING_TIMEOUT
+    )
+
+# The services are created on first use (once per worker process), so importing this
+# module doesn't open the local stores or start anything before the workers fork
+_user_service = LazySingleton(UserService)
+_expense_service = LazySingleton(ExpenseService)
+_idempotency_store = LazySingleton(create_idempotency_store)
+
+def get_user_service():
+    """
+    Get the user service of this process
+    """
+    return _user_service.get()
+
+def get_expense_service():
+    """
+    Get the expense service of this process
+    """
+    return _expense_service.get()
+
+def get_idempotency_store():
+    """
+    Get the idempotency store, or None if it's disabled
+    """
+    if not IDEMPOTENCY_ENABLED:
+        return None
+    return _idempotency_store.get()
+
+def handle_history(args):
+    """
+    Get a page of the expense history of a user for /expenses, args being the query string
+
+    Returns a tuple (response, status_code)
+    """
+    telegram_id = args.get("telegram_id")
+    if not telegram_id:
+        return {"success": False, "error": "Missing telegram_id"}, 400
+    filters, error = get_history_filters(
+        args, HISTORY_DEFAULT_LIMIT, HISTORY_MAX_LIMIT, EXPENSE_CATEGORIES, HISTORY_COLUMNS
+    )
+    if error:
+        return {"success": False, "error": error}, 400
+
+    with metrics.span("user_lookup"):
+        user = yield from get_user_service().get_user(telegram_id)
+    if not user or not user.id:
+        return user_not_found_response(), 404
+
+    try:
+        with metrics.span("history_query"):
+            expenses, next_cursor = yield from get_expense_service().get_history(user.id, **filters)
+    except ValueError as e:
+        return {"success": False, "error": str(e)}, 400
+    return history_response(telegram_id, expenses, filters["columns"] or HISTORY_COLUMNS, next_cursor), 200
+
+def prepare_export(args):
+    """
+    Check an /expenses/export request and find its user, args being the query string
+
+    Returns a tuple (response, status_code, export): export is None when the request is
+    answered with the error response, else (next_page, columns, export_format), next_page
+    being the flow that reads a page (see config.flow.pages)
+    """
+    telegram_id = args.get("telegram_id")
+    if not telegram_id:
+        return {"success": False, "error": "Missing telegram_id"}, 400, None
+    export_format, filters, error = get_export_filters(
+        args, EXPORT_FORMATS, EXPENSE_CATEGORIES, HISTORY_COLUMNS
+    )
+    if error:
+        return {"success": False, "error": error}, 400, None
+
+    with metrics.span("user_lookup"):
+        user = yield from get_user_service().get_user(telegram_id)
+    if not user or not user.id:
+        return user_not_found_response(), 404, None
+
+    columns = filters["columns"] or HISTORY_COLUMNS
+    next_page = get_expense_service().history_pages(user.id, page_size=EXPORT_PAGE_SIZE, **filters)
+    return None, 200, (next_page, columns, export_format)
+
+def handle_process_message(headers, data, wait_timeout=None):
+    """
+    Process a /process-message request: verify if the user is registered, process the
+    message and build the response. Retries with the same idempotency key wait up to
+    wait_timeout seconds for the first request (IDEMPOTENCY_WAIT_TIMEOUT if None).
+
+    Returns a tuple (response, status_code, headers)
+    """
+    with request_log("process-message", headers.get("X-Request-ID")) as log_context:
+        try:
+            # Verify that the data is valid
+            if not data:
+                logger.warning("No data received")
+                log_context["status"] = 400
+                return {"success": False, "error": "No data received"}, 400, {}
+
+            # Extract message information
+            telegram_id = data.get('telegram_id')
+            message = data.get('message')
+
+            if not telegram_id or not message:
+                logger.warning("Missing required data (telegram_id or message)")
+                log_context["status"] = 400
+                return {"success": False, "error": "Missing required data"}, 400, {}
+
+            # Retries of the connector get the response of the first request
+            idempotency_store = get_idempotency_store()
+            key = get_idempotency_key(headers, data) if idempotency_store else None
+            replayed = False
+            try:
+                with metrics.span("request"):
+                    if key:
+                        response, status, replayed = yield from idempotency_store.run(
+                            key, process_message(telegram_id, message), wait_timeout
+                        )
+                    else:
+                        response, status = yield from process_message(telegram_id, message)
+            except IdempotencyTimeout as e:
+                logger.warning("%s", e)
+                log_context["status"] = 409
+                return duplicate_in_progress_response(telegram_id, message), 409, {"Retry-After": "5"}
+            log_context["status"] = status
+            response_headers = {}
+            if replayed:
+                log_context["replayed"] = True
+                response_headers["Idempotent-Replayed"] = "true"
+            if status == 429:
+                response_headers["Retry-After"] = str(response["retry_after"])
+            return response, status, response_headers
+
+        except Exception as e:
+            logger.exception("Error processing message")
+            log_context["status"] = 500
+            return {"success": False, "error": str(e)}, 500, {}
+
+def handle_process_messages(headers, data):
+    """
+    Process a /process-messages request, a JSON array of {"telegram_id", "message"} items
+    (or {"messages": [...]}). Users are resolved with one query, expenses are parsed
+    concurrently and saved with one bulk insert.
+
+    Returns a tuple (response, status_code), the response has one result per item, in the
+    same order and shape as /process-message
+    """
+    with request_log("process-messages", headers.get("X-Request-ID")) as log_context:
+        try:
+            items = get_batch_items(data)
+
+            error = batch_error_response(items, BATCH_MAX_ITEMS)
+            if error:
+                logger.warning("Invalid batch: %s", error['error'])
+                log_context["status"] = 400
+                return error, 400
+
+            log_context["items"] = len(items)
+            with metrics.span("batch_request"):
+                results = yield from process_messages(items)
+            log_context["status"] = 200
+            return {"success": True, "results": results}, 200
+
+        except Exception as e:
+            logger.exception("Error processing message batch")
+            log_context["status"] = 500
+            return {"success": False, "error": str(e)}, 500
+
+def process_message(telegram_id, message):
+    """
+    Process a single message from a user
+
+    Returns a tuple (response, status_code) where response is the JSON response body
+    """
+    debug_sample(logger, "Message received", telegram_id=telegram_id, text=message)
+
+    # Check if this is a help command
+    if is_help_command(message):
+        logger.debug("Help command received")
+        count_message("help")
+        return help_response(telegram_id, message), 200
+
+    # Check if this is a report command
+    if is_report_command(message):
+        return (yield from process_report(telegram_id, message))
+
+    # The user is looked up once and cached, its previous expenses can set the category
+    with metrics.span("user_lookup"):
+        user = yield from get_user_service().get_user(telegram_id)
+
+    if not user:
+        return (yield from process_unregistered_message(telegram_id, message))
+
+    # Parse the expense, using the rule-based parser first and Langchain as fallback
+    try:
+        with metrics.span("parse"):
+            expenses_data, parsed_by = yield from parse_expenses(message, user.id)
+    except RateLimitExceeded as e:
+        logger.info("Message from %s rejected: %s", telegram_id, e)
+        count_message("rate_limited")
+        return rate_limited_response(telegram_id, message, e), 429
+
+    # If the message is not an expense, ignore it
+    if not expenses_data:
+        debug_sample(logger, "Message is not an expense", text=message)
+        count_message("not_expense")
+        return not_expense_response(telegram_id, message, parsed_by), 200
+
+    if not user.id:
+        logger.warning("User with Telegram ID %s not found or has no ID", telegram_id)
+        return user_not_found_response(), 404
+
+    # Create the expenses
+    expenses = build_expenses(user.id, expenses_data, parsed_by)
+
+    # Save the expenses, those of a message that lists several with one bulk insert
+    with metrics.span("db_insert"):
+        if len(expenses) == 1:
+            saved = (yield from get_expense_service().create(expenses[0])) is not None
+        else:
+            saved = len((yield from get_expense_service().create_many(expenses))) == len(expenses)
+
+    # A 500 is not stored for idempotent retries, so the connector can send the message again
+    if not saved:
+        logger.error("The %d expenses of a message from %s were not saved", len(expenses), telegram_id)
+        return expense_not_saved_response(telegram_id, message), 500
+
+    count_message("expense")
+    return expense_added_response(telegram_id, message, expenses_data, parsed_by), 200
+
+def build_expenses(user_id, expenses_data, parsed_by):
+    """
+    Create the expenses parsed from a message of a user
+    """
+    return [
+        Expense(
+            user_id=user_id,
+            description=expense_data["description"],
+            amount=expense_data["amount"],
+            category=expense_data["category"],
+            parsed_by=parsed_by
+        )
+        for expense_data in expenses_data
+    ]
+
+def daily_report_response(telegram_id, message, user_id, expenses, totals, read_at):
+    """
+    Render the daily report of a user, read from the database at read_at, and cache it
+    """
+    report = render_report(expenses, totals)
+    yield from get_expense_service().cache_report(telegram_id, user_id, report, expenses, totals, read_at)
+    return rendered_report_response(telegram_id, message, report)
+
+def process_daily_report(telegram_id, message):
+    """
+    Build the daily report with a single database round trip, which also finds the user
+    when they're not cached
+
+    Returns a tuple (response, status_code), or None when the report needs separate queries
+    """
+    cached = get_user_service().get_cached_user(telegram_id)
+    if cached is None:
+        logger.debug("User %s is not registered", telegram_id)
+        return report_not_registered_response(telegram_id, message), 200
+
+    read_at = time.time()
+    with metrics.span("report_query"):
+        report = yield from get_expense_service().get_daily_report_by_telegram_id(
+            telegram_id, REPORT_MAX_ROWS, None if cached is MISSING else cached.id
+        )
+    if report is None:
+        return None
+
+    user_id, expenses, totals = report
+    if cached is MISSING:
+        get_user_service().cache_user(telegram_id, User(telegram_id, id=user_id) if user_id is not None else None)
+    if user_id is None:
+        logger.debug("User %s is not registered", telegram_id)
+        return report_not_registered_response(telegram_id, message), 200
+
+    logger.debug("Report generated for user %s", telegram_id)
+    return (yield from daily_report_response(telegram_id, message, user_id, expenses, totals, read_at)), 200
+
+def process_report(telegram_id, message):
+    """
+    Build the expense report of the last 24 hours for a user
+
+    Returns a tuple (response, status_code)
+    """
+    logger.debug("Report command received")
+    count_message("report")
+
+    if get_report_window(message) == "day":
+        try:
+            cached_report = yield from get_expense_service().get_cached_report(telegram_id)
+            if cached_report is not None:
+                logger.debug("Report served from the cache for user %s", telegram_id)
+                return rendered_report_response(telegram_id, message, cached_report[1]), 200
+            response = yield from process_daily_report(telegram_id, message)
+        except Exception:
+            logger.exception("Error generating report")
+            return report_error_response(telegram_id, message), 200
+        if response:
+            return response
+
+    # Check if the user is registered
+    with metrics.span("user_lookup"):
+        user = yield from get_user_service().get_user(telegram_id)
+
+    if not user:
+        logger.debug("User %s is not registered", telegram_id)
+        # For unregistered users, send the help message
+        return report_not_registered_response(telegram_id, message), 200
+
+    try:
+        if not user.id:
+            logger.warning("User with Telegram ID %s not found or has no ID", telegram_id)
+            return user_not_found_response(), 404
+
+        # Weekly and monthly reports only show totals, served from the rolling aggregates
+        window = get_report_window(message)
+        if window != "day":
+            _, days = REPORT_WINDOWS[window]
+            with metrics.span("report_query"):
+                totals = yield from get_expense_service().get_window_totals(user.id, days)
+            logger.debug("%s report generated for user %s", window.capitalize(), telegram_id)
+            return window_report_response(telegram_id, message, window, totals), 200
+
+        # Get daily expenses
+        read_at = time.time()
+        with metrics.span("report_query"):
+            expenses, totals = yield from get_expense_service().get_daily_report(user.id, REPORT_MAX_ROWS)
+
+        if not expenses:
+            logger.debug("No expenses found for user %s", telegram_id)
+        else:
+            logger.debug("Report generated for user %s", telegram_id)
+        return (yield from daily_report_response(telegram_id, message, user.id, expenses, totals, read_at)), 200
+    except Exception as e:
+        logger.exception("Error generating report")
+        return report_error_response(telegram_id, message), 200
+
+def process_unregistered_message(telegram_id, message):
+    """
+    Handle a message from a user who is not registered: register them if they ask to,
+    otherwise send the help message
+
+    Returns a tuple (response, status_code)
+    """
+    logger.debug("User %s is not registered", telegram_id)
+
+    # Check if this is a registration request
+    if is_registration_request(message):
+        logger.info("Registration request from %s", telegram_id)
+
+        # Register the user
+        with metrics.span("db_insert"):
+            yield from get_user_service().create_user(telegram_id)
+
+        count_message("register")
+        return registered_response(telegram_id, message), 200
+
+    # If not a registration request, send the help message
+    logger.debug("Sending help message to unregistered user %s", telegram_id)
+    count_message("welcome")
+    return welcome_response(telegram_id, message), 200
+
+def process_messages(items):
+    """
+    Process a batch of {"telegram_id", "message"} items
+
+    Returns the list of responses, one per item and in the same order
+    """
+    results = [None] * len(items)
+
+    # Validate the items
+    valid = []
+    for index, item in enumerate(items):
+        telegram_id, message = get_item_fields(item)
+        if not telegram_id or not message:
+            results[index] = {"success": False, "error": "Missing required data"}
+        else:
+            valid.append((index, telegram_id, message))
+
+    # Resolve all the users with one query (this also fills the user cache). If it fails the
+    # whole batch gets a 500, so the connector retries it instead of users being told to register
+    with metrics.span("user_lookup"):
+        users = yield from get_user_service().get_users([telegram_id for _, telegram_id, _ in valid])
+
+    # Commands and messages from unregistered users go through the regular flow,
+    # expenses from registered users are parsed concurrently
+    to_parse = []
+    for index, telegram_id, message in valid:
+        user = users.get(str(telegram_id))
+        if is_command(message) or not user or not user.id:
+            results[index] = yield from safe_process_message(telegram_id, message)
+        else:
+            to_parse.append((index, telegram_id, message, user))
+
+    if not to_parse:
+        return results
+
+    logger.debug("Parsing %d messages, up to %d at a time", len(to_parse), BATCH_PARSE_WORKERS)
+    parsed = yield gather(
+        (parse_batch_message(message, user.id) for _, _, message, user in to_parse), BATCH_PARSE_WORKERS
+    )
+
+    # Save all the expenses with one bulk insert
+    expenses = []
+    added = []
+    for (index, telegram_id, message, user), outcome in zip(to_parse, parsed):
+        if isinstance(outcome, RateLimitExceeded):
+            count_message("rate_limited")
+            results[index] = rate_limited_response(telegram_id, message, outcome)
+            continue
+        expenses_data, parsed_by = outcome
+        if not expenses_data:
+            count_message("not_expense")
+            results[index] = not_expense_response(telegram_id, message, parsed_by)
+            continue
+        expenses.extend(build_expenses(user.id, expenses_data, parsed_by))
+        added.append((index, telegram_id, message, expenses_data, parsed_by))
+
+    if expenses:
+        with metrics.span("db_insert"):
+            created = yield from get_expense_service().create_many(expenses)
+        count_message("expense", len(added))
+        saved = len(created) == len(expenses)
+        logger.debug("Saved %d of %d expenses with one bulk insert", len(created), len(expenses))
+
+        for index, telegram_id, message, expenses_data, parsed_by in added:
+            if saved:
+                results[index] = expense_added_response(telegram_id, message, expenses_data, parsed_by)
+            else:
+                results[index] = expense_not_saved_response(telegram_id, message)
+
+    return results
+
+def parse_batch_message(message, user_id):
+    """
+    Parse a message of a batch, returns (expenses_data, parsed_by) or the RateLimitExceeded
+    error of a message that was rejected, so the others of the batch are processed
+    """
+    try:
+        return (yield from parse_expenses(message, user_id))
+    except RateLimitExceeded as e:
+        return e
+
+def safe_process_message(telegram_id, message):
+    """
+    Process a single message of a batch, turning errors into an error response
+    """
+    try:
+        response, _ = yield from process_message(telegram_id, message)
+        return response
+    except Exception as e:
+        logger.exception("Error processing message")
+        return {"success": False, "error": str(e)}
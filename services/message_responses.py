@@ -0,0 +1,471 @@
+"""
+Response messages shared by the Flask (WSGI) and async (ASGI) message controllers.
+"""
+import hashlib
+from datetime import datetime
+from decimal import Decimal
+from services.expense_parser import PARSE_PATH_DEGRADED
+from services.rate_limiter import SCOPE_USER, retry_after_seconds
+from config.settings import EXPENSE_MAX_ITEMS
+from config.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Report windows: /report <window> -> (title, number of days)
+REPORT_WINDOWS = {
+    "day": ("Last 24 Hours", 1),
+    "week": ("Last 7 Days", 7),
+    "month": ("Last 30 Days", 30)
+}
+
+# Helper function to get the help message
+def get_help_message():
+    return "🤖 Expense Bot - Available Commands:\n\n" + \
+           "To register, send:\n" + \
+           '"I want to register to the application"\n\n' + \
+           "Once registered, you can:\n" + \
+           "1. Record expenses by sending messages like:\n" + \
+           '   - "Bought bread for $100"\n' + \
+           '   - "Paid $30 for gas"\n' + \
+           '   - "Taxi $20"\n\n' + \
+           "2. Use /report to see your expenses from the last 24 hours\n" + \
+           "3. Use /report week or /report month to see your totals by category"
+
+def is_help_command(message):
+    """
+    Check if a message is the help command
+    """
+    return message.lower().strip() == "/help"
+
+def is_report_command(message):
+    """
+    Check if a message is the report command (/report, /report week or /report month)
+    """
+    command = message.lower().split()
+    return bool(command) and command[0] == "/report" and len(command) <= 2
+
+def get_report_window(message):
+    """
+    Get the window of a report command ("day", "week" or "month").
+    Unknown windows fall back to the daily report.
+    """
+    command = message.lower().split()
+    window = command[1] if len(command) > 1 else "day"
+    return window if window in REPORT_WINDOWS else "day"
+
+def is_command(message):
+    """
+    Check if a message is one of the bot commands
+    """
+    return is_help_command(message) or is_report_command(message)
+
+def is_registration_request(message):
+    """
+    Check if a message from an unregistered user asks to register
+    """
+    return "register" in message.lower()
+
+def build_report_message(expenses, totals=None):
+    """
+    Format the expense report of the last 24 hours: the given (most recent) expenses,
+    then the summary of all the expenses of the period when totals are given
+    """
+    if totals is None:
+        totals = {"total": sum(expense.amount_cents for expense in expenses) / 100, "count": len(expenses), "categories": {}}
+
+    # Format the report with the preferred style
+    lines = ["📊 Your expenses in the last 24 hours:", ""]
+
+    for expense in expenses:
+        # Format time in 12-hour format with AM/PM
+        time_str = expense.added_at.strftime("%I:%M %p") if expense.added_at else "N/A"
+
+        lines.append(f"• {expense.description}")
+        lines.append(f"  💰 ${expense.amount:,.2f}")
+        lines.append(f"  🏷️ {expense.category}")
+        lines.append(f"  🕒 {time_str}")
+        lines.append("")
+
+    hidden = totals["count"] - len(expenses)
+    if hidden > 0:
+        lines.append(f"…and {hidden} more expense{'s' if hidden > 1 else ''}")
+        lines.append("")
+
+    # Add total at the end
+    total = f"Total: ${totals['total']:,.2f}"
+    if len(totals["categories"]) > 1:
+        lines.append(f"{total} ({totals['count']} expenses)")
+        lines.append("")
+        lines.append("By category:")
+        for category, amount in sorted(totals["categories"].items(), key=lambda item: item[1], reverse=True):
+            lines.append(f"  🏷️ {category}: ${amount:,.2f}")
+    else:
+        lines.append(total)
+    return "\n".join(lines)
+
+def help_response(telegram_id, message):
+    """
+    Build the response for the help command
+    """
+    return {
+        "success": True,
+        "telegram_id": telegram_id,
+        "message": message,
+        "should_respond": True,
+        "response_message": get_help_message()
+    }
+
+def report_not_registered_response(telegram_id, message):
+    """
+    Build the response for a report requested by an unregistered user
+    """
+    return {
+        "success": True,
+        "telegram_id": telegram_id,
+        "message": message,
+        "user_whitelisted": False,
+        "should_respond": True,
+        "response_message": "You need to register first to use this command.\n\n" + get_help_message()
+    }
+
+def render_report(expenses, totals=None):
+    """
+    Render the text of the daily report
+    """
+    if not expenses:
+        return "📊 Expense Report (Last 24 Hours)\n\nNo expenses recorded in the last 24 hours."
+    return build_report_message(expenses, totals)
+
+def rendered_report_response(telegram_id, message, report):
+    """
+    Build the response for the report command from the rendered report
+    """
+    return {
+        "success": True,
+        "telegram_id": telegram_id,
+        "message": message,
+        "user_whitelisted": True,
+        "should_respond": True,
+        "response_message": report
+    }
+
+def build_window_report_message(window, totals):
+    """
+    Format the total and per-category spend of a report window
+    """
+    title, _ = REPORT_WINDOWS[window]
+    if not totals["count"]:
+        return f"📊 Expense Report ({title})\n\nNo expenses recorded in this period."
+
+    report = f"📊 Expense Report ({title})\n\n"
+    report += f"Total: ${totals['total']:,.2f} ({totals['count']} expenses)\n\n"
+    report += "By category:\n"
+    for category, amount in sorted(totals["categories"].items(), key=lambda item: item[1], reverse=True):
+        report += f"  🏷️ {category}: ${amount:,.2f}\n"
+    return report.rstrip("\n")
+
+def window_report_response(telegram_id, message, window, totals):
+    """
+    Build the response for a weekly or monthly report
+    """
+    return {
+        "success": True,
+        "telegram_id": telegram_id,
+        "message": message,
+        "user_whitelisted": True,
+        "should_respond": True,
+        "response_message": build_window_report_message(window, totals)
+    }
+
+def report_error_response(telegram_id, message):
+    """
+    Build the response for a report that couldn't be generated
+    """
+    return {
+        "success": False,
+        "telegram_id": telegram_id,
+        "message": message,
+        "user_whitelisted": True,
+        "should_respond": True,
+        "response_message": "Sorry, I couldn't generate your expense report. Please try again later."
+    }
+
+def registered_response(telegram_id, message):
+    """
+    Build the response for a user who has just registered
+    """
+    return {
+        "success": True,
+        "telegram_id": telegram_id,
+        "message": message,
+        "user_whitelisted": True,
+        "should_respond": True,
+        "response_message": "You have been registered successfully! You can now start tracking your expenses."
+    }
+
+def welcome_response(telegram_id, message):
+    """
+    Build the response for a message from an unregistered user
+    """
+    return {
+        "success": True,
+        "telegram_id": telegram_id,
+        "message": message,
+        "user_whitelisted": False,
+        "should_respond": True,
+        "response_message": "Welcome! To use this bot, you need to register first.\n\n" + get_help_message()
+    }
+
+def user_not_found_response():
+    """
+    Build the response for a registered user whose record can't be loaded
+    """
+    return {
+        "success": False,
+        "error": "User not found"
+    }
+
+def not_expense_response(telegram_id, message, parsed_by):
+    """
+    Build the response for a message that is not an expense. While the LLM is unavailable
+    the user is asked to try again, the message may be an expense the local parse didn't get.
+    """
+    response = {
+        "success": True,
+        "telegram_id": telegram_id,
+        "message": message,
+        "user_whitelisted": True,
+        "expense_created": False,
+        "parsed_by": parsed_by,
+        "should_respond": False
+    }
+    if parsed_by == PARSE_PATH_DEGRADED:
+        response["should_respond"] = True
+        response["response_message"] = (
+            "Sorry, I can't understand this message right now. "
+            'Please try again later, or send it like "Taxi $20".'
+        )
+    return response
+
+def expense_added_response(telegram_id, message, expenses, parsed_by):
+    """
+    Build the response for a message whose expenses were saved, confirming the category
+    of each one. expense_data is the first expense, for clients that expect a single one.
+    """
+    # Create a response message
+    degraded = parsed_by == PARSE_PATH_DEGRADED
+    if len(expenses) == 1:
+        expense_data = expenses[0]
+        response_message = f"{expense_data['category']} expense added ✅"
+        if degraded:
+            response_message += f"\n{expense_data['description']}: ${expense_data['amount']:,.2f} (quick parse, please check it)"
+    else:
+        lines = [f"{len(expenses)} expenses added ✅"]
+        for expense_data in expenses:
+            lines.append(f"• {expense_data['description']}: ${expense_data['amount']:,.2f} ({expense_data['category']})")
+        if len(expenses) >= EXPENSE_MAX_ITEMS:
+            lines.append(f"(Up to {EXPENSE_MAX_ITEMS} expenses are added per message)")
+        if degraded:
+            lines.append("(quick parse, please check them)")
+        response_message = "\n".join(lines)
+
+    # Return response with expense information and response message
+    return {
+        "success": True,
+        "telegram_id": telegram_id,
+        "message": message,
+        "user_whitelisted": True,
+        "expense_created": True,
+        "expense_data": expenses[0],
+        "expenses": expenses,
+        "parsed_by": parsed_by,
+        "should_respond": True,
+        "response_message": response_message
+    }
+
+def rate_limited_response(telegram_id, message, error):
+    """
+    Build the response for a message rejected by the rate limits (status 429)
+    """
+    retry_after = retry_after_seconds(error)
+    if error.scope == SCOPE_USER:
+        response_message = f"You're sending messages too fast. Please try again in {retry_after} second{'s' if retry_after > 1 else ''}."
+    else:
+        response_message = "I'm very busy right now. Please try again in a few seconds."
+    return {
+        "success": False,
+        "telegram_id": telegram_id,
+        "message": message,
+        "user_whitelisted": True,
+        "expense_created": False,
+        "error": "Too many requests",
+        "rate_limit": error.scope,
+        "retry_after": retry_after,
+        "should_respond": True,
+        "response_message": response_message
+    }
+
+def expense_not_saved_response(telegram_id, message):
+    """
+    Build the response for a message whose expenses couldn't be saved
+    """
+    return {
+        "success": False,
+        "telegram_id": telegram_id,
+        "message": message,
+        "error": "Failed to save expense"
+    }
+
+def get_idempotency_key(headers, data):
+    """
+    Get the idempotency key of a /process-message request, or None if it has none: the
+    Idempotency-Key header of the sender, else the Telegram message_id of the sender, else
+    a hash of the sender, text and send time ("date") of the message
+    """
+    telegram_id = data.get("telegram_id")
+    # The header is scoped to the sender, so a reused key never replays another user's response
+    if headers.get("Idempotency-Key"):
+        return f"key:{telegram_id}:{headers.get('Idempotency-Key')}"
+    if data.get("message_id") is not None:
+        return f"message:{telegram_id}:{data.get('message_id')}"
+    if data.get("date") is not None:
+        digest = hashlib.sha256(f"{telegram_id}\0{data.get('message')}\0{data.get('date')}".encode("utf-8"))
+        return f"hash:{digest.hexdigest()}"
+    return None
+
+def duplicate_in_progress_response(telegram_id, message):
+    """
+    Build the response for a retried request whose first attempt is still running (status 409)
+    """
+    return {
+        "success": False,
+        "telegram_id": telegram_id,
+        "message": message,
+        "error": "A request with the same idempotency key is still being processed",
+        "should_respond": False
+    }
+
+def get_batch_items(data):
+    """
+    Get the list of items of a batch request, which is either a JSON array
+    or an object with a "messages" array
+    """
+    items = data.get('messages') if isinstance(data, dict) else data
+    return items if isinstance(items, list) else None
+
+def batch_error_response(items, max_items):
+    """
+    Build the error response for an invalid batch, or None if the batch is valid
+    """
+    if not items:
+        return {"success": False, "error": "No messages received"}
+    if len(items) > max_items:
+        return {"success": False, "error": f"Too many messages, the maximum batch size is {max_items}"}
+    return None
+
+def get_item_fields(item):
+    """
+    Get the (telegram_id, message) of a batch item, or (None, None) if it's not an object
+    """
+    if not isinstance(item, dict):
+        return None, None
+    return item.get('telegram_id'), item.get('message')
+
+def _parse_datetime(value, name):
+    try:
+        return datetime.fromisoformat(value), None
+    except ValueError:
+        return None, f"Invalid {name} date, use the ISO format (2024-01-31 or 2024-01-31T18:30:00)"
+
+def _get_range_filters(args, categories, columns):
+    """
+    Get the from, to, category and columns filters of a history or export request.
+    Returns a tuple (filters, error).
+    """
+    filters = {}
+    for name, key in (("from", "since"), ("to", "until")):
+        filters[key] = None
+        if args.get(name):
+            filters[key], error = _parse_datetime(args.get(name), name)
+            if error:
+                return None, error
+
+    requested = [
+        category.strip() for value in args.getlist("category")
+        for category in value.split(",") if category.strip()
+    ]
+    filters["categories"] = []
+    for name in requested:
+        category = next((category for category in categories if category.lower() == name.lower()), None)
+        if not category:
+            return None, f"Unknown category: {name}"
+        filters["categories"].append(category)
+
+    filters["columns"] = None
+    if args.get("columns"):
+        filters["columns"] = [column.strip() for column in args.get("columns").split(",") if column.strip()]
+        unknown = [column for column in filters["columns"] if column not in columns]
+        if unknown:
+            return None, f"Unknown columns: {', '.join(unknown)}. Available: {', '.join(columns)}"
+    return filters, None
+
+def get_history_filters(args, default_limit, max_limit, categories, columns):
+    """
+    Get the filters of an expense history request from its query string arguments:
+    from, to, category (repeated or comma separated), columns, limit and cursor.
+
+    Returns a tuple (filters, error): filters are the keyword arguments of get_history,
+    error is an error message when an argument is not valid
+    """
+    filters, error = _get_range_filters(args, categories, columns)
+    if error:
+        return None, error
+    filters["cursor"] = args.get("cursor") or None
+
+    try:
+        limit = int(args.get("limit", default_limit))
+    except ValueError:
+        return None, "Invalid limit"
+    if not 1 <= limit <= max_limit:
+        return None, f"The limit must be between 1 and {max_limit}"
+    filters["limit"] = limit
+    return filters, None
+
+def get_export_filters(args, formats, categories, columns):
+    """
+    Get the format and the filters of an expense export request from its query string
+    arguments: format, from, to, category and columns.
+
+    Returns a tuple (export_format, filters, error): filters are the keyword arguments of
+    ExpenseService.history_pages, error is an error message when an argument is not valid
+    """
+    export_format = (args.get("format") or "csv").lower()
+    if export_format not in formats:
+        return None, None, f"Unknown format: {export_format}. Available: {', '.join(formats)}"
+    filters, error = _get_range_filters(args, categories, columns)
+    return export_format, filters, error
+
+def expense_row(expense, columns):
+    """
+    Get the given columns of an expense as JSON-serializable values
+    """
+    row = {}
+    for column in columns:
+        value = getattr(expense, column)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        elif isinstance(value, Decimal):
+            value = float(value)
+        row[column] = value
+    return row
+
+def history_response(telegram_id, expenses, columns, next_cursor):
+    """
+    Build the response for a page of the expense history, with only the requested columns
+    """
+    return {
+        "success": True,
+        "telegram_id": telegram_id,
+        "expenses": [expense_row(expense, columns) for expense in expenses],
+        "next_cursor": next_cursor
+    }
@@ -0,0 +1,271 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from config.logging_config import get_logger, record_stage, count_request_path
+from config.settings import METRICS_ENABLED, METRICS_DIR, METRICS_FLUSH_INTERVAL
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Help text of the exported metrics
+METRIC_HELP = {
+    "bot_stage_duration_seconds": "Time spent in each stage of message processing",
+    "bot_messages_total": "Messages processed, by path",
+    "bot_parsed_messages_total": "Messages sent to the expense parser, by parser and result",
+    "bot_parse_cache_requests_total": "Lookups in the LLM parse cache",
+    "bot_user_cache_requests_total": "Lookups in the user cache",
+    "bot_category_classifier_requests_total": "Categories assigned by the user's previous expenses (user) or the local classifier (model), or left to the LLM (unsure)",
+    "bot_llm_tokens_total": "Tokens used by the language model, by cascade tier",
+    "bot_llm_tier_requests_total": "Messages parsed by each tier of the model cascade, by outcome",
+    "bot_llm_tier_duration_seconds": "Time spent by each tier of the model cascade on a message",
+    "bot_llm_escalations_total": "Messages escalated to the next tier of the model cascade, by reason",
+    "bot_single_flight_calls_total": "Calls run (leader), shared (follower) or timed out waiting for an identical call in flight",
+    "bot_single_flight_wait_seconds": "Time spent waiting for an identical call in flight",
+    "bot_prefilter_total": "Messages the pre-filter found obviously not expenses, by reason and mode",
+    "bot_prefilter_shadow_checks_total": "Filtered messages also sent to the LLM, by whether it agreed",
+    "bot_prefilter_false_negative_ratio": "Share of the filtered messages sent to the LLM that were expenses",
+    "bot_non_expense_ratio": "Share of parsed messages that were not expenses",
+    "bot_report_queries_total": "Daily reports fetched with the single round trip database function (rpc), or with separate queries because it is disabled, the user's ID is unknown with write-behind, or it failed",
+    "bot_circuit_breaker_calls_total": "Calls to a dependency through its circuit breaker, by result (success, failure, or rejected while open)",
+    "bot_circuit_breaker_transitions_total": "Circuit breaker state changes, by the state entered",
+    "bot_rate_limit_requests_total": "Admission checks of the messages sent to the LLM: rate limits (rejected by the user or global bucket) and LLM call slots (concurrency)",
+    "bot_idempotency_requests_total": "Requests with an idempotency key: processed (new), answered with the stored response (replayed, or waited for the first request), timed out waiting, or store errors",
+    "bot_report_cache_requests_total": "Lookups in the cache of rendered daily reports: hit, miss or error",
+    "bot_report_cache_invalidations_total": "Users whose cached daily reports were dropped because they added expenses",
+    "bot_exports_total": "Expense exports by format: completed, or ended early by an error",
+    "bot_export_rows_total": "Expenses streamed by the exports, by format",
+    "bot_parsed_expenses_total": "Expenses extracted from messages, by parse path (a message can list several)",
+    "bot_expense_items_dropped_total": "Expenses left out of the language model responses that listed more than EXPENSE_MAX_ITEMS"
+}
+
+logger = get_logger(__name__)
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [
+        (name, value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for name, value in pairs
+    ]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+class Metrics:
+    """
+    In-process counters and latency histograms, exported in the Prometheus text format.
+
+    Each gunicorn worker keeps its own values, and a background thread writes them to a
+    snapshot file named after the worker's pid in snapshot_dir. A scrape merges the
+    snapshots of all the workers, so /api/metrics returns the totals of the whole host
+    whichever worker serves it.
+    """
+    def __init__(self, snapshot_dir, flush_interval=5, buckets=LATENCY_BUCKETS, enabled=True):
+        self.snapshot_dir = snapshot_dir
+        self.flush_interval = flush_interval
+        self.buckets = buckets
+        self.enabled = enabled
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> [count of each bucket..., count above the last bucket, sum]
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._flusher = None
+        self._flusher_pid = None
+
+    def _check_pid(self):
+        """
+        Drop values inherited from the parent process after a fork, they are in its own snapshot
+        """
+        if self._pid != os.getpid():
+            self.counters = {}
+            self.histograms = {}
+            self._pid = os.getpid()
+
+    def increment(self, name, value=1, **labels):
+        """
+        Add to a counter
+        """
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._check_pid()
+            self.counters[key] = self.counters.get(key, 0) + value
+        self._ensure_flusher()
+
+    def observe(self, name, value, **labels):
+        """
+        Record a value in a histogram
+        """
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        index = len(self.buckets)
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = position
+                break
+        with self._lock:
+            self._check_pid()
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            histogram[index] += 1
+            histogram[-1] += value
+        self._ensure_flusher()
+
+    @contextmanager
+    def span(self, stage):
+        """
+        Time a stage of message processing:
+
+            with metrics.span("llm_call"):
+                ...
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.observe("bot_stage_duration_seconds", duration, stage=stage)
+            record_stage(stage, duration)
+
+    def snapshot(self):
+        """
+        Get the values of this process as a JSON-serializable dictionary
+        """
+        with self._lock:
+            self._check_pid()
+            return {
+                "buckets": list(self.buckets),
+                "counters": [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                "histograms": [[name, list(labels), list(values)] for (name, labels), values in self.histograms.items()]
+            }
+
+    def write_snapshot(self):
+        """
+        Write the values of this process to its snapshot file (atomically, readers never see a partial file)
+        """
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        path = os.path.join(self.snapshot_dir, f"{os.getpid()}.json")
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file)
+        os.replace(temp_path, path)
+
+    def collect(self):
+        """
+        Merge the snapshots of all the workers, using the live values of this process
+        """
+        snapshots = [self.snapshot()]
+        own_file = f"{os.getpid()}.json"
+        if os.path.isdir(self.snapshot_dir):
+            for file_name in os.listdir(self.snapshot_dir):
+                if not file_name.endswith(".json") or file_name == own_file:
+                    continue
+                try:
+                    with open(os.path.join(self.snapshot_dir, file_name)) as snapshot_file:
+                        snapshots.append(json.load(snapshot_file))
+                except (OSError, ValueError) as e:
+                    logger.warning("Error reading metrics snapshot %s: %s", file_name, e)
+
+        counters = {}
+        histograms = {}
+        for snapshot in snapshots:
+            # Snapshots written with other buckets can't be merged
+            if snapshot.get("buckets") != list(self.buckets):
+                continue
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in snapshot["histograms"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                merged = histograms.setdefault(key, [0] * len(values))
+                for index, value in enumerate(values):
+                    merged[index] += value
+        return counters, histograms
+
+    def render(self):
+        """
+        Render the merged metrics of all the workers in the Prometheus text format
+        """
+        counters, histograms = self.collect()
+        lines = []
+
+        def header(name, metric_type):
+            lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} {metric_type}")
+
+        for name in sorted({name for name, _ in counters}):
+            header(name, "counter")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for name in sorted({name for name, _ in histograms}):
+            header(name, "histogram")
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ["+Inf"], values[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', str(bound))])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {values[-1]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+        # Share of the parsed messages that were not expenses
+        parsed = {labels: value for (name, labels), value in counters.items() if name == "bot_parsed_messages_total"}
+        total = sum(parsed.values())
+        if total:
+            not_expense = sum(value for labels, value in parsed.items() if ("result", "not_expense") in labels)
+            header("bot_non_expense_ratio", "gauge")
+            lines.append(f"bot_non_expense_ratio {not_expense / total}")
+
+        # Share of the pre-filter's shadow checks where the LLM found an expense
+        checks = {labels: value for (name, labels), value in counters.items() if name == "bot_prefilter_shadow_checks_total"}
+        total = sum(checks.values())
+        if total:
+            false_negatives = sum(value for labels, value in checks.items() if ("result", "false_negative") in labels)
+            header("bot_prefilter_false_negative_ratio", "gauge")
+            lines.append(f"bot_prefilter_false_negative_ratio {false_negatives / total}")
+
+        return "\n".join(lines) + "\n"
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.write_snapshot()
+            except Exception as e:
+                logger.warning("Error writing metrics snapshot: %s", e)
+
+    def _ensure_flusher(self):
+        """
+        Start the snapshot writer of this process if it's not running.
+        Started lazily so it runs in each forked worker, not in the gunicorn master.
+        """
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher = threading.Thread(target=self._run_flusher, name="metrics-snapshot-writer", daemon=True)
+            self._flusher_pid = os.getpid()
+            self._flusher.start()
+
+# Metrics of this process, shared by the controllers and services
+metrics = Metrics(METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL, enabled=METRICS_ENABLED)
+
+def count_message(path, count=1):
+    """
+    Count processed messages by path, in the metrics and in the request log line
+    """
+    metrics.increment("bot_messages_total", count, path=path)
+    count_request_path(path, count)
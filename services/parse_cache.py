@@ -0,0 +1,152 @@
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from services.ttl_cache import MISSING
+from config.logging_config import get_logger
+from storage.sqlite_store import SQLiteStore
+
+logger = get_logger(__name__)
+
+def normalize_message(message):
+    """
+    Normalize a message for cache lookups (lowercase, collapsed whitespace)
+    """
+    return " ".join(message.lower().split())
+
+def prompt_fingerprint(prompt_text, model):
+    """
+    Fingerprint of the prompt and model that produced a parse result.
+    Changing either one produces a different fingerprint.
+    """
+    return hashlib.sha256(f"{model}\0{prompt_text}".encode("utf-8")).hexdigest()[:16]
+
+# Tables of the parse cache file
+SCHEMA = [
+    """
+        CREATE TABLE IF NOT EXISTS parse_cache (
+            key TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            result TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_parse_cache_last_used ON parse_cache (last_used)"
+]
+
+class ParseCache:
+    """
+    Persistent cache of LLM parse results stored in a local SQLite database.
+    The database file is shared by all the workers on the host and survives restarts.
+
+    Results of another prompt or model are never read, since the fingerprint is part of
+    the key. They are left to the LRU eviction rather than deleted on connect: during a
+    rolling deploy, old and new workers share the file and would delete each other's
+    entries. A deploy hook can drop them at once with
+        python -m services.parse_cache --purge
+    """
+    # Check the number of entries every N writes instead of on every write
+    EVICTION_CHECK_INTERVAL = 100
+
+    def __init__(self, path, fingerprint, max_entries=50000):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._store = SQLiteStore(path, SCHEMA, timeout=5, synchronous="NORMAL")
+        self._lock = threading.Lock()
+
+    def _key(self, message):
+        normalized = normalize_message(message)
+        return hashlib.sha256(f"{self.fingerprint}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, message):
+        """
+        Get the cached parse result of a message, or MISSING if it's not cached.
+        A cached result may be None (the message is not an expense).
+        """
+        key = self._key(message)
+        try:
+            conn = self._store.connect()
+            row = conn.execute("SELECT result FROM parse_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                with self._lock:
+                    self.misses += 1
+                return MISSING
+
+            conn.execute("UPDATE parse_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+            with self._lock:
+                self.hits += 1
+            return json.loads(row[0])
+        except Exception as e:
+            logger.error("Error reading parse cache: %s", e)
+            return MISSING
+
+    def set(self, message, result):
+        """
+        Store the parse result of a message
+        """
+        key = self._key(message)
+        now = time.time()
+        try:
+            conn = self._store.connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO parse_cache (key, fingerprint, result, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, self.fingerprint, json.dumps(result), now, now)
+            )
+            with self._lock:
+                self._writes += 1
+                check_eviction = self._writes % self.EVICTION_CHECK_INTERVAL == 0
+            if check_eviction:
+                self.evict()
+        except Exception as e:
+            logger.error("Error writing parse cache: %s", e)
+
+    def evict(self):
+        """
+        Remove the least recently used entries above max_entries
+        """
+        conn = self._store.connect()
+        count = conn.execute("SELECT COUNT(*) FROM parse_cache").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM parse_cache WHERE key IN "
+                "(SELECT key FROM parse_cache ORDER BY last_used LIMIT ?)",
+                (excess,)
+            )
+
+    def purge(self):
+        """
+        Delete the results produced by a different prompt or model, returns how many
+        """
+        return self._store.connect().execute("DELETE FROM parse_cache WHERE fingerprint != ?", (self.fingerprint,)).rowcount
+
+    def stats(self):
+        """
+        Get hit/miss counters of this process
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the parse cache of the host")
+    parser.add_argument("--purge", action="store_true",
+                        help="Delete the results of other prompts or models (run once all the workers are updated)")
+    args = parser.parse_args()
+
+    from services.llm_parser import parse_cache
+    if parse_cache is None:
+        print("The parse cache is disabled (PARSE_CACHE_ENABLED)")
+        return
+    if args.purge:
+        print(f"Deleted {parse_cache.purge()} results of other prompts or models from {parse_cache.path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+from services.metrics import metrics
+from config.logging_config import get_logger
+from storage.sqlite_store import SQLiteStore
+
+logger = get_logger(__name__)
+
+# What a message was rejected by
+SCOPE_USER = "user"
+SCOPE_GLOBAL = "global"
+SCOPE_CONCURRENCY = "concurrency"
+
+GLOBAL_KEY = "global"
+
+class RateLimitExceeded(Exception):
+    """
+    Raised when a message can't be sent to the LLM now: its user or the whole service
+    is over its rate, or too many LLM calls are in flight
+    """
+    def __init__(self, scope, retry_after):
+        super().__init__(f"Rate limit exceeded ({scope}), retry after {retry_after:.1f}s")
+        self.scope = scope
+        self.retry_after = retry_after
+
+# Tables of the rate limiter file
+SCHEMA = [
+    """
+        CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS llm_slots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pid INTEGER NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """
+]
+
+class RateLimiter:
+    """
+    Admission control of the messages sent to the LLM, shared by all the workers on the
+    host through a local SQLite database:
+
+    - a token bucket per user and one for the whole service: each message takes a token
+      from both, and buckets refill at their rate up to their burst size
+    - a limit on the LLM calls in flight, each call holds a slot until it ends (or until
+      slot_timeout, so the slots of a killed worker are freed)
+
+    Rejections are immediate (RateLimitExceeded). If the database can't be used, messages
+    are admitted: the limiter never takes the service down.
+    """
+    # Remove the buckets that have refilled completely every N admissions
+    PRUNE_INTERVAL = 1000
+
+    def __init__(self, path, user_rate, user_burst, global_rate, global_burst,
+                 max_concurrency=0, slot_timeout=120):
+        self.path = path
+        # Rates are in tokens per second, 0 disables the bucket
+        self.buckets = {SCOPE_USER: (user_rate, user_burst), SCOPE_GLOBAL: (global_rate, global_burst)}
+        self.max_concurrency = max_concurrency
+        self.slot_timeout = slot_timeout
+        self._admissions = 0
+        # The limiter state is disposable, it doesn't need to survive a crash
+        self._store = SQLiteStore(path, SCHEMA, timeout=1, synchronous="OFF")
+        self._lock = threading.Lock()
+
+    def _bucket_keys(self, user_id):
+        keys = []
+        if user_id is not None and self.buckets[SCOPE_USER][0] > 0:
+            keys.append((SCOPE_USER, f"user:{user_id}"))
+        if self.buckets[SCOPE_GLOBAL][0] > 0:
+            keys.append((SCOPE_GLOBAL, GLOBAL_KEY))
+        return keys
+
+    def admit(self, user_id=None):
+        """
+        Take a token from the bucket of the user and from the global bucket.
+        Raises RateLimitExceeded (and takes no token) if either one is empty.
+        """
+        keys = self._bucket_keys(user_id)
+        if not keys:
+            return
+        try:
+            rejection = self._take(keys)
+        except sqlite3.Error as e:
+            logger.error("Error checking the rate limits, admitting the message: %s", e)
+            metrics.increment("bot_rate_limit_requests_total", scope="rate", result="error")
+            return
+        if rejection:
+            scope, retry_after = rejection
+            metrics.increment("bot_rate_limit_requests_total", scope=scope, result="rejected")
+            raise RateLimitExceeded(scope, retry_after)
+        metrics.increment("bot_rate_limit_requests_total", scope="rate", result="admitted")
+
+    def _take(self, keys):
+        """
+        Take a token from each bucket in one transaction, returns (scope, retry_after)
+        of the first empty bucket, or None if the tokens were taken
+        """
+        conn = self._store.connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            levels = []
+            rejection = None
+            for scope, key in keys:
+                rate, burst = self.buckets[scope]
+                row = conn.execute("SELECT tokens, updated_at FROM rate_limit_buckets WHERE key = ?", (key,)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+                if tokens < 1:
+                    rejection = scope, (1 - tokens) / rate
+                    break
+                levels.append((key, tokens - 1))
+            if rejection is None:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO rate_limit_buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                    [(key, tokens, now) for key, tokens in levels]
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if rejection is not None:
+            return rejection
+
+        with self._lock:
+            self._admissions += 1
+            prune = self._admissions % self.PRUNE_INTERVAL == 0
+        if prune:
+            self.prune()
+        return None
+
+    def prune(self):
+        """
+        Remove the user buckets that are full again, a missing bucket is a full one
+        """
+        rate, burst = self.buckets[SCOPE_USER]
+        if rate <= 0:
+            return
+        self._store.connect().execute(
+            "DELETE FROM rate_limit_buckets WHERE key != ? AND updated_at < ?",
+            (GLOBAL_KEY, time.time() - burst / rate)
+        )
+
+    def acquire_slot(self):
+        """
+        Take one of the LLM call slots of the host, returns its ID (None when the limit is
+        disabled or can't be checked). Raises RateLimitExceeded if they're all taken.
+        """
+        if self.max_concurrency <= 0:
+            return None
+        try:
+            conn = self._store.connect()
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM llm_slots WHERE expires_at < ?", (now,))
+                in_flight = conn.execute("SELECT COUNT(*) FROM llm_slots").fetchone()[0]
+                slot_id = None
+                if in_flight < self.max_concurrency:
+                    slot_id = conn.execute(
+                        "INSERT INTO llm_slots (pid, expires_at) VALUES (?, ?)", (os.getpid(), now + self.slot_timeout)
+                    ).lastrowid
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            logger.error("Error checking the LLM concurrency limit, admitting the call: %s", e)
+            metrics.increment("bot_rate_limit_requests_total", scope=SCOPE_CONCURRENCY, result="error")
+            return None
+        if slot_id is not None:
+            metrics.increment("bot_rate_limit_requests_total", scope=SCOPE_CONCURRENCY, result="admitted")
+            return slot_id
+        metrics.increment("bot_rate_limit_requests_total", scope=SCOPE_CONCURRENCY, result="rejected")
+        # Calls in flight end within seconds, there is no better estimate
+        raise RateLimitExceeded(SCOPE_CONCURRENCY, 1.0)
+
+    def release_slot(self, slot_id):
+        """
+        Free a slot taken with acquire_slot
+        """
+        if slot_id is None:
+            return
+        try:
+            self._store.connect().execute("DELETE FROM llm_slots WHERE id = ?", (slot_id,))
+        except sqlite3.Error as e:
+            # It expires after slot_timeout anyway
+            logger.error("Error releasing an LLM call slot: %s", e)
+
+    def get_stats(self):
+        """
+        Get the shared state of the limiter: its settings, the tokens left in the global
+        bucket, the LLM calls in flight on the host and the users being limited
+        """
+        user_rate, user_burst = self.buckets[SCOPE_USER]
+        global_rate, global_burst = self.buckets[SCOPE_GLOBAL]
+        stats = {
+            "enabled": True,
+            "user_rate_per_minute": user_rate * 60,
+            "user_burst": user_burst,
+            "global_rate_per_minute": global_rate * 60,
+            "global_burst": global_burst,
+            "max_llm_concurrency": self.max_concurrency
+        }
+        try:
+            conn = self._store.connect()
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated_at FROM rate_limit_buckets WHERE key = ?", (GLOBAL_KEY,)).fetchone()
+            stats["global_tokens"] = global_burst if row is None else min(global_burst, row[0] + (now - row[1]) * global_rate)
+            stats["llm_calls_in_flight"] = conn.execute(
+                "SELECT COUNT(*) FROM llm_slots WHERE expires_at >= ?", (now,)
+            ).fetchone()[0]
+            # Users whose bucket is empty right now
+            stats["limited_users"] = conn.execute(
+                "SELECT COUNT(*) FROM rate_limit_buckets WHERE key != ? AND tokens + (? - updated_at) * ? < 1",
+                (GLOBAL_KEY, now, user_rate)
+            ).fetchone()[0]
+        except sqlite3.Error as e:
+            logger.error("Error reading the rate limiter state: %s", e)
+        return stats
+
+def retry_after_seconds(error):
+    """
+    Whole seconds a rate limited client should wait (for the Retry-After header)
+    """
+    return max(1, math.ceil(error.retry_after))
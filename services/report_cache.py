@@ -0,0 +1,159 @@
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from services.metrics import metrics
+from config.logging_config import get_logger
+from storage.sqlite_store import SQLiteStore
+
+logger = get_logger(__name__)
+
+# Length of the daily report window, in seconds
+DAY_SECONDS = 86400
+
+def report_expires_at(expenses, totals, read_at, ttl):
+    """
+    Time when a daily report read at read_at stops being valid: when its oldest expense
+    leaves the 24 hour window, or after ttl seconds. The oldest expense is only known
+    when the report lists all of them, otherwise the report lasts ttl seconds.
+    """
+    expires_at = read_at + ttl
+    if totals["count"] == len(expenses):
+        times = [expense.added_at.timestamp() for expense in expenses if isinstance(expense.added_at, datetime)]
+        if times:
+            expires_at = min(expires_at, min(times) + DAY_SECONDS)
+    return expires_at
+
+# Tables of the report cache file
+SCHEMA = [
+    """
+        CREATE TABLE IF NOT EXISTS daily_reports (
+            telegram_id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            report TEXT NOT NULL,
+            totals TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """,
+    "CREATE INDEX IF NOT EXISTS daily_reports_user_id ON daily_reports (user_id)",
+    """
+        CREATE TABLE IF NOT EXISTS report_invalidations (
+            user_id TEXT PRIMARY KEY,
+            invalidated_at REAL NOT NULL
+        )
+    """
+]
+
+class ReportCache:
+    """
+    Rendered daily reports and their totals by Telegram ID, shared by all the workers on
+    the host through a local SQLite database, so a repeated /report makes no database call.
+
+    A user's reports are dropped when they add an expense (invalidate), and expire when
+    their oldest expense leaves the 24 hour window. Expenses added through other hosts
+    show up after ttl seconds at most. A report read before an invalidation of its user is
+    not stored, so a report racing with a new expense can't hide it.
+    """
+    # Remove the expired reports every N stored reports
+    PURGE_INTERVAL = 1000
+
+    def __init__(self, path, ttl=300):
+        self.path = path
+        self.ttl = ttl
+        self._stored = 0
+        # The cache is disposable, it doesn't need to survive a crash
+        self._store = SQLiteStore(path, SCHEMA, timeout=1, synchronous="OFF")
+        self._lock = threading.Lock()
+
+    def get(self, telegram_id):
+        """
+        Get the cached report of a user as a tuple (user_id, report, totals), or None
+        """
+        try:
+            row = self._store.connect().execute(
+                "SELECT user_id, report, totals FROM daily_reports WHERE telegram_id = ? AND expires_at > ?",
+                (str(telegram_id), time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.error("Error reading the report cache: %s", e)
+            metrics.increment("bot_report_cache_requests_total", result="error")
+            return None
+        metrics.increment("bot_report_cache_requests_total", result="miss" if row is None else "hit")
+        if row is None:
+            return None
+        user_id, report, totals = row
+        return user_id, report, json.loads(totals)
+
+    def set(self, telegram_id, user_id, report, expenses, totals, read_at):
+        """
+        Cache the report of a user rendered from expenses and totals read from the database
+        at read_at (a time.time() taken before the read)
+        """
+        expires_at = report_expires_at(expenses, totals, read_at, self.ttl)
+        try:
+            conn = self._store.connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT invalidated_at FROM report_invalidations WHERE user_id = ?", (str(user_id),)
+                ).fetchone()
+                stale = row is not None and row[0] >= read_at
+                if not stale:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO daily_reports (telegram_id, user_id, report, totals, expires_at) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (str(telegram_id), str(user_id), report, json.dumps(totals), expires_at)
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            logger.error("Error writing the report cache: %s", e)
+            return
+
+        with self._lock:
+            self._stored += 1
+            purge = self._stored % self.PURGE_INTERVAL == 0
+        if purge:
+            self.purge()
+
+    def invalidate(self, user_ids):
+        """
+        Drop the cached reports of users whose expenses changed
+        """
+        user_ids = {str(user_id) for user_id in user_ids if user_id is not None}
+        if not user_ids:
+            return
+        now = time.time()
+        try:
+            conn = self._store.connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO report_invalidations (user_id, invalidated_at) VALUES (?, ?)",
+                    [(user_id, now) for user_id in user_ids]
+                )
+                conn.executemany("DELETE FROM daily_reports WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            # The reports are still dropped when they expire
+            logger.error("Error invalidating cached reports: %s", e)
+            return
+        metrics.increment("bot_report_cache_invalidations_total", value=len(user_ids))
+
+    def purge(self):
+        """
+        Remove the expired reports, and the invalidations older than any report being read
+        """
+        now = time.time()
+        try:
+            conn = self._store.connect()
+            conn.execute("DELETE FROM daily_reports WHERE expires_at <= ?", (now,))
+            conn.execute("DELETE FROM report_invalidations WHERE invalidated_at < ?", (now - self.ttl,))
+        except sqlite3.Error as e:
+            logger.error("Error purging the report cache: %s", e)
@@ -0,0 +1,176 @@
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from config.flow import io, register, run, run_async
+from services.metrics import metrics
+
+class SingleFlightTimeout(TimeoutError):
+    """
+    Raised when a call waited longer than the timeout for the identical call in flight
+    """
+
+class _Call:
+    """
+    A call in flight and the result shared with the callers waiting for it
+    """
+    def __init__(self, done):
+        self.done = done
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time in this process. Callers asking for a key
+    that is already in flight wait for that call and share its result, or its exception.
+
+    Keeps wait statistics for the most recently used keys (the same message forwarded
+    several times, connector retries...).
+    """
+    def __init__(self, name, timeout=30, max_stats_keys=1000):
+        self.name = name
+        self.timeout = timeout
+        self.max_stats_keys = max_stats_keys
+        self._calls = {}
+        self._async_calls = {}
+        self._stats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args):
+        """
+        Call function(*args), or wait for the call with the same key already in flight
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call(threading.Event())
+
+        if leader:
+            try:
+                call.result = function(*args)
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                    self._record(key, call)
+                call.done.set()
+            if call.error:
+                raise call.error
+            return call.result
+
+        start = time.perf_counter()
+        finished = call.done.wait(self.timeout)
+        return self._follower_result(key, call, finished, time.perf_counter() - start)
+
+    async def do_async(self, key, function, *args):
+        """
+        Async version of do, function is a coroutine function
+        """
+        call = self._async_calls.get(key)
+        if call is None:
+            call = self._async_calls[key] = _Call(asyncio.Event())
+            try:
+                call.result = await function(*args)
+            except Exception as e:
+                call.error = e
+            except asyncio.CancelledError:
+                # The waiters get an error instead of waiting for a result that won't come
+                call.error = RuntimeError(f"The {self.name} call in flight was cancelled")
+                raise
+            finally:
+                del self._async_calls[key]
+                with self._lock:
+                    self._record(key, call)
+                call.done.set()
+            if call.error:
+                raise call.error
+            return call.result
+
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(call.done.wait(), self.timeout)
+            finished = True
+        except asyncio.TimeoutError:
+            finished = False
+        return self._follower_result(key, call, finished, time.perf_counter() - start)
+
+    def do_flow(self, key, flow):
+        """
+        Request from a flow (see config.flow) to run another flow, or to wait for the
+        one with the same key already in flight
+        """
+        return io("single_flight", self, key, flow)
+
+    def _follower_result(self, key, call, finished, waited):
+        metrics.observe("bot_single_flight_wait_seconds", waited, call=self.name)
+        with self._lock:
+            stats = self._key_stats(key)
+            stats["waits"] += 1
+            stats["wait_seconds"] += waited
+            stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+            if not finished:
+                stats["timeouts"] += 1
+        if not finished:
+            metrics.increment("bot_single_flight_calls_total", call=self.name, role="timeout")
+            raise SingleFlightTimeout(f"Waited more than {self.timeout}s for the {self.name} call in flight")
+        metrics.increment("bot_single_flight_calls_total", call=self.name, role="follower")
+        if call.error:
+            raise call.error
+        return call.result
+
+    def _key_stats(self, key):
+        """
+        Get the statistics of a key, evicting the least recently used key if needed.
+        Must be called with the lock held.
+        """
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = {
+                "calls": 0, "errors": 0, "waits": 0, "timeouts": 0,
+                "wait_seconds": 0.0, "max_wait_seconds": 0.0
+            }
+            while len(self._stats) > self.max_stats_keys:
+                self._stats.popitem(last=False)
+        self._stats.move_to_end(key)
+        return stats
+
+    def _record(self, key, call):
+        stats = self._key_stats(key)
+        stats["calls"] += 1
+        if call.error:
+            stats["errors"] += 1
+        metrics.increment("bot_single_flight_calls_total", call=self.name, role="leader")
+
+    def get_stats(self, limit=20):
+        """
+        Get the wait statistics of the keys with the most waiting callers.
+        Keys are reported as a short digest, they may contain message texts.
+        """
+        with self._lock:
+            in_flight = len(self._calls) + len(self._async_calls)
+            items = [(key, dict(stats)) for key, stats in self._stats.items()]
+        items.sort(key=lambda item: (-item[1]["waits"], -item[1]["wait_seconds"]))
+        keys = []
+        for key, stats in items[:limit]:
+            stats["key"] = hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+            stats["avg_wait_seconds"] = round(stats["wait_seconds"] / stats["waits"], 6) if stats["waits"] else 0.0
+            stats["wait_seconds"] = round(stats["wait_seconds"], 6)
+            stats["max_wait_seconds"] = round(stats["max_wait_seconds"], 6)
+            keys.append(stats)
+        return {
+            "name": self.name,
+            "in_flight": in_flight,
+            "tracked_keys": len(items),
+            "calls": sum(stats["calls"] for _, stats in items),
+            "waits": sum(stats["waits"] for _, stats in items),
+            "keys": keys
+        }
+
+register(
+    "single_flight",
+    lambda flight, key, flow: flight.do(key, run, flow),
+    lambda flight, key, flow: flight.do_async(key, run_async, flow)
+)
@@ -0,0 +1,208 @@
+import sqlite3
+import time
+from models.expense_batch import ExpenseBatch
+from storage.sqlite_store import SQLiteStore
+
+# Added expenses are logged for this many seconds, so a seed whose database read missed
+# them can apply them on top of its snapshot
+_ADD_LOG_SECONDS = 3600
+
+def as_batch(expenses):
+    """
+    Get a list of expenses as an ExpenseBatch (a batch is returned as is)
+    """
+    return expenses if isinstance(expenses, ExpenseBatch) else ExpenseBatch.from_expenses(expenses)
+
+def summarize_expenses(expenses):
+    """
+    Compute the totals of a list of expenses (or an ExpenseBatch) over its columns.
+    Returns the same structure as SpendAggregates.totals.
+    """
+    return as_batch(expenses).summary()
+
+# Tables of the spend aggregates file
+SCHEMA = [
+    """
+        CREATE TABLE IF NOT EXISTS spend_buckets (
+            user_id TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            total REAL NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, bucket, category)
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS seeded_users (
+            user_id TEXT PRIMARY KEY,
+            seeded_at REAL NOT NULL
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS added_expenses (
+            user_id TEXT NOT NULL,
+            added_at REAL NOT NULL,
+            bucket INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            total REAL NOT NULL,
+            logged_at REAL NOT NULL
+        )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_added_expenses_user ON added_expenses (user_id, added_at)"
+]
+
+class SpendAggregates:
+    """
+    Per-user, per-category rolling spend totals kept in time buckets.
+
+    Totals are stored in a SQLite file shared by all the workers on the host and updated
+    when an expense is created, so window totals cost O(buckets x categories) instead of
+    a scan over the expense rows. A user's buckets are seeded once from the database and
+    re-seeded every reseed_interval seconds, which also picks up expenses written by
+    other hosts. Buckets older than the retention window are expired.
+
+    Expenses added while a seed reads the database may be missing from its snapshot, so
+    every add is also logged for a while, and the seed applies the logged expenses newer
+    than the newest one of its snapshot (its watermark).
+    """
+    def __init__(self, path, bucket_seconds=3600, retention_days=31, reseed_interval=86400):
+        self.path = path
+        self.bucket_seconds = bucket_seconds
+        self.retention_seconds = retention_days * 86400
+        self.reseed_interval = reseed_interval
+        self._store = SQLiteStore(path, SCHEMA, timeout=5)
+        self._last_expiry = 0
+
+    def _bucket(self, timestamp):
+        return int(timestamp // self.bucket_seconds)
+
+    def _bucket_rows(self, user_id, expenses):
+        """
+        Group expenses (a list or an ExpenseBatch) into (user_id, bucket, category, total, count) rows
+        """
+        buckets = {}
+        for bucket, category, cents, count in as_batch(expenses).bucket_totals(self.bucket_seconds):
+            # None and "Other" share a row
+            key = (bucket, category or "Other")
+            total, previous_count = buckets.get(key, (0, 0))
+            buckets[key] = (total + cents, previous_count + count)
+        return [(str(user_id), bucket, category, total / 100, count) for (bucket, category), (total, count) in buckets.items()]
+
+    def _added_rows(self, user_id, expenses, logged_at):
+        """
+        Get the (user_id, added_at, bucket, category, total, logged_at) log rows of added expenses
+        """
+        batch = as_batch(expenses)
+        return [
+            (str(user_id), timestamp, self._bucket(timestamp), batch.categories[code] or "Other", cents / 100, logged_at)
+            for cents, code, timestamp in zip(batch.amounts, batch.category_codes, batch.timestamps)
+        ]
+
+    def needs_seed(self, user_id):
+        """
+        Check if a user's buckets must be (re)loaded from the database
+        """
+        row = self._store.connect().execute(
+            "SELECT seeded_at FROM seeded_users WHERE user_id = ?", (str(user_id),)
+        ).fetchone()
+        return row is None or row[0] < time.time() - self.reseed_interval
+
+    def seed(self, user_id, expenses, loaded_at):
+        """
+        Replace a user's buckets with the totals of their expenses in the retention window.
+        loaded_at is the time the expenses were read from the database.
+
+        The logged adds newer than the newest expense read are applied on top: they were
+        stored after the read, and add() skipped them or the snapshot overwrote them.
+        """
+        batch = as_batch(expenses)
+        rows = self._bucket_rows(user_id, batch)
+        watermark = max(batch.timestamps) if len(batch) else float("-inf")
+        conn = self._store.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM spend_buckets WHERE user_id = ?", (str(user_id),))
+            conn.executemany("INSERT INTO spend_buckets VALUES (?, ?, ?, ?, ?)", rows)
+            conn.execute(
+                "INSERT INTO spend_buckets (user_id, bucket, category, total, count) "
+                "SELECT user_id, bucket, category, SUM(total), COUNT(*) FROM added_expenses "
+                "WHERE user_id = ? AND added_at > ? GROUP BY bucket, category "
+                "ON CONFLICT (user_id, bucket, category) "
+                "DO UPDATE SET total = total + excluded.total, count = count + excluded.count",
+                (str(user_id), watermark)
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO seeded_users (user_id, seeded_at) VALUES (?, ?)",
+                (str(user_id), loaded_at)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def add(self, expenses):
+        """
+        Add new expenses to the totals of their (already seeded) users, and log them for
+        the seeds running meanwhile. Expenses of users that were never seeded are only
+        logged, the seed will include them.
+        """
+        by_user = {}
+        for expense in expenses:
+            by_user.setdefault(str(expense.user_id), []).append(expense)
+
+        logged_at = time.time()
+        conn = self._store.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for user_id, user_expenses in by_user.items():
+                conn.executemany(
+                    "INSERT INTO added_expenses VALUES (?, ?, ?, ?, ?, ?)",
+                    self._added_rows(user_id, user_expenses, logged_at)
+                )
+                seeded = conn.execute("SELECT 1 FROM seeded_users WHERE user_id = ?", (user_id,)).fetchone()
+                if not seeded:
+                    continue
+                conn.executemany(
+                    "INSERT INTO spend_buckets (user_id, bucket, category, total, count) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (user_id, bucket, category) "
+                    "DO UPDATE SET total = total + excluded.total, count = count + excluded.count",
+                    self._bucket_rows(user_id, user_expenses)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        self._expire()
+
+    def totals(self, user_id, since):
+        """
+        Get a user's spend since a datetime (aligned to the bucket size)
+
+        Returns a dictionary with the total, the number of expenses and the total per category
+        """
+        rows = self._store.connect().execute(
+            "SELECT category, SUM(total), SUM(count) FROM spend_buckets "
+            "WHERE user_id = ? AND bucket >= ? GROUP BY category",
+            (str(user_id), self._bucket(since.timestamp()))
+        ).fetchall()
+        return {
+            "total": sum(row[1] for row in rows),
+            "count": sum(row[2] for row in rows),
+            "categories": {row[0]: row[1] for row in rows}
+        }
+
+    def _expire(self):
+        """
+        Delete buckets older than the retention window and the old add log, at most once
+        per bucket period
+        """
+        now = time.time()
+        if now - self._last_expiry < self.bucket_seconds:
+            return
+        self._last_expiry = now
+        conn = self._store.connect()
+        conn.execute(
+            "DELETE FROM spend_buckets WHERE bucket < ?", (self._bucket(now - self.retention_seconds),)
+        )
+        conn.execute("DELETE FROM added_expenses WHERE logged_at < ?", (now - _ADD_LOG_SECONDS,))
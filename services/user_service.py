@@ -1,36 +1,116 @@
 from repositories.user_repository import UserRepository
 from models.user import User
+from services.ttl_cache import TTLCache, MISSING
+from services.metrics import metrics
+from config.settings import USER_CACHE_SIZE, USER_CACHE_TTL, USER_CACHE_NEGATIVE_TTL
 
 class UserService:
     """
-    Service for user operations
+    Service for user operations. The methods that query the database are flows
+    (see config.flow), the cache is read directly.
     """
     def __init__(self):
         self.user_repository = UserRepository()
-        
+        # Cache of Telegram ID -> User (or None for unregistered users)
+        self.user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+    def _get_cached(self, telegram_id):
+        user = self.user_cache.get(str(telegram_id))
+        metrics.increment("bot_user_cache_requests_total", result="miss" if user is MISSING else "hit")
+        return user
+
+    def _cache_user(self, telegram_id, user):
+        # Cache negative lookups too, but for a shorter time
+        ttl = USER_CACHE_TTL if user else USER_CACHE_NEGATIVE_TTL
+        self.user_cache.set(str(telegram_id), user, ttl=ttl)
+
+    def _split_cached(self, telegram_ids):
+        """
+        Split Telegram IDs into cached users and the IDs that must be queried
+        """
+        users = {}
+        missing = []
+        for telegram_id in telegram_ids:
+            key = str(telegram_id)
+            if key in users:
+                continue
+            user = self.user_cache.get(key)
+            metrics.increment("bot_user_cache_requests_total", result="miss" if user is MISSING else "hit")
+            if user is MISSING:
+                missing.append(telegram_id)
+                users[key] = None
+            else:
+                users[key] = user
+        return users, missing
+
     def get_user(self, telegram_id):
         """
         Get a user by Telegram ID
         """
-        return self.user_repository.get_by_telegram_id(telegram_id)
-        
+        user = self._get_cached(telegram_id)
+        if user is not MISSING:
+            return user
+
+        # A failed query is raised, caching it as unregistered would tell the user to register
+        user = yield from self.user_repository.get_by_telegram_id(telegram_id, raise_errors=True)
+        self._cache_user(telegram_id, user)
+        return user
+
+    def get_users(self, telegram_ids):
+        """
+        Get several users by Telegram ID, querying the database at most once
+
+        Returns a dictionary of Telegram ID (as a string) -> User, or None if not registered
+        """
+        users, missing = self._split_cached(telegram_ids)
+        if not missing:
+            return users
+        # A failed query is raised instead of caching every user of the batch as unregistered
+        found_users = yield from self.user_repository.get_by_telegram_ids(missing, raise_errors=True)
+        found = {str(user.telegram_id): user for user in found_users}
+        for telegram_id in missing:
+            user = found.get(str(telegram_id))
+            users[str(telegram_id)] = user
+            self._cache_user(telegram_id, user)
+        return users
+
+    def get_cached_user(self, telegram_id):
+        """
+        Get a user from the cache without querying the database: the User, None for
+        an unregistered user, or MISSING when the user isn't cached
+        """
+        return self._get_cached(telegram_id)
+
+    def cache_user(self, telegram_id, user):
+        """
+        Cache a user found by another query (None for an unregistered user)
+        """
+        self._cache_user(telegram_id, user)
+
+    def get_cache_stats(self):
+        """
+        Get hit/miss counters of the user cache
+        """
+        return self.user_cache.stats()
+
     def create_user(self, telegram_id):
         """
         Create a new user with the given Telegram ID
         """
         # Create a new User instance
         user = User(telegram_id=telegram_id)
-        
+
         # Save the user to the database using the repository
-        created_user = self.user_repository.create(user)
-        
+        created_user = yield from self.user_repository.create(user)
+
         if not created_user:
             raise Exception("Failed to create user")
-            
+
+        self._cache_user(telegram_id, created_user)
         return created_user
-        
+
     def user_exists(self, telegram_id):
         """
         Check if a user exists by Telegram ID
         """
-        return self.user_repository.user_exists(telegram_id) 
\ No newline at end of file
+        return (yield from self.get_user(telegram_id)) is not None
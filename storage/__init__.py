@@ -0,0 +1,8 @@
+"""
+Storage backends for the repositories.
+
+A backend is a client exposing the subset of the Supabase (PostgREST) query builder
+used by the repositories: table(name).select/insert, the eq/gte/lt/lte/in_/or_ filters,
+order, limit and execute(), returning a response with a `data` list of rows.
+"""
+from storage.sqlite_backend import SQLiteClient, AsyncSQLiteClient
@@ -0,0 +1,373 @@
+import asyncio
+import contextlib
+import sqlite3
+import threading
+from datetime import datetime
+from storage.sqlite_store import SQLiteStore
+
+# Tables of the embedded database, with the same columns as the Supabase tables
+SCHEMA = {
+    "users": {
+        "columns": ["id", "telegram_id", "created_at"],
+        "ddl": """
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                telegram_id TEXT NOT NULL,
+                created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime'))
+            )
+        """,
+        "indexes": [
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_telegram_id ON users (telegram_id)"
+        ]
+    },
+    "expenses": {
+        "columns": ["id", "user_id", "description", "amount", "category", "added_at", "parsed_by"],
+        "ddl": """
+            CREATE TABLE IF NOT EXISTS expenses (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                description TEXT,
+                amount NUMERIC,
+                category TEXT,
+                added_at TEXT NOT NULL,
+                parsed_by TEXT
+            )
+        """,
+        "indexes": [
+            "CREATE INDEX IF NOT EXISTS idx_expenses_user_added_at ON expenses (user_id, added_at)"
+        ],
+        # Columns added after the table was first created, added to older database files
+        "added_columns": {"parsed_by": "TEXT"}
+    }
+}
+
+def _add_columns(conn):
+    """
+    Add the columns added after a table was first created to older database files
+    """
+    for table_name, table in SCHEMA.items():
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")}
+        for column, column_type in table.get("added_columns", {}).items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} {column_type}")
+
+# Statements creating the schema on a new connection
+SCHEMA_STATEMENTS = [table["ddl"] for table in SCHEMA.values()] + [_add_columns] + [
+    index for table in SCHEMA.values() for index in table["indexes"]
+]
+
+# Timestamp columns are stored as ISO strings with microseconds, so they compare as text
+TIMESTAMP_COLUMNS = {"created_at", "added_at"}
+
+# PostgREST operators supported in or_() filters
+_OPERATORS = {"eq": "=", "neq": "!=", "gt": ">", "gte": ">=", "lt": "<", "lte": "<="}
+
+def _split_conditions(text):
+    """
+    Split a PostgREST logic tree ("a.eq.1,and(b.gt.2,c.lt.3)") on its top-level commas
+    """
+    parts = []
+    depth = 0
+    quoted = False
+    start = 0
+    for index, char in enumerate(text):
+        if char == '"':
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            parts.append(text[start:index])
+            start = index + 1
+    parts.append(text[start:])
+    return [part.strip() for part in parts if part.strip()]
+
+def _normalize_value(column, value):
+    if column in TIMESTAMP_COLUMNS and isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value).isoformat(timespec="microseconds")
+        except ValueError:
+            return value
+    if isinstance(value, datetime):
+        return value.isoformat(timespec="microseconds")
+    return value
+
+def _expense_report(conn, params):
+    """
+    Local stand-in of the get_expense_report database function (storage/supabase_functions.sql)
+    """
+    telegram_id = str(params["p_telegram_id"])
+    since = _normalize_value("added_at", params["p_since"])
+    user = conn.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+    if user is None:
+        return {"user_id": None, "expenses": [], "total": 0, "count": 0, "categories": {}}
+    expenses = conn.execute(
+        "SELECT e.id, e.description, e.amount, e.category, e.added_at FROM expenses e "
+        "JOIN users u ON e.user_id = u.id WHERE u.telegram_id = ? AND e.added_at >= ? "
+        "ORDER BY e.added_at DESC, e.id DESC LIMIT ?",
+        (telegram_id, since, int(params["p_max_rows"]))
+    ).fetchall()
+    categories = conn.execute(
+        "SELECT COALESCE(e.category, 'Other') AS category, SUM(e.amount) AS total, COUNT(*) AS count "
+        "FROM expenses e JOIN users u ON e.user_id = u.id WHERE u.telegram_id = ? AND e.added_at >= ? "
+        "GROUP BY 1",
+        (telegram_id, since)
+    ).fetchall()
+    return {
+        "user_id": user["id"],
+        "expenses": [dict(row) for row in expenses],
+        "total": sum(row["total"] for row in categories),
+        "count": sum(row["count"] for row in categories),
+        "categories": {row["category"]: row["total"] for row in categories}
+    }
+
+# Database functions callable with rpc(), like the Postgres functions of the Supabase project
+RPC_FUNCTIONS = {
+    "get_expense_report": _expense_report
+}
+
+class SQLiteResponse:
+    """
+    Query response with the same `data` attribute as the Supabase client responses
+    """
+    def __init__(self, data):
+        self.data = data
+
+class SQLiteQuery:
+    """
+    Query builder with the subset of the Supabase query builder API used by the repositories
+    """
+    def __init__(self, client, table_name):
+        if table_name not in SCHEMA:
+            raise ValueError(f"Unknown table: {table_name}")
+        self.client = client
+        self.table_name = table_name
+        self.columns = SCHEMA[table_name]["columns"]
+        self.selected = self.columns
+        self.filters = []
+        self.params = []
+        self.ordering = []
+        self.limit_count = None
+        self.offset_count = None
+        self.rows = None
+
+    def _column(self, name):
+        if name not in self.columns:
+            raise ValueError(f"Unknown column {name} in table {self.table_name}")
+        return name
+
+    def select(self, columns="*"):
+        if columns.strip() != "*":
+            self.selected = [self._column(column.strip()) for column in columns.split(",")]
+        return self
+
+    def insert(self, data):
+        self.rows = data if isinstance(data, list) else [data]
+        return self
+
+    def _filter(self, column, operator, value):
+        self.filters.append(f"{self._column(column)} {operator} ?")
+        self.params.append(_normalize_value(column, value))
+        return self
+
+    def eq(self, column, value):
+        return self._filter(column, "=", value)
+
+    def neq(self, column, value):
+        return self._filter(column, "!=", value)
+
+    def gt(self, column, value):
+        return self._filter(column, ">", value)
+
+    def gte(self, column, value):
+        return self._filter(column, ">=", value)
+
+    def lt(self, column, value):
+        return self._filter(column, "<", value)
+
+    def lte(self, column, value):
+        return self._filter(column, "<=", value)
+
+    def in_(self, column, values):
+        values = list(values)
+        if not values:
+            self.filters.append("0")
+            return self
+        self.filters.append(f"{self._column(column)} IN ({','.join('?' * len(values))})")
+        self.params.extend(_normalize_value(column, value) for value in values)
+        return self
+
+    def or_(self, filters):
+        """
+        Filter with a PostgREST logic tree, e.g. 'added_at.lt."2024-01-01",and(added_at.eq."2024-01-01",id.lt.5)'.
+        Supports the eq/neq/gt/gte/lt/lte operators and nested and()/or().
+        """
+        sql, params = self._logic_tree(filters, "OR")
+        self.filters.append(sql)
+        self.params.extend(params)
+        return self
+
+    def _logic_tree(self, text, joiner):
+        conditions = []
+        params = []
+        for part in _split_conditions(text):
+            group = next((name for name in ("and", "or") if part.startswith(f"{name}(") and part.endswith(")")), None)
+            if group:
+                sql, group_params = self._logic_tree(part[len(group) + 1:-1], group.upper())
+            else:
+                column, operator, value = part.split(".", 2)
+                if operator not in _OPERATORS:
+                    raise ValueError(f"Unsupported operator in or_ filter: {operator}")
+                if len(value) >= 2 and value.startswith('"') and value.endswith('"'):
+                    value = value[1:-1]
+                sql = f"{self._column(column)} {_OPERATORS[operator]} ?"
+                group_params = [_normalize_value(column, value)]
+            conditions.append(sql)
+            params.extend(group_params)
+        return "(" + f" {joiner} ".join(conditions) + ")", params
+
+    def order(self, column, desc=False):
+        self.ordering.append(f"{self._column(column)} {'DESC' if desc else 'ASC'}")
+        return self
+
+    def limit(self, count):
+        self.limit_count = int(count)
+        return self
+
+    def range(self, start, end):
+        # Rows start to end, both included, like the Supabase client
+        self.offset_count = int(start)
+        self.limit_count = int(end) - int(start) + 1
+        return self
+
+    def _select_sql(self):
+        sql = f"SELECT {', '.join(self.selected)} FROM {self.table_name}"
+        if self.filters:
+            sql += " WHERE " + " AND ".join(self.filters)
+        if self.ordering:
+            sql += " ORDER BY " + ", ".join(self.ordering)
+        if self.limit_count is not None:
+            sql += f" LIMIT {self.limit_count}"
+        if self.offset_count:
+            sql += f" OFFSET {self.offset_count}"
+        return sql
+
+    def execute(self):
+        if self.rows is not None:
+            return SQLiteResponse(self.client.insert(self.table_name, self.rows))
+        return SQLiteResponse(self.client.query(self._select_sql(), self.params))
+
+class SQLiteRPC:
+    """
+    Database function call, executed like a query
+    """
+    def __init__(self, client, function_name, params):
+        if function_name not in RPC_FUNCTIONS:
+            raise ValueError(f"Unknown database function: {function_name}")
+        self.client = client
+        self.function_name = function_name
+        self.params = params or {}
+
+    def execute(self):
+        return SQLiteResponse(self.client.call(self.function_name, self.params))
+
+class SQLiteClient:
+    """
+    Embedded SQLite storage backend, a drop-in replacement for the Supabase client.
+
+    Uses WAL mode and one connection per thread, so several threads and worker
+    processes can read while one writes. ":memory:" keeps everything in a single
+    in-process connection, which is useful for tests and benchmarks.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._store = SQLiteStore(path, SCHEMA_STATEMENTS, synchronous="NORMAL", row_factory=sqlite3.Row)
+        self.memory = self._store.memory
+        self._lock = threading.RLock()
+        # Create the schema up front
+        self._store.connect()
+
+    def table(self, table_name):
+        return SQLiteQuery(self, table_name)
+
+    def rpc(self, function_name, params=None):
+        return SQLiteRPC(self, function_name, params)
+
+    def call(self, function_name, params):
+        """
+        Run a database function in one read transaction
+        """
+        with self._lock if self.memory else contextlib.nullcontext():
+            conn = self._store.connect()
+            conn.execute("BEGIN")
+            try:
+                return RPC_FUNCTIONS[function_name](conn, params)
+            finally:
+                conn.execute("COMMIT")
+
+    def query(self, sql, params=()):
+        """
+        Run a SELECT and return the rows as dictionaries
+        """
+        with self._lock if self.memory else contextlib.nullcontext():
+            return [dict(row) for row in self._store.connect().execute(sql, params).fetchall()]
+
+    def insert(self, table_name, rows):
+        """
+        Insert rows and return them as stored, like Supabase does
+        """
+        columns = SCHEMA[table_name]["columns"]
+        with self._lock if self.memory else contextlib.nullcontext():
+            conn = self._store.connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                ids = []
+                for row in rows:
+                    names = [name for name in row if name in columns and name != "id"]
+                    values = [_normalize_value(name, row[name]) for name in names]
+                    if table_name == "expenses" and "added_at" not in names:
+                        names.append("added_at")
+                        values.append(datetime.now().isoformat(timespec="microseconds"))
+                    cursor = conn.execute(
+                        f"INSERT INTO {table_name} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+                        values
+                    )
+                    ids.append(cursor.lastrowid)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+            placeholders = ",".join("?" * len(ids))
+            inserted = conn.execute(f"SELECT * FROM {table_name} WHERE id IN ({placeholders}) ORDER BY id", ids)
+            return [dict(row) for row in inserted.fetchall()]
+
+class AsyncSQLiteQuery(SQLiteQuery):
+    """
+    Query builder whose execute() is awaitable, like the async PostgREST client
+    """
+    async def execute(self):
+        return await asyncio.to_thread(super().execute)
+
+class AsyncSQLiteRPC(SQLiteRPC):
+    """
+    Database function call whose execute() is awaitable
+    """
+    async def execute(self):
+        return await asyncio.to_thread(super().execute)
+
+class AsyncSQLiteClient:
+    """
+    Async wrapper of SQLiteClient for the ASGI app
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def table(self, table_name):
+        return AsyncSQLiteQuery(self.client, table_name)
+
+    def rpc(self, function_name, params=None):
+        return AsyncSQLiteRPC(self.client, function_name, params)
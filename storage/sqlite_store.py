@@ -0,0 +1,60 @@
+import os
+import sqlite3
+import threading
+
+class SQLiteStore:
+    """
+    Connections to a SQLite file shared by the threads and worker processes of the host,
+    used by the embedded backend and by the local stores of the services (caches, rate
+    limiter, write-behind queue...).
+
+    Each thread gets its own connection in WAL mode, opened on first use, and a forked
+    process opens new ones: connections are never shared across threads or processes.
+    ":memory:" keeps everything in a single in-process connection, the caller serializes
+    its use.
+
+    The schema is a list of SQL statements, or of functions called with the connection
+    for what SQL can't express, run on every new connection.
+    """
+    def __init__(self, path, schema, timeout=5, synchronous=None, row_factory=None):
+        self.path = path
+        self.schema = schema
+        self.timeout = timeout
+        # None keeps SQLite's default (FULL)
+        self.synchronous = synchronous
+        self.row_factory = row_factory
+        self.memory = path == ":memory:"
+        self._local = threading.local()
+        self._shared_conn = None
+
+    def connect(self):
+        """
+        Get the connection of the current thread, opening it if needed
+        """
+        if self.memory:
+            if self._shared_conn is None:
+                self._shared_conn = self._open()
+            return self._shared_conn
+
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = self._open()
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=not self.memory)
+        if self.row_factory is not None:
+            conn.row_factory = self.row_factory
+        if not self.memory:
+            conn.execute("PRAGMA journal_mode=WAL")
+            if self.synchronous is not None:
+                conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        for statement in self.schema:
+            if callable(statement):
+                statement(conn)
+            else:
+                conn.execute(statement)
+        return conn
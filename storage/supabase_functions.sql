@@ -0,0 +1,43 @@
+-- Database functions of the Supabase project, run this file in the Supabase SQL editor.
+-- storage/sqlite_backend.py has a local stand-in of each one (RPC_FUNCTIONS).
+
+-- Parse path of each expense (rules, classifier, llm, degraded): the category classifier
+-- doesn't learn the categories it chose itself. Null for expenses stored before.
+alter table expenses add column if not exists parsed_by text;
+
+-- Daily report in a single round trip: resolves the user by Telegram ID and returns their
+-- p_max_rows most recent expenses since p_since, with the totals of all of them.
+-- user_id is null for unregistered users.
+create or replace function get_expense_report(p_telegram_id text, p_since timestamptz, p_max_rows integer)
+returns json
+language sql
+stable
+as $$
+    with report_user as (
+        -- Cast so the function also works when users.telegram_id is a bigint
+        select id from users where telegram_id::text = p_telegram_id
+    ),
+    window_expenses as (
+        select e.id, e.description, e.amount, e.category, e.added_at
+        from expenses e
+        join report_user u on e.user_id = u.id
+        where e.added_at >= p_since
+    ),
+    category_totals as (
+        select coalesce(category, 'Other') as category, sum(amount) as total, count(*) as count
+        from window_expenses
+        group by 1
+    )
+    select json_build_object(
+        'user_id', (select id from report_user),
+        'expenses', coalesce((
+            select json_agg(recent order by recent.added_at desc, recent.id desc)
+            from (
+                select * from window_expenses order by added_at desc, id desc limit p_max_rows
+            ) recent
+        ), '[]'::json),
+        'total', coalesce((select sum(total) from category_totals), 0),
+        'count', coalesce((select sum(count) from category_totals), 0),
+        'categories', coalesce((select json_object_agg(category, total) from category_totals), '{}'::json)
+    )
+$$;